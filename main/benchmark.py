@@ -0,0 +1,690 @@
+"""Benchmark code."""
+
+import argparse
+import contextlib
+import gc
+import http.server
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from urllib.parse import parse_qs, unquote, urlsplit
+import numpy as np
+import pandas as pd
+import property_database as ppd
+import property_events as ppe
+import property_geo as pgeo
+import property_json as ppj
+import property_monitor as ppm
+import property_query as ppq
+
+STREETS = ["Flemington Road", "Swanston Street", "Sturt Street", "Queens Road", "Lygon St"]
+SUBURBS = ["Parkville", "Carlton", "Southbank", "Melbourne"]
+
+
+def get_latitude(i):
+    return -37.85 + (i * 7919 % 100003) * 1e-6
+
+
+def get_longitude(i):
+    return 144.9 + (i * 6007 % 100019) * 1e-6
+
+
+def make_realestate_listing(i):
+    return {
+        "_links": {"prettyUrl": {"href": f"https://www.realestate.com.au/property-{i}"}},
+        "features": {"general": {"bedrooms": i % 4 + 1, "bathrooms": i % 2 + 1, "parkingSpaces": i % 3}},
+        "price": {"display": f"${300 + i % 900} per week"},
+        "propertyType": "apartment" if i % 5 else "house",
+        "address": {
+            "streetAddress": f"{i + 1}/{i % 300 + 1} {STREETS[i % len(STREETS)]}",
+            "suburb": SUBURBS[i % len(SUBURBS)],
+            "state": "vic",
+            "location": {"latitude": get_latitude(i), "longitude": get_longitude(i)},
+        },
+        "dateAvailable": {"date": "2021-09-01"},
+        "images": [{"server": "https://i2.au.reastatic.net", "uri": f"/{i}/{j}.jpg"} for j in range(8)],
+    }
+
+
+def make_domain_listing(i):
+    return {
+        "listingModel": {
+            "url": f"/{i % 300 + 1}-{STREETS[i % len(STREETS)].lower().replace(' ', '-')}-{i}",
+            "price": f"${300 + i % 900} pw",
+            "address": {
+                "street": f"{i + 1}/{i % 300 + 1} {STREETS[i % len(STREETS)]}",
+                "suburb": SUBURBS[i % len(SUBURBS)].upper(),
+                "state": "vic",
+                "lat": get_latitude(i),
+                "lng": get_longitude(i),
+            },
+            "features": {
+                "beds": i % 4 + 1,
+                "baths": i % 2 + 1,
+                "parking": i % 3,
+                "propertyTypeFormatted": "Apartment / Unit / Flat",
+            },
+            "images": [f"https://rimh2.domainstatic.com.au/{i}/{j}.jpg" for j in range(8)],
+        }
+    }
+
+
+def make_realestate_pages(n_listings, page_size=200):
+    """Search result pages of n_listings synthetic Realestate listings."""
+    return [
+        {
+            "totalResultsCount": n_listings,
+            "resolvedQuery": {"pageSize": str(page_size)},
+            "tieredResults": [
+                {"results": [make_realestate_listing(i) for i in range(start, min(start + page_size, n_listings))]}
+            ],
+        }
+        for start in range(0, max(n_listings, 1), page_size)
+    ]
+
+
+def make_domain_pages(n_listings, page_size=20):
+    """Search result pages of n_listings synthetic Domain listings."""
+    n_pages = max(int(np.ceil(n_listings / page_size)), 1)
+    return [
+        {
+            "props": {
+                "pageViewMetadata": {
+                    "searchResponse": {
+                        "SearchResults": {
+                            "totalPages": n_pages,
+                            "totalResults": n_listings,
+                            "actualTotalResultsExceedsMaximum": False,
+                        }
+                    }
+                },
+                "listingsMap": {
+                    str(i): make_domain_listing(i)
+                    for i in range(page * page_size, min((page + 1) * page_size, n_listings))
+                },
+            }
+        }
+        for page in range(n_pages)
+    ]
+
+
+def legacy_parse_realestate_pages(pages):
+    content = pages[0]
+    for page_content in pages[1:]:
+        content["tieredResults"][0]["results"].extend(page_content["tieredResults"][0]["results"])
+    property_info = []
+    for estate_web in content["tieredResults"][0]["results"]:
+        estate_info = dict()
+        estate_info["Url"] = estate_web["_links"]["prettyUrl"]["href"]
+        estate_info["Bedroom_num"] = estate_web["features"]["general"]["bedrooms"]
+        estate_info["Bathroom_num"] = estate_web["features"]["general"]["bathrooms"]
+        estate_info["Parking_num"] = estate_web["features"]["general"]["parkingSpaces"]
+        estate_info["Price"] = estate_web["price"]["display"]
+        estate_info["Type"] = estate_web["propertyType"].capitalize()
+        estate_info["Name"] = estate_web["address"]["streetAddress"]
+        estate_info["Suburb"] = "".join(estate_web["address"]["suburb"].split(" ")).lower().capitalize()
+        estate_info["State"] = estate_web["address"]["state"].upper()
+        estate_info["Latitude"] = estate_web["address"]["location"]["latitude"]
+        estate_info["Longitude"] = estate_web["address"]["location"]["longitude"]
+        estate_info["Available"] = estate_web["dateAvailable"]["date"]
+        estate_info["Images"] = estate_web["images"]
+        property_info.append(estate_info)
+    return pd.DataFrame(property_info)
+
+
+def legacy_parse_domain_pages(pages):
+    content = pages[0]
+    for page_content in pages[1:]:
+        content["props"]["listingsMap"] = {
+            **content["props"]["listingsMap"],
+            **page_content["props"]["listingsMap"],
+        }
+    property_info = []
+    for estate_web in content["props"]["listingsMap"].values():
+        estate_web = estate_web["listingModel"]
+        estate_info = dict()
+        estate_info["Url"] = "https://www.domain.com.au" + estate_web["url"]
+        estate_info["Price"] = estate_web["price"]
+        estate_info["Name"] = estate_web["address"]["street"]
+        estate_info["Suburb"] = "".join(estate_web["address"]["suburb"].split(" ")).lower().capitalize()
+        estate_info["State"] = estate_web["address"]["state"].upper()
+        estate_info["Latitude"] = estate_web["address"]["lat"]
+        estate_info["Longitude"] = estate_web["address"]["lng"]
+        estate_info["Bedroom_num"] = estate_web["features"].get("beds", None)
+        estate_info["Bathroom_num"] = estate_web["features"].get("baths", None)
+        estate_info["Parking_num"] = estate_web["features"].get("parking", 0)
+        estate_info["Type"] = estate_web["features"].get("propertyTypeFormatted", None)
+        estate_info["Images"] = estate_web["images"]
+        property_info.append(estate_info)
+    return pd.DataFrame(property_info)
+
+
+def legacy_merge_realestate_domain_properties(rp, dp):
+    if rp.PID.dropna().duplicated().any() or dp.PID.dropna().duplicated().any():
+        dup_indices = rp.dropna()[rp.PID.dropna().duplicated(keep=False)].index
+        rp.loc[dup_indices, "PID"] = np.nan
+        dup_indices = dp.dropna()[dp.PID.dropna().duplicated(keep=False)].index
+        dp.loc[dup_indices, "PID"] = np.nan
+    rp_pid = set(rp.PID.dropna())
+    dp_pid = set(dp.PID.dropna())
+    both_pid = rp_pid & dp_pid
+    ronly_pid = rp_pid - dp_pid
+    donly_pid = dp_pid - rp_pid
+    both = rp.query("PID in @both_pid").copy()
+    both["Source"] = "Both"
+    rsource = rp[rp["PID"].isin(ronly_pid) | rp["PID"].isna()]
+    dsource = dp[dp["PID"].isin(donly_pid) | dp["PID"].isna()]
+    merge_p = pd.concat([both, rsource, dsource], ignore_index=True).sort_values(["Street", "Room"])
+    indices = merge_p["PID"].fillna(merge_p["Url"])
+    indices.name = ""
+    merge_p.index = indices
+    return merge_p
+
+
+def make_portal_properties(n_listings):
+    """Parsed Realestate and Domain listings, of which the Domain ones are offset by a third."""
+    rp = ppq.parse_realestate_pages(iter(make_realestate_pages(n_listings)))
+    rp = ppq.add_room_street_pid(rp, after="Name")
+    rp = ppq.add_weekly_price(rp)
+    rp["Source"] = "Realestate"
+    dp = ppq.parse_domain_pages(iter(make_domain_pages(n_listings + n_listings // 3)))
+    dp = ppq.add_room_street_pid(dp.iloc[n_listings // 3 :].reset_index(drop=True), after="Type")
+    dp = ppq.add_weekly_price(dp)
+    dp["Source"] = "Domain"
+    dp["Available"] = ""
+    return rp, dp
+
+
+def make_tracked_properties(n_props, seed=0):
+    rng = np.random.default_rng(seed)
+    pids = [f"{i}_Flemington_Parkville_VIC" for i in range(n_props)]
+    return pd.DataFrame(
+        {
+            "Price": [f"${x} per week" for x in rng.integers(300, 1500, n_props)],
+            "Bedroom_num": rng.integers(1, 5, n_props).astype(float),
+            "Bathroom_num": rng.integers(1, 3, n_props),
+            "Parking_num": rng.integers(0, 3, n_props),
+            "Source": rng.choice(["Realestate", "Domain", "Both"], n_props),
+        },
+        index=pids,
+    )
+
+
+def make_updated_properties(previous, change_ratio=0.05, seed=1):
+    """Reprice, delist and add change_ratio of the listings each."""
+    rng = np.random.default_rng(seed)
+    n_change = int(len(previous) * change_ratio)
+    current = previous.copy()
+    repriced = rng.choice(len(current), n_change, replace=False)
+    current.iloc[repriced, 0] = "$999 per week"
+    current = current.iloc[n_change:]
+    added = make_tracked_properties(n_change, seed=seed)
+    added.index = [f"{i}_Swanston_Carlton_VIC" for i in range(n_change)]
+    return pd.concat([current, added])
+
+
+def legacy_get_prop_value_change(previous_prop, current_prop):
+    row_same = previous_prop.eq(current_prop).all(axis=1)
+    if all(row_same):
+        return None
+    diff_dict = dict()
+    for pid in row_same[~row_same].index:
+        diff_val = dict()
+        for col in previous_prop.columns:
+            pre_val = previous_prop.loc[pid, col]
+            cur_val = current_prop.loc[pid, col]
+            if pre_val != cur_val:
+                diff_val[col] = (pre_val, cur_val)
+        diff_dict[pid] = diff_val
+    return diff_dict
+
+
+def time_call(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_call(make_args, func):
+    """Return (seconds, peak traced bytes) of func(*make_args()), excluding building the arguments."""
+    args = make_args()
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def bench_parse(n_listings=2000):
+    """Legacy merge-then-parse against page streaming, on 10 Realestate and 10 Domain pages."""
+    result = {"n_listings": n_listings}
+    cases = [
+        ("realestate", make_realestate_pages, legacy_parse_realestate_pages, ppq.parse_realestate_pages),
+        ("domain", make_domain_pages, legacy_parse_domain_pages, ppq.parse_domain_pages),
+    ]
+    for name, make_pages, legacy_parse, parse in cases:
+        page_size = int(np.ceil(n_listings / 10))
+        make_args = lambda: (make_pages(n_listings, page_size),)
+        # Streaming keeps no reference to the parsed pages.
+        stream_args = lambda: (iter(make_pages(n_listings, page_size)),)
+        seconds, peak = measure_call(make_args, legacy_parse)
+        result[f"legacy_{name}_s"], result[f"legacy_{name}_peak_mb"] = seconds, peak / 2**20
+        seconds, peak = measure_call(stream_args, parse)
+        result[f"{name}_s"], result[f"{name}_peak_mb"] = seconds, peak / 2**20
+    return result
+
+
+def bench_diff(n_props=20000, change_ratio=0.05):
+    previous = make_tracked_properties(n_props)
+    current = make_updated_properties(previous, change_ratio)
+    same_pids = previous.index.intersection(current.index)
+    pre_same, cur_same = previous.loc[same_pids], current.loc[same_pids]
+    return {
+        "n_props": n_props,
+        "legacy_value_change_s": time_call(legacy_get_prop_value_change, pre_same, cur_same),
+        "value_change_s": time_call(ppm.get_prop_value_change, pre_same, cur_same),
+        "diff_property_info_s": time_call(ppm.diff_property_info, previous, current),
+    }
+
+
+def bench_snapshot(n_props=20000):
+    """Time a full save and a check-column load of the tracked properties per snapshot format."""
+    property_data = make_tracked_properties(n_props)
+    property_data["Url"] = [f"https://www.domain.com.au/{i}" for i in range(n_props)]
+    property_data["Name"] = [f"{i}/83 Flemington Road" for i in range(n_props)]
+    property_data["Images"] = [[f"https://i/{i}_{j}.jpg" for j in range(10)] for i in range(n_props)]
+    result = {"n_props": n_props}
+    for fmt in ppm.SNAPSHOT_BACKENDS:
+        read_snapshot, write_snapshot = ppm.SNAPSHOT_BACKENDS[fmt]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, f"tracked_properties.{fmt}")
+            try:
+                result[f"{fmt}_save_s"] = time_call(write_snapshot, path, property_data)
+            except ImportError:  # No Parquet engine installed.
+                continue
+            result[f"{fmt}_load_s"] = time_call(read_snapshot, path, ppm.CHECK_COL)
+    return result
+
+
+def bench_merge(n_listings=20000):
+    rp, dp = make_portal_properties(n_listings)
+    return {
+        "n_listings": n_listings,
+        "legacy_merge_s": time_call(
+            lambda: legacy_merge_realestate_domain_properties(rp.copy(), dp.copy())
+        ),
+        "merge_s": time_call(lambda: ppq.merge_realestate_domain_properties(rp, dp, None)),
+        "merge_geo_s": time_call(lambda: ppq.merge_realestate_domain_properties(rp, dp)),
+    }
+
+
+def bench_memory(n_listings=20000):
+    """Memory of the merged listings before and after compact_properties."""
+    rp, dp = make_portal_properties(n_listings)
+    merged = ppq.merge_realestate_domain_properties(rp, dp)
+    plain = merged.astype({col: object for col in ppq.CATEGORY_COLUMNS})
+    plain = plain.astype({col: "float64" for col in ppq.COUNT_COLUMNS})
+    # Image lists as parsed from the pages, without shared strings.
+    plain["Images"] = plain["Images"].map(json.dumps).map(json.loads)
+    return {
+        "n_listings": n_listings,
+        "plain_mb": ppq.get_memory_report(plain)["total"] / 2**20,
+        "compact_mb": ppq.get_memory_report(merged)["total"] / 2**20,
+    }
+
+
+def bench_geo(n_props=50000, n_queries=200):
+    """Average milliseconds of GeoIndex queries against a scan of every listing."""
+    rng = np.random.default_rng(0)
+    props = pd.DataFrame(
+        {
+            "Latitude": -37.8 + rng.uniform(-0.15, 0.15, n_props),
+            "Longitude": 144.96 + rng.uniform(-0.2, 0.2, n_props),
+        },
+        index=[f"{i}_Flemington_Parkville_VIC" for i in range(n_props)],
+    )
+    lats, lons = props["Latitude"].to_numpy(), props["Longitude"].to_numpy()
+    geo_index = pgeo.GeoIndex(props)
+    polygon = [(-37.79, 144.95), (-37.79, 144.97), (-37.81, 144.97), (-37.81, 144.95)]
+    cases = {
+        "scan_radius": lambda: props.index[pgeo.get_distance(-37.8, 144.96, lats, lons) <= 1500],
+        "radius": lambda: geo_index.query_radius(-37.8, 144.96, 1500),
+        "polygon": lambda: geo_index.query_polygon(polygon),
+        "nearest_10": lambda: geo_index.query_nearest(-37.8, 144.96, 10),
+    }
+    result = {"n_props": n_props, "build_s": time_call(pgeo.GeoIndex, props, repeat=1)}
+    for name, query in cases.items():
+        start = time.perf_counter()
+        for _ in range(n_queries):
+            query()
+        result[f"{name}_ms"] = (time.perf_counter() - start) * 1000 / n_queries
+    return result
+
+
+def bench_property_json(n_events=10000):
+    """
+    Apply n_events listing changes (a third each listed again, delisted and repriced) to a
+    property database, through listing events against updating the entities in place.
+    """
+    rp, dp = make_portal_properties(n_events)
+    merged = ppq.merge_realestate_domain_properties(rp, dp, None)
+    n_change = n_events // 3
+    previous = merged.iloc[n_change:]
+    current = merged.iloc[:-n_change].copy()
+    current.iloc[n_change : 2 * n_change, current.columns.get_loc("Price")] = "$999 per week"
+    current = ppq.add_weekly_price(current.drop(columns=ppm.PRICE_COLUMNS))
+    times = ["2021-09-01 12:00:00", "2021-09-02 12:00:00"]
+    make_args = lambda: (ppj.init_property_database(merged, times[0]),)
+
+    def apply_events(props_db):
+        update_dict = ppm.diff_property_info(previous, current)
+        return ppj.apply_property_events(props_db, ppe.make_events(update_dict, current, times[1]))
+
+    result = {"n_events": 3 * n_change}
+    seconds, peak = measure_call(make_args, apply_events)
+    result["events_s"], result["events_peak_mb"] = seconds, peak / 2**20
+    seconds, peak = measure_call(
+        make_args, lambda props_db: ppj.updates_property_json(current, previous, props_db, times[1])
+    )
+    result["in_place_s"], result["in_place_peak_mb"] = seconds, peak / 2**20
+    return result
+
+
+# Realestate returns at most 10 pages of 200 listings per search.
+STUB_CHUNK_SIZE = 2000
+BENCH_SIZES = [1000, 10000, 100000]
+# Committed baseline, recorded with --save-baseline at the BENCH_SIZES on a single core machine.
+# Timings depend on the machine: record a new one when benchmarking elsewhere.
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+# A measure regresses when it exceeds its baseline by this ratio and by the minimum difference.
+# The stub round trips make the timings of the portal stages vary by a few tenths of a second,
+# the in-process stages are timed as the best of IN_PROCESS_REPEAT runs instead, without the
+# tracemalloc overhead which is several times their duration.
+REGRESSION_TOLERANCE = 0.25
+MIN_REGRESSION = {"seconds": 0.0, "peak_mb": 1.0}
+STUB_MIN_REGRESSION = {"seconds": 0.5, "peak_mb": 1.0}
+STUB_STAGES = {"get_realestate_properties", "get_domain_properties"}
+IN_PROCESS_REPEAT = 5
+
+
+def make_stub_realestate_page(chunk, page, chunk_size, page_size=200):
+    start = chunk * chunk_size + (page - 1) * page_size
+    stop = min(start + page_size, (chunk + 1) * chunk_size)
+    return {
+        "totalResultsCount": chunk_size,
+        "resolvedQuery": {"pageSize": str(page_size)},
+        "tieredResults": [{"results": [make_realestate_listing(i) for i in range(start, stop)]}],
+    }
+
+
+def make_stub_domain_page(chunk, page, chunk_size, page_size=20):
+    """Domain listings of a chunk are those of Realestate shifted by a third of the chunk."""
+    first = chunk * chunk_size + chunk_size // 3
+    start = first + (page - 1) * page_size
+    stop = min(start + page_size, first + chunk_size)
+    return {
+        "props": {
+            "pageViewMetadata": {
+                "searchResponse": {
+                    "SearchResults": {
+                        "totalPages": int(np.ceil(chunk_size / page_size)),
+                        "totalResults": chunk_size,
+                        "actualTotalResultsExceedsMaximum": False,
+                    }
+                }
+            },
+            "listingsMap": {str(i): make_domain_listing(i) for i in range(start, stop)},
+        }
+    }
+
+
+class PortalStubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve synthetic search pages for the urls of property_query. The listings of a search
+    depend on its north bound: chunk k has north k + 1 and chunk_size listings.
+    """
+
+    chunk_size = STUB_CHUNK_SIZE
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path.endswith("/services/listings/search"):
+            query = json.loads(unquote(url.query).split("query=", 1)[1])
+            chunk = int(float(query["boundingBoxSearch"][2])) - 1
+            content = make_stub_realestate_page(chunk, int(query.get("page", 1)), self.chunk_size)
+        elif url.path == "/rent/":
+            query = parse_qs(url.query)
+            chunk = int(float(query["startloc"][0].split(",")[0])) - 1
+            page = int(query.get("page", ["1"])[0])
+            content = make_stub_domain_page(chunk, page, self.chunk_size)
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps(content).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        return
+
+
+def serve_portal_stub(chunk_size, port_queue):
+    PortalStubHandler.chunk_size = chunk_size
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), PortalStubHandler)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+@contextlib.contextmanager
+def portal_stub(chunk_size=STUB_CHUNK_SIZE):
+    """
+    Run the stub portals in another process, so they are not traced by the memory
+    measurements, and point property_query at them.
+    """
+    context = multiprocessing.get_context("spawn")
+    port_queue = context.Queue()
+    process = context.Process(target=serve_portal_stub, args=(chunk_size, port_queue), daemon=True)
+    process.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=60)}"
+    urls = ppq.DOMAIN_URL, ppq.REALESTATE_SEARCH_URL
+    ppq.DOMAIN_URL = base_url
+    ppq.REALESTATE_SEARCH_URL = base_url + "/services/listings/search"
+    try:
+        yield base_url
+    finally:
+        ppq.DOMAIN_URL, ppq.REALESTATE_SEARCH_URL = urls
+        process.terminate()
+        process.join()
+
+
+def get_stub_requisitions(n_chunks):
+    return [{"north": k + 1, "south": k, "west": 144.0, "east": 145.0} for k in range(n_chunks)]
+
+
+def run_measured(func, *args, traced=True):
+    """Return (result, seconds, peak traced MiB) of func(*args), the peak is nan untraced."""
+    gc.collect()
+    if traced:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    if not traced:
+        return result, seconds, np.nan
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / 2**20
+
+
+def query_chunks(query_func, requisitions, page_workers):
+    return pd.concat(
+        [query_func(req, max_workers=page_workers) for req in requisitions], ignore_index=True
+    )
+
+
+def reprice_and_delist(properties, change_ratio=0.05):
+    """Reprice change_ratio of the listings and delist as many others."""
+    n_change = int(len(properties) * change_ratio)
+    current = properties.iloc[n_change:].copy()
+    current.iloc[::max(int(1 / change_ratio), 1), current.columns.get_loc("Price")] = "$999 per week"
+    return ppq.add_weekly_price(current.drop(columns=ppm.PRICE_COLUMNS))
+
+
+def bench_pipeline(n_listings, page_workers=4):
+    """
+    Throughput (listings per second) and peak memory of each stage of a monitor run on
+    n_listings synthetic listings per portal, served by the stub portals.
+    """
+    chunk_size = min(n_listings, STUB_CHUNK_SIZE)
+    requisitions = get_stub_requisitions(int(np.ceil(n_listings / chunk_size)))
+    n_listings = chunk_size * len(requisitions)
+    result = dict()
+
+    def record(name, func, make_args, repeat=IN_PROCESS_REPEAT):
+        """
+        Measure the peak of a traced run of func(*make_args()) and the best seconds of repeat
+        untraced runs, or of the traced run when repeat is 0.
+        """
+        output, seconds, peak_mb = run_measured(func, *make_args())
+        if repeat > 0:
+            seconds = min(
+                run_measured(func, *make_args(), traced=False)[1] for _ in range(repeat)
+            )
+        result[name] = {
+            "seconds": seconds,
+            "peak_mb": peak_mb,
+            "throughput": n_listings / seconds if seconds > 0 else np.inf,
+        }
+        return output
+
+    with portal_stub(chunk_size):
+        rp = record(
+            "get_realestate_properties",
+            query_chunks,
+            lambda: (ppq.get_realestate_properties, requisitions, page_workers),
+            repeat=0,
+        )
+        dp = record(
+            "get_domain_properties",
+            query_chunks,
+            lambda: (ppq.get_domain_properties, requisitions, page_workers),
+            repeat=0,
+        )
+    merged = record(
+        "merge_realestate_domain_properties",
+        ppq.merge_realestate_domain_properties,
+        lambda: (rp, dp),
+    )
+    current = reprice_and_delist(merged)
+    record("diff_property_info", ppm.diff_property_info, lambda: (merged, current))
+    # The update changes the database in place, so each run gets a new one.
+    record(
+        "updates_property_json",
+        ppj.updates_property_json,
+        lambda: (
+            current,
+            merged,
+            ppj.init_property_database(merged, "2021-09-01 12:00:00"),
+            "2021-09-02 12:00:00",
+        ),
+    )
+    return result
+
+
+def bench_sweep(n_listings=20000, worker_counts=(1, 2, 4, 8)):
+    """
+    Seconds of a whole sweep of the stub portals per number of workers, with threads and with
+    worker processes. Processes should scale with the cores, threads stop at the parsing.
+    """
+    chunk_size = min(n_listings, STUB_CHUNK_SIZE)
+    requisitions = get_stub_requisitions(int(np.ceil(n_listings / chunk_size)))
+    result = {"n_listings": chunk_size * len(requisitions), "cores": os.cpu_count()}
+    with portal_stub(chunk_size):
+        for max_workers in worker_counts:
+            for mode, processes in [("threads", False), ("processes", True)]:
+                result[f"{mode}_{max_workers}_s"] = time_call(
+                    lambda: ppd.query_multi_chunk_properties(
+                        requisitions, max_workers=max_workers, processes=processes
+                    ),
+                    repeat=1,
+                )
+    return result
+
+
+def run_benchmarks(sizes=BENCH_SIZES, page_workers=4):
+    return {str(n_listings): bench_pipeline(n_listings, page_workers) for n_listings in sizes}
+
+
+def find_regressions(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Describe every measure of results exceeding the same measure of baseline, beyond tolerance
+    and the minimum difference of the stage (see STUB_MIN_REGRESSION).
+    """
+    regressions = []
+    for size, cases in results.items():
+        for case, measures in cases.items():
+            base = baseline.get(size, dict()).get(case)
+            if base is None:
+                continue
+            min_regression = STUB_MIN_REGRESSION if case in STUB_STAGES else MIN_REGRESSION
+            for measure, min_difference in min_regression.items():
+                value, base_value = measures[measure], base[measure]
+                if value > base_value * (1 + tolerance) and value - base_value > min_difference:
+                    regressions.append(
+                        f"{case} at {size} listings: {measure} {value:.3g} (baseline {base_value:.3g})"
+                    )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the monitor on stub portals.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=BENCH_SIZES)
+    parser.add_argument("--page-workers", type=int, default=4)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as baseline.")
+    parser.add_argument("--micro", action="store_true", help="Run the function benchmarks instead.")
+    args = parser.parse_args(argv)
+
+    if args.micro:
+        for n_props in [1000, 20000]:
+            print(bench_diff(n_props))
+            print(bench_snapshot(n_props))
+            print(bench_parse(n_props))
+            print(bench_merge(n_props))
+            print(bench_memory(n_props))
+        print(bench_geo())
+        print(bench_property_json())
+        print(bench_sweep())
+        return 0
+
+    results = run_benchmarks(args.sizes, args.page_workers)
+    print(json.dumps(results, indent=2))
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        return 0
+    if not os.path.isfile(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to record one.")
+        return 0
+    with open(args.baseline, "r") as f:
+        regressions = find_regressions(results, json.load(f))
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
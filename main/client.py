@@ -1,33 +1,36 @@
 import os
+import property_geo as pgeo
+import property_metrics as pmet
 import property_query as ppq
 import property_monitor as ppm
 
-
-def transform_angle(ms_angle):
-    """Transform minute and second formatted angle to decimal degree."""
-    de_angle = 0
-    multiplier = 1 if ms_angle[0] > 0 else -1
-    for i, value in enumerate(ms_angle):
-        if i == 0:
-            de_angle += value
-        else:
-            de_angle += multiplier * value / 60 ** i
-    return de_angle
+transform_angle = pgeo.transform_angle
 
 
-def monitor_properties(folder, requisition, init_ignore=None):
-    realestate_property = ppq.get_realestate_properties(requisition)
-    domain_property = ppq.get_domain_properties(requisition)
+def monitor_properties(
+    folder, requisition, init_ignore=None, max_workers=1, get_details=False, notifier=None
+):
+    with pmet.stage("realestate"):
+        realestate_property = ppq.get_realestate_properties(requisition, max_workers)
+    # Domain details are only fetched for listings that are new or changed since the last run.
+    previous = None
+    if get_details and os.path.isdir(folder):
+        previous = ppm.read_property_data(folder, ["Url", "Price", "Source", "Available", "Images"])
+    with pmet.stage("domain"):
+        domain_property = ppq.get_domain_properties(
+            requisition, get_details, max_workers, previous
+        )
     property_data = ppq.merge_realestate_domain_properties(
         realestate_property, domain_property
     )
 
-    if os.path.isdir(folder):
-        print("Updating property monitor.")
-        new_prop = ppm.update_property_data(folder, property_data)
-    else:
-        print("Initiating property monitor.")
-        new_prop = ppm.initiate_property_data(folder, property_data, init_ignore)
+    with pmet.stage("update"):
+        if os.path.isdir(folder):
+            print("Updating property monitor.")
+            new_prop = ppm.update_property_data(folder, property_data, notifier=notifier)
+        else:
+            print("Initiating property monitor.")
+            new_prop = ppm.initiate_property_data(folder, property_data, init_ignore)
     if new_prop is not None:
         new_prop = ppm.filter_prop(new_prop, folder)
     return new_prop
@@ -40,35 +43,42 @@ def make_clickable_url(props):
     )
 
 
+def edit_preferences(
+    folder, preferred=(), unpreferred=(), ignored=(), unignored=(), write_behind=False
+):
+    """
+    Apply several preference and ignored street edits at once. They are written right away,
+    or with write_behind in the background (see property_monitor.NameIndex).
+    Names "suburb:<suburb>", "street:<street>" and "prefix:<start>" match listings by rule.
+    """
+    edits = {
+        ppm.PREFERENCE_FILE: (preferred, unpreferred),
+        ppm.IGNORE_FILE: (ignored, unignored),
+    }
+    for file, (added, removed) in edits.items():
+        if len(added) == 0 and len(removed) == 0:
+            continue
+        index = ppm.get_name_index(folder, file)
+        index.edit(added, removed)
+        if not write_behind:
+            index.flush()
+
+
 def set_preferred_properties(folder, names, set_to_preferred=True):
     if type(names) == str:
         names = [names]
-    names = set(names)
-    with open(f"{folder}preference.txt", "r") as f:
-        pref = set(f.read().split(","))
-
     if set_to_preferred:
-        pref |= names
+        edit_preferences(folder, preferred=names)
     else:
-        pref -= names
-
-    with open(f"{folder}preference.txt", "w") as f:
-        f.write(",".join(pref))
+        edit_preferences(folder, unpreferred=names)
     return
 
 
 def set_ignored_streets(folder, streets, set_to_ignored=True):
     if type(streets) == str:
         streets = [streets]
-    streets = set(streets)
-    with open(f"{folder}ignore_street.txt", "r") as f:
-        ignored = set(f.read().split(","))
-
     if set_to_ignored:
-        ignored |= streets
+        edit_preferences(folder, ignored=streets)
     else:
-        ignored -= streets
-
-    with open(f"{folder}ignore_street.txt", "w") as f:
-        f.write(",".join(ignored))
+        edit_preferences(folder, unignored=streets)
     return
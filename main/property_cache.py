@@ -0,0 +1,132 @@
+import sqlite3
+import threading
+import time
+
+# Seconds a cached response stays fresh, per endpoint.
+ENDPOINT_TTLS = {
+    "search": 15 * 60,  # Search results change through the day.
+    "detail": 7 * 24 * 3600,  # Listing details rarely change once listed.
+}
+
+
+class OfflineCacheMiss(LookupError):
+    pass
+
+
+def endpoint_of(url):
+    if "/services/listings/search" in url or "/rent/?" in url:
+        return "search"
+    return "detail"
+
+
+class ResponseCache:
+    """
+    Persistent response cache in a SQLite file, keyed by url.
+    The least recently used responses are evicted once the bodies exceed max_bytes.
+    In offline mode every cached response is served regardless of age and a miss raises
+    OfflineCacheMiss instead of reaching the network.
+    """
+
+    def __init__(self, path, ttls=None, max_bytes=512 * 2**20, offline=False):
+        self.path = path
+        self.ttls = dict(ENDPOINT_TTLS if ttls is None else ttls)
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(url TEXT PRIMARY KEY, body TEXT, size INTEGER, created REAL, accessed REAL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+            )
+        self.total_bytes = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def get_settings(self):
+        """Arguments opening the same cache again, e.g. in another process."""
+        return {
+            "path": self.path,
+            "ttls": self.ttls,
+            "max_bytes": self.max_bytes,
+            "offline": self.offline,
+        }
+
+    def get(self, url):
+        """Return the cached body of url, or None if it is missing or stale."""
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT body, created FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+            fresh = row is not None and (
+                self.offline or now - row[1] <= self.ttls.get(endpoint_of(url), 0)
+            )
+            if not fresh:
+                self.misses += 1
+                if self.offline:
+                    raise OfflineCacheMiss(url)
+                return None
+            self.hits += 1
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE responses SET accessed = ? WHERE url = ?", (now, url)
+                )
+            return row[0]
+
+    def put(self, url, body):
+        now = time.time()
+        size = len(body.encode())
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT size FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+            if row is not None:
+                self.total_bytes -= row[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (url, body, size, now, now),
+            )
+            self.total_bytes += size
+            self.evict()
+
+    def evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        rows = self.conn.execute(
+            "SELECT url, size FROM responses ORDER BY accessed"
+        ).fetchall()
+        evicted = []
+        for url, size in rows:
+            if self.total_bytes <= self.max_bytes:
+                break
+            evicted.append((url,))
+            self.total_bytes -= size
+        self.conn.executemany("DELETE FROM responses WHERE url = ?", evicted)
+        self.evictions += len(evicted)
+
+    def stats(self):
+        with self.lock:
+            n_entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": n_entries,
+                "bytes": self.total_bytes,
+            }
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses")
+            self.total_bytes = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,6 +1,31 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+import warnings
 import numpy as np
 import pandas as pd
+import property_http as pph
+import property_metrics as pmet
+import property_monitor as ppm
 import property_query as ppq
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+try:
+    import pyarrow as pa
+except ImportError:  # Without pyarrow, process sweeps send plain frames.
+    pa = None
+
+# Status of the queries of a checkpointed sweep, next to their properties.
+SWEEP_STATUS = "status.json"
+# Realestate serves at most 10 pages of 200 listings.
+REALESTATE_MAX_RESULTS = 2000
+PORTAL_QUERIES = [
+    ("Realestate", "get_realestate_properties"),
+    ("Domain", "get_domain_properties"),
+]
 
 
 def make_equal_chunk_requistions(requisition, n_row, n_col):
@@ -36,13 +61,294 @@ def make_equal_chunk_requistions(requisition, n_row, n_col):
     return req_list
 
 
-def query_multi_chunk_properties(requisition_list):
-    rp = []
-    dp = []
-    for req in requisition_list:
-        rp.append(ppq.get_realestate_properties(req))
-        dp.append(ppq.get_domain_properties(req))
-    rp = pd.concat(rp, ignore_index=True)
-    dp = pd.concat(dp, ignore_index=True)
+def probe_chunk_saturation(requisition):
+    """Return True if either portal cannot return every listing of the requisition."""
+    content, _ = ppq.request_realestate_properties(requisition)
+    if int(content["totalResultsCount"]) > REALESTATE_MAX_RESULTS:
+        return True
+    content, _ = ppq.request_domain_properties(requisition)
+    page_info = content["props"]["pageViewMetadata"]["searchResponse"]["SearchResults"]
+    return bool(page_info["actualTotalResultsExceedsMaximum"])
+
+
+def make_adaptive_chunk_requisitions(requisition, max_depth=5, partition_file=None, probe=None):
+    """
+    Split the bounding box into quadrants recursively, only where a box is saturated.
+    The learned partition is saved to partition_file and reused for the same requisition
+    (bounding box and filters, which both change the saturation). A reused partition only
+    probes its chunks, splitting again the ones saturated since. Probes only request the first
+    result page, which a response cache set with property_http.set_cache serves again to the
+    chunk query.
+    """
+    box_keys = ["north", "west", "south", "east"]
+    box = [requisition[key] for key in box_keys]
+    filters = {key: value for key, value in requisition.items() if key not in box_keys}
+    if probe is None:
+        probe = probe_chunk_saturation
+
+    pending = [(requisition, 0)]
+    if partition_file is not None and os.path.isfile(partition_file):
+        with open(partition_file, "r") as f:
+            partition = json.load(f)
+        if partition["box"] == box and partition.get("filters") == filters:
+            pending = [
+                ({**requisition, **chunk["box"]}, chunk["depth"])
+                for chunk in reversed(partition["chunks"])
+            ]
+
+    req_list = []
+    depths = []
+    while len(pending) > 0:
+        req, depth = pending.pop()
+        if not probe(req):
+            req_list.append(req)
+            depths.append(depth)
+        elif depth < max_depth:
+            quadrants = make_equal_chunk_requistions(req, 2, 2)
+            pending.extend((quadrant, depth + 1) for quadrant in reversed(quadrants))
+        else:
+            warnings.warn(f"Chunk still saturated at maximum depth: {req}")
+            req_list.append(req)
+            depths.append(depth)
+
+    if partition_file is not None:
+        chunks = [
+            {"box": {key: req[key] for key in box_keys}, "depth": depth}
+            for req, depth in zip(req_list, depths)
+        ]
+        with open(partition_file, "w") as f:
+            json.dump({"box": box, "filters": filters, "chunks": chunks}, f)
+    return req_list
+
+
+def timed_portal_query(query_func, requisition, page_workers=1):
+    """Run one portal query, returning (properties, seconds, error) instead of raising."""
+    start = time.perf_counter()
+    try:
+        properties = query_func(requisition, max_workers=page_workers)
+        error = None
+    except Exception as e:
+        properties = None
+        error = repr(e)
+    return properties, time.perf_counter() - start, error
+
+
+def to_columnar(properties):
+    """
+    Compact form of a portal frame to send between processes: an Arrow IPC stream when pyarrow
+    is installed, else the frame itself, with the image lists as JSON text either way.
+    """
+    if properties is None:
+        return None
+    properties = properties.copy(deep=False)
+    if "Images" in properties.columns:
+        properties["Images"] = [json.dumps(images) for images in properties["Images"]]
+    if pa is not None:
+        try:
+            table = pa.Table.from_pandas(properties, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):  # Mixed-type column.
+            return properties
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    return properties
+
+
+def from_columnar(payload):
+    """Portal frame back from to_columnar."""
+    if payload is None:
+        return None
+    if isinstance(payload, bytes):
+        payload = pa.ipc.open_stream(payload).read_all().to_pandas()
+    if "Images" in payload.columns:
+        payload["Images"] = [json.loads(images) for images in payload["Images"]]
+    return payload
+
+
+def get_columnar_length(payload):
+    if payload is None:
+        return 0
+    if isinstance(payload, bytes):
+        return pa.ipc.open_stream(payload).read_all().num_rows
+    return len(payload)
+
+
+def columnar_portal_query(func_name, requisition, page_workers=1):
+    """timed_portal_query run in a worker process, returning the properties in columnar form."""
+    properties, seconds, error = timed_portal_query(
+        getattr(ppq, func_name), requisition, page_workers
+    )
+    return to_columnar(properties), seconds, error
+
+
+def concat_portal_frames(frames, other_frames):
+    if len(frames) > 0:
+        return pd.concat(frames, ignore_index=True)
+    if len(other_frames) > 0:
+        return pd.DataFrame(columns=other_frames[0].columns)
+    raise RuntimeError("No chunk query succeeded.")
+
+
+def get_sweep_checkpoint(checkpoint_dir, requisition_list):
+    """Folder of the checkpoints of a sweep, named by a hash of its requisitions."""
+    key = hashlib.sha1(json.dumps(requisition_list, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(checkpoint_dir, f"sweep_{key}", "")
+
+
+def read_sweep_status(checkpoint):
+    """Time, listing count and error of each finished query, keyed by "<chunk>_<source>"."""
+    if not os.path.isfile(f"{checkpoint}{SWEEP_STATUS}"):
+        return dict()
+    with open(f"{checkpoint}{SWEEP_STATUS}", "r") as f:
+        return json.load(f)["queries"]
+
+
+def write_chunk_payload(path, payload):
+    with open(path, "wb") as f:
+        pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_chunk_checkpoint(checkpoint, key):
+    with open(f"{checkpoint}{key}.pkl", "rb") as f:
+        return from_columnar(pickle.load(f))
+
+
+def write_chunk_checkpoint(checkpoint, requisition_list, status, key, payload, seconds, error):
+    """Persist a finished query: its columnar properties first, then its status."""
+    if error is None:
+        ppm.replace_file(f"{checkpoint}{key}.pkl", write_chunk_payload, payload)
+    status[key] = {
+        "time": seconds,
+        "count": get_columnar_length(payload),
+        "error": error,
+    }
+    ppm.replace_file(
+        f"{checkpoint}{SWEEP_STATUS}",
+        ppm.write_json,
+        {"requisitions": requisition_list, "queries": status},
+    )
+
+
+def run_portal_queries(tasks, max_workers=1, page_workers=1, processes=False):
+    """
+    Yield (task index, (properties, seconds, error)) of the (requisition, source, query) tasks
+    as they finish. Worker processes return the properties in columnar form, and share the
+    request limits of this process (see property_http.get_worker_settings).
+    """
+    if processes:
+        func_names = dict(PORTAL_QUERIES)
+        n_workers = max(1, max_workers)
+        executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=pph.init_worker,
+            initargs=(pph.get_worker_settings(n_workers),),
+        )
+        submit = lambda req, source, func: executor.submit(
+            columnar_portal_query, func_names[source], req, page_workers
+        )
+    elif max_workers > 1:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        submit = lambda req, source, func: executor.submit(
+            timed_portal_query, func, req, page_workers
+        )
+    else:
+        for k, (req, _, func) in tasks:
+            yield k, timed_portal_query(func, req, page_workers)
+        return
+
+    with executor:
+        futures = {submit(*task): k for k, task in tasks}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+@pmet.timed("sweep")
+def query_multi_chunk_properties(
+    requisition_list,
+    max_workers=1,
+    page_workers=1,
+    max_inflight=None,
+    chunk_report=None,
+    processes=False,
+    checkpoint_dir=None,
+):
+    """
+    Query every chunk on both portals and merge the results.
+    With max_workers > 1, chunks and the two portals within a chunk are queried concurrently.
+    max_inflight caps the HTTP requests in flight over the whole sweep. A failed portal query
+    is warned about and skipped; per-chunk timings and errors are appended to chunk_report.
+    With processes, the chunks are fetched and parsed in max_workers worker processes, which
+    send back columnar results (see to_columnar) merged once here. The per-host interval,
+    request budget and max_inflight are split between the workers, each opening the response
+    cache again. Request metrics are not collected from the workers.
+    With checkpoint_dir, each finished query is saved there with its status as soon as it
+    completes. Running the same sweep again only queries the chunks missing or failed so far,
+    and merges from the checkpoints, giving the same result as an uninterrupted sweep. The
+    checkpoints are deleted once every query of the sweep succeeded.
+    """
+    tasks = [
+        (req, source, getattr(ppq, func_name))
+        for req in requisition_list
+        for source, func_name in PORTAL_QUERIES
+    ]
+    keys = [f"{i}_{source}" for i in range(len(requisition_list)) for source, _ in PORTAL_QUERIES]
+    status = dict()
+    if checkpoint_dir is not None:
+        checkpoint = get_sweep_checkpoint(checkpoint_dir, requisition_list)
+        os.makedirs(checkpoint, exist_ok=True)
+        status = read_sweep_status(checkpoint)
+    outputs = [None] * len(tasks)
+    for k, key in enumerate(keys):
+        if key in status and status[key]["error"] is None:
+            outputs[k] = (None, status[key]["time"], None)
+    pending = [(k, task) for k, task in enumerate(tasks) if outputs[k] is None]
+
+    previous_limit = pph.set_max_inflight(max_inflight) if max_inflight else None
+    try:
+        for k, (properties, seconds, error) in run_portal_queries(
+            pending, max_workers, page_workers, processes
+        ):
+            if checkpoint_dir is not None:
+                payload = properties if processes else to_columnar(properties)
+                write_chunk_checkpoint(
+                    checkpoint, requisition_list, status, keys[k], payload, seconds, error
+                )
+                # Read back from the checkpoint, as a resumed sweep does.
+                properties = None
+            elif processes:
+                properties = from_columnar(properties)
+            outputs[k] = (properties, seconds, error)
+    finally:
+        if max_inflight:
+            pph.set_max_inflight(previous_limit)
+
+    # Collect results in chunk order so the merged frame matches a serial sweep.
+    frames = {source: [] for source, _ in PORTAL_QUERIES}
+    for i, req in enumerate(requisition_list):
+        record = {"chunk": i, "requisition": req}
+        for j, (source, _) in enumerate(PORTAL_QUERIES):
+            k = i * len(PORTAL_QUERIES) + j
+            properties, seconds, error = outputs[k]
+            if checkpoint_dir is not None and error is None:
+                properties = read_chunk_checkpoint(checkpoint, keys[k])
+            record[source] = {
+                "time": seconds,
+                "count": 0 if properties is None else len(properties),
+                "error": error,
+            }
+            pmet.record_chunk(i, source, record[source]["count"], seconds, error)
+            if error is not None:
+                warnings.warn(f"Chunk {i} {source} query failed: {error}")
+            else:
+                frames[source].append(properties)
+        if chunk_report is not None:
+            chunk_report.append(record)
+
+    rp = concat_portal_frames(frames["Realestate"], frames["Domain"])
+    dp = concat_portal_frames(frames["Domain"], frames["Realestate"])
     property_data = ppq.merge_realestate_domain_properties(rp, dp)
-    return property_data
\ No newline at end of file
+    # A complete sweep needs no resuming, and the next run of it must query the portals again.
+    if checkpoint_dir is not None and all(output[2] is None for output in outputs):
+        shutil.rmtree(checkpoint)
+    return property_data
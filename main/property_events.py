@@ -0,0 +1,137 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+EVENT_LOG = "events.jsonl"
+
+
+def to_json_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def make_events(diff_result, current, current_time):
+    """
+    Turn a diff_property_info result into listing events.
+    listed events hold the full listing, changed events the full listing and the previous
+    values of the changed fields, and delisted events only the PID.
+    """
+    events = []
+    if diff_result is None:
+        return events
+    new_props = current.loc[sorted(diff_result["new"])]
+    columns = list(new_props.columns)
+    for pid, *values in new_props.itertuples(name=None):
+        fields = {col: to_json_value(value) for col, value in zip(columns, values)}
+        events.append({"time": current_time, "event": "listed", "pid": pid, "fields": fields})
+    for pid in sorted(diff_result["passed"]):
+        events.append({"time": current_time, "event": "delisted", "pid": pid})
+    changed = diff_result["changed"] or dict()
+    changed_props = current.loc[list(changed)]
+    columns = list(changed_props.columns)
+    for pid, *values in changed_props.itertuples(name=None):
+        change = changed[pid]
+        events.append(
+            {
+                "time": current_time,
+                "event": "changed",
+                "pid": pid,
+                "fields": {col: to_json_value(value) for col, value in zip(columns, values)},
+                "previous": {col: to_json_value(old) for col, (old, _) in change.items()},
+            }
+        )
+    return events
+
+
+def truncate_partial_event(path):
+    """Cut a last line left unfinished by a crash during an append. Return the log size."""
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - 4096)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < f.seek(0, os.SEEK_END):
+            f.truncate(end)
+        return end
+
+
+def append_events(folder, events):
+    """Append events to the folder's event log, synced to disk. Return the log size in bytes."""
+    path = f"{folder}{EVENT_LOG}"
+    if os.path.isfile(path):
+        truncate_partial_event(path)
+    with open(path, "a") as f:
+        f.writelines(json.dumps(event) + "\n" for event in events)
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def get_event_log_size(folder):
+    path = f"{folder}{EVENT_LOG}"
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def read_events(folder, offset=0, until=None):
+    """Read the events logged after byte offset, up to and including time until."""
+    path = f"{folder}{EVENT_LOG}"
+    if not os.path.isfile(path):
+        return []
+    events = []
+    with open(path, "r") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith("\n"):  # Cut by a crash, it is dropped by the next append.
+                break
+            event = json.loads(line)
+            if until is not None and event["time"] > until:
+                break
+            events.append(event)
+    return events
+
+
+def apply_events(property_data, events):
+    """Replay events over property_data, keeping its columns."""
+    dropped = set()
+    listed = dict()
+    updates = dict()
+    for event in events:
+        pid = event["pid"]
+        if event["event"] == "listed":
+            dropped.add(pid)
+            listed[pid] = dict(event["fields"])
+            updates.pop(pid, None)
+        elif event["event"] == "delisted":
+            dropped.add(pid)
+            listed.pop(pid, None)
+            updates.pop(pid, None)
+        elif pid in listed:
+            listed[pid].update(event["fields"])
+        else:
+            updates.setdefault(pid, dict()).update(event["fields"])
+
+    property_data = property_data[~property_data.index.isin(dropped)].copy()
+    columns = property_data.columns
+    for col in columns:
+        pids = [pid for pid, fields in updates.items() if col in fields]
+        if len(pids) > 0:
+            values = [updates[pid][col] for pid in pids]
+            if property_data[col].dtype == object:
+                # A Series keeps list values (Images) from being spread over the rows.
+                values = pd.Series(values, index=pids, dtype=object)
+            property_data.loc[pids, col] = values
+    if len(listed) > 0:
+        listed_data = pd.DataFrame.from_dict(listed, orient="index").reindex(columns=columns)
+        listed_data = listed_data.astype(property_data.dtypes.to_dict(), errors="ignore")
+        property_data = pd.concat([property_data, listed_data])
+    property_data.index.name = ""
+    return property_data
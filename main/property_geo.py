@@ -0,0 +1,217 @@
+import threading
+import numpy as np
+
+EARTH_RADIUS = 6371008.8
+METRES_PER_DEGREE = 111320
+# Side in metres of the grid cells of a GeoIndex.
+CELL_SIZE = 500.0
+
+
+def transform_angle(ms_angle):
+    """Transform minute and second formatted angle to decimal degree."""
+    de_angle = 0
+    multiplier = 1 if ms_angle[0] > 0 else -1
+    for i, value in enumerate(ms_angle):
+        if i == 0:
+            de_angle += value
+        else:
+            de_angle += multiplier * value / 60 ** i
+    return de_angle
+
+
+def to_degrees(angle):
+    """Decimal degrees of an angle given in decimal degrees or as (degree, minute, second)."""
+    if isinstance(angle, (list, tuple)):
+        return transform_angle(angle)
+    return float(angle)
+
+
+def get_distance(lat, lon, lats, lons):
+    """Haversine distance in metres from (lat, lon) to the points of lats and lons."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = (
+        np.sin((lats - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def is_in_polygon(polygon, lats, lons):
+    """Mask of the points inside polygon, a sequence of (lat, lon) vertices (even-odd rule)."""
+    inside = np.zeros(len(lats), dtype=bool)
+    n = len(polygon)
+    for k in range(n):
+        lat_a, lon_a = polygon[k]
+        lat_b, lon_b = polygon[k - 1]
+        crosses = (lons > lon_a) != (lons > lon_b)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lat_cross = lat_a + (lons - lon_a) * (lat_b - lat_a) / (lon_b - lon_a)
+        inside ^= crosses & (lats < lat_cross)
+    return inside
+
+
+class GeoIndex:
+    """
+    Grid of cell_size metre cells over listing locations, keyed by PID. Queries only look at the
+    cells near the searched area. Listings are added, moved and removed one by one, so the index
+    follows updates without being rebuilt. Locations may be given in degree-minute-second.
+    """
+
+    def __init__(self, property_data=None, cell_size=CELL_SIZE, ref_lat=None):
+        self.cell_size = cell_size
+        self.ref_lat = None
+        self.cell_lat = None
+        self.cell_lon = None
+        if ref_lat is not None:
+            self.set_cell_degrees(ref_lat)
+        self.cells = dict()
+        self.points = dict()
+        # Lowest and highest cell rows and columns ever used.
+        self.bounds = None
+        self.lock = threading.RLock()
+        if property_data is not None:
+            self.update(property_data)
+
+    def set_cell_degrees(self, ref_lat):
+        # Cell sides in degrees, fixed by a reference latitude (by default the first listing's).
+        self.ref_lat = ref_lat
+        self.cell_lat = self.cell_size / METRES_PER_DEGREE
+        self.cell_lon = self.cell_lat / np.cos(np.radians(self.ref_lat))
+
+    def get_cell(self, lat, lon):
+        return (int(np.floor(lat / self.cell_lat)), int(np.floor(lon / self.cell_lon)))
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, pid, lat, lon):
+        """Add or move a listing."""
+        lat, lon = to_degrees(lat), to_degrees(lon)
+        if np.isnan(lat) or np.isnan(lon):
+            self.remove(pid)
+            return
+        with self.lock:
+            if self.cell_lat is None:
+                self.set_cell_degrees(lat)
+            self.insert(pid, lat, lon, self.get_cell(lat, lon))
+
+    def insert(self, pid, lat, lon, cell):
+        point = self.points.get(pid)
+        if point is not None:
+            if point[0] == lat and point[1] == lon:
+                return
+            self.remove(pid)
+        self.cells.setdefault(cell, dict())[pid] = (lat, lon)
+        self.points[pid] = (lat, lon, cell)
+        if self.bounds is None:
+            self.bounds = [cell[0], cell[0], cell[1], cell[1]]
+        else:
+            bounds = self.bounds
+            bounds[0], bounds[1] = min(bounds[0], cell[0]), max(bounds[1], cell[0])
+            bounds[2], bounds[3] = min(bounds[2], cell[1]), max(bounds[3], cell[1])
+
+    def remove(self, pid):
+        with self.lock:
+            point = self.points.pop(pid, None)
+            if point is None:
+                return
+            cell_points = self.cells[point[2]]
+            del cell_points[pid]
+            if len(cell_points) == 0:
+                del self.cells[point[2]]
+
+    def update(self, property_data, remove_missing=False):
+        """
+        Add or move the listings of property_data (indexed by PID, with Latitude and Longitude).
+        With remove_missing, the listings absent from property_data are removed.
+        """
+        lats = property_data["Latitude"].to_numpy(dtype=float)
+        lons = property_data["Longitude"].to_numpy(dtype=float)
+        valid = ~(np.isnan(lats) | np.isnan(lons))
+        with self.lock:
+            if remove_missing:
+                for pid in set(self.points).difference(property_data.index[valid]):
+                    self.remove(pid)
+            if not valid.any():
+                return
+            if self.cell_lat is None:
+                self.set_cell_degrees(lats[valid][0])
+            rows = np.floor(np.where(valid, lats, 0) / self.cell_lat).astype(np.int64).tolist()
+            cols = np.floor(np.where(valid, lons, 0) / self.cell_lon).astype(np.int64).tolist()
+            for pid, lat, lon, row, col, is_valid in zip(
+                property_data.index, lats.tolist(), lons.tolist(), rows, cols, valid.tolist()
+            ):
+                if is_valid:
+                    self.insert(pid, lat, lon, (row, col))
+                else:
+                    self.remove(pid)
+
+    def get_candidates(self, cell_ranges):
+        """PIDs and locations of the listings in the cells of the given row and column ranges."""
+        pids = []
+        locations = []
+        with self.lock:
+            for i in cell_ranges[0]:
+                for j in cell_ranges[1]:
+                    cell_points = self.cells.get((i, j))
+                    if cell_points is not None:
+                        pids.extend(cell_points)
+                        locations.extend(cell_points.values())
+        locations = np.array(locations, dtype=float).reshape(-1, 2)
+        return np.array(pids, dtype=object), locations[:, 0], locations[:, 1]
+
+    def query_radius(self, lat, lon, radius):
+        """PIDs of the listings within radius metres of (lat, lon), nearest first."""
+        if len(self.points) == 0:
+            return []
+        lat, lon = to_degrees(lat), to_degrees(lon)
+        d_lat = radius / METRES_PER_DEGREE
+        d_lon = d_lat / max(np.cos(np.radians(abs(lat) + d_lat)), 1e-6)
+        low = self.get_cell(lat - d_lat, lon - d_lon)
+        high = self.get_cell(lat + d_lat, lon + d_lon)
+        pids, lats, lons = self.get_candidates(
+            (range(low[0], high[0] + 1), range(low[1], high[1] + 1))
+        )
+        distance = get_distance(lat, lon, lats, lons)
+        inside = np.flatnonzero(distance <= radius)
+        return list(pids[inside[np.argsort(distance[inside], kind="stable")]])
+
+    def query_polygon(self, polygon):
+        """PIDs of the listings inside polygon, a sequence of (lat, lon) vertices."""
+        if len(self.points) == 0:
+            return []
+        polygon = [(to_degrees(lat), to_degrees(lon)) for lat, lon in polygon]
+        lats, lons = zip(*polygon)
+        low = self.get_cell(min(lats), min(lons))
+        high = self.get_cell(max(lats), max(lons))
+        pids, lats, lons = self.get_candidates(
+            (range(low[0], high[0] + 1), range(low[1], high[1] + 1))
+        )
+        return list(pids[is_in_polygon(polygon, lats, lons)])
+
+    def query_nearest(self, lat, lon, k=1):
+        """PIDs of the k listings nearest to (lat, lon), nearest first."""
+        if len(self.points) == 0 or k <= 0:
+            return []
+        lat, lon = to_degrees(lat), to_degrees(lon)
+        center = self.get_cell(lat, lon)
+        bounds = self.bounds
+        max_ring = max(
+            center[0] - bounds[0], bounds[1] - center[0], center[1] - bounds[2], bounds[3] - center[1]
+        )
+        # Metres surely covered by each ring of cells around the center cell.
+        lon_ratio = np.cos(np.radians(lat)) / np.cos(np.radians(self.ref_lat))
+        ring_size = self.cell_size * min(1.0, lon_ratio)
+        ring = 0
+        while True:
+            cell_ranges = (
+                range(center[0] - ring, center[0] + ring + 1),
+                range(center[1] - ring, center[1] + ring + 1),
+            )
+            pids, lats, lons = self.get_candidates(cell_ranges)
+            distance = get_distance(lat, lon, lats, lons)
+            found = len(pids) >= k and np.partition(distance, k - 1)[k - 1] <= ring * ring_size
+            if found or ring >= max_ring:
+                return list(pids[np.argsort(distance, kind="stable")[:k]])
+            ring += 1
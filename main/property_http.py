@@ -0,0 +1,261 @@
+import json
+import random
+import threading
+import time
+import requests
+import property_cache as pcache
+import property_metrics as pmet
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+
+# (connect, read) timeout in seconds.
+TIMEOUT = (5, 30)
+# Minimum number of seconds between two requests sent to the same host.
+HOST_MIN_INTERVAL = 0.0
+
+_host_next_time = dict()
+_host_lock = threading.Lock()
+# Global cap on the number of requests in flight across all threads.
+_inflight = None
+_inflight_limit = None
+_session = None
+_session_lock = threading.Lock()
+# Optional property_cache.ResponseCache consulted before the network.
+_cache = None
+# Optional RequestBudget shared by every query.
+_budget = None
+# Moving average of the response time of the portals, in seconds.
+LATENCY_SMOOTHING = 0.2
+_latency = None
+_latency_lock = threading.Lock()
+
+
+class JitterRetry(Retry):
+    """
+    Retry adding up to jitter seconds of random delay to each backoff. urllib3 only has a
+    backoff_jitter option from 2.0 on, and requests still works with urllib3 1.26.
+    """
+
+    def __init__(self, *args, jitter=0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.jitter = jitter
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.jitter = self.jitter
+        return retry
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        if backoff <= 0:  # First retry, or no backoff.
+            return backoff
+        return backoff + random.uniform(0, self.jitter)
+
+
+def make_session(
+    pool_size=10,
+    retries=3,
+    backoff=0.5,
+    jitter=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+):
+    """
+    Create a session keeping up to pool_size alive connections per host.
+    Failed GETs are retried with exponential backoff (backoff * 2 ** n seconds plus up to
+    jitter seconds of random delay), honouring Retry-After.
+    """
+    retry = JitterRetry(
+        total=retries,
+        backoff_factor=backoff,
+        jitter=jitter,
+        status_forcelist=status_forcelist,
+        allowed_methods=["GET"],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+    return session
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+        return _session
+
+
+def set_session(session):
+    """Replace the shared session used by every query (None to recreate the default). Return the previous one."""
+    global _session
+    with _session_lock:
+        previous = _session
+        _session = session
+    return previous
+
+
+def set_cache(cache):
+    """Serve requests through a response cache (None to disable). Return the previous cache."""
+    global _cache
+    previous = _cache
+    _cache = cache
+    return previous
+
+
+def wait_for_host(url):
+    """Block until the per-host rate limit allows another request to the host of url."""
+    if HOST_MIN_INTERVAL <= 0:
+        return
+    host = urlsplit(url).netloc
+    with _host_lock:
+        now = time.monotonic()
+        start = max(now, _host_next_time.get(host, now))
+        _host_next_time[host] = start + HOST_MIN_INTERVAL
+    if start > now:
+        time.sleep(start - now)
+
+
+def set_max_inflight(limit):
+    """Cap the number of concurrent HTTP requests (None for no cap). Return the previous cap."""
+    global _inflight, _inflight_limit
+    previous = _inflight_limit
+    _inflight_limit = limit
+    _inflight = None if limit is None else threading.BoundedSemaphore(limit)
+    return previous
+
+
+class RequestBudget:
+    """
+    Token bucket allowing on average rate requests per second, in bursts of up to burst
+    requests. acquire blocks until a token is available.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = max(1, rate if burst is None else burst)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def set_request_budget(budget):
+    """Share a RequestBudget between all queries (None for no budget). Return the previous one."""
+    global _budget
+    previous = _budget
+    _budget = budget
+    return previous
+
+
+def get_worker_settings(n_workers):
+    """
+    Request settings of each of n_workers worker processes: the per-host interval, request
+    budget and in-flight cap of this process are split between the workers, so together they
+    stay within them, and the response cache is opened again by each worker.
+    """
+    budget = _budget
+    return {
+        "host_min_interval": HOST_MIN_INTERVAL * n_workers,
+        "budget": None if budget is None else (budget.rate / n_workers, budget.burst / n_workers),
+        "max_inflight": None if _inflight_limit is None else max(1, _inflight_limit // n_workers),
+        "cache": None if _cache is None else _cache.get_settings(),
+    }
+
+
+def init_worker(settings):
+    """
+    Set up a worker process with get_worker_settings, dropping the state inherited from the
+    parent: its session's connections, host times, locks and SQLite cache connection.
+    """
+    global HOST_MIN_INTERVAL, _session, _host_lock, _session_lock, _latency_lock
+    HOST_MIN_INTERVAL = settings["host_min_interval"]
+    _host_next_time.clear()
+    _host_lock = threading.Lock()
+    _session_lock = threading.Lock()
+    _latency_lock = threading.Lock()
+    _session = None
+    reset_latency()
+    set_max_inflight(settings["max_inflight"])
+    budget = settings["budget"]
+    set_request_budget(None if budget is None else RequestBudget(*budget))
+    cache = settings["cache"]
+    set_cache(None if cache is None else pcache.ResponseCache(**cache))
+
+
+def record_latency(seconds):
+    global _latency
+    with _latency_lock:
+        if _latency is None:
+            _latency = seconds
+        else:
+            _latency += LATENCY_SMOOTHING * (seconds - _latency)
+
+
+def get_latency():
+    """Moving average of the portal response time, None before the first request."""
+    return _latency
+
+
+def reset_latency():
+    global _latency
+    with _latency_lock:
+        _latency = None
+
+
+def request_url(session, url, headers, timeout):
+    start = time.monotonic()
+    response = session.get(url, headers=headers, timeout=timeout)
+    seconds = time.monotonic() - start
+    record_latency(seconds)
+    if pmet.ENABLED:
+        pmet.add_stage_time("http", seconds)
+        pmet.count("http_requests")
+        pmet.count("http_bytes", len(response.content))
+        retries = getattr(response.raw, "retries", None)
+        if retries is not None and len(retries.history) > 0:
+            pmet.count("http_retries", len(retries.history))
+    response.raise_for_status()
+    return response
+
+
+def get_json(url, headers=None, session=None, timeout=None):
+    cache = _cache
+    if cache is not None:
+        body = cache.get(url)
+        if body is not None:
+            pmet.count("cache_hits")
+            return json.loads(body)
+        pmet.count("cache_misses")
+    if session is None:
+        session = get_session()
+    if timeout is None:
+        timeout = TIMEOUT
+    budget = _budget
+    if budget is not None:
+        budget.acquire()
+    wait_for_host(url)
+    inflight = _inflight
+    if inflight is None:
+        response = request_url(session, url, headers, timeout)
+    else:
+        with inflight:
+            response = request_url(session, url, headers, timeout)
+    content = response.json()
+    if cache is not None:
+        cache.put(url, response.text)
+    return content
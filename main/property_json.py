@@ -1,62 +1,123 @@
+import sys
+import numpy as np
+import property_events as ppe
 import property_monitor as ppm
+import property_query as ppq
+
+
+def compact_value(value):
+    """Plain Python value, with strings interned so that entities share them."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
 
 
 def init_property_entity(prop_info):
-    prop_entity = dict(prop_info)
+    prop_entity = {key: compact_value(value) for key, value in dict(prop_info).items()}
     prop_entity.pop('Url')
     prop_entity.pop('PID')
     prop_entity.pop('Source')
+    prop_entity.pop('Weekly_price', None)
+    prop_entity.pop('Price_flag', None)
     prop_entity['Offlist_date'] = []
     prop_entity['Listing_date'] = []
     prop_entity['Parking_num'] = {}
     prop_entity['Available'] = {}
     prop_entity['Images'] = {}
     prop_entity['Price'] = {}
+    prop_entity['Weekly_price'] = {}
     return prop_entity
 
 
-def relist_property_entity(prop_info, prop_entity_input, current_time):
-    prop_entity = prop_entity_input.copy()
+def record_price(prop_entity, prop_info, current_time):
+    """Record the display price and the weekly price of prop_info at current_time."""
+    if 'Price' in prop_info:
+        prop_entity['Price'][current_time] = compact_value(prop_info['Price'])
+    if 'Weekly_price' in prop_info:
+        weekly_price = prop_info['Weekly_price']
+    else:  # Listing tracked before prices were parsed.
+        weekly_price = ppq.parse_weekly_price(prop_info['Price'])[0]
+    prop_entity.setdefault('Weekly_price', {})[current_time] = compact_value(weekly_price)
+
+
+def relist_property_entity(prop_info, prop_entity, current_time):
+    """Record a listing of prop_info at current_time in prop_entity, which is updated in place."""
+    current_time = sys.intern(current_time)
     prop_entity['Listing_date'].append(current_time)
-    prop_entity['Parking_num'][current_time] = prop_info['Parking_num']
-    prop_entity['Available'][current_time] = prop_info['Available']
-    prop_entity['Images'][current_time] = prop_info['Images']
-    prop_entity['Price'][current_time] = prop_info['Price']
+    prop_entity['Parking_num'][current_time] = compact_value(prop_info['Parking_num'])
+    prop_entity['Available'][current_time] = compact_value(prop_info['Available'])
+    prop_entity['Images'][current_time] = ppq.intern_images(prop_info['Images'])
+    record_price(prop_entity, prop_info, current_time)
     return prop_entity
 
 
+def relist_properties(props_db, properties, current_time):
+    """List the rows of properties at current_time, adding the PIDs not in props_db yet."""
+    current_time = sys.intern(current_time)
+    columns = list(properties.columns)
+    for pid, *values in properties.itertuples(name=None):
+        if pid[:5] == 'https':  # Listing without PID.
+            continue
+        prop_info = dict(zip(columns, values))
+        prop_entity = props_db.get(pid)
+        if prop_entity is None:
+            prop_entity = props_db[pid] = init_property_entity(prop_info)
+        relist_property_entity(prop_info, prop_entity, current_time)
+    return props_db
+
+
 def init_property_database(current_list, current_time):
-    init_props = current_list[current_list['PID'].notna()]
-    props_db = dict()
-    for pid, prop in init_props.iterrows():
-        props_db[pid] = relist_property_entity(prop, init_property_entity(prop), current_time)
+    return relist_properties(dict(), ppm.ensure_weekly_price(current_list), current_time)
+
+
+def apply_property_events(props_db, events):
+    """Apply listing events (see property_events.make_events) to the property database."""
+    for event in events:
+        pid = event['pid']
+        if pid[:5] == 'https':  # Listing without PID.
+            continue
+        if event['event'] == 'listed':
+            if pid not in props_db:
+                props_db[pid] = init_property_entity(event['fields'])
+            relist_property_entity(event['fields'], props_db[pid], event['time'])
+        elif pid not in props_db:
+            continue
+        elif event['event'] == 'delisted':
+            props_db[pid]['Offlist_date'].append(sys.intern(event['time']))
+        elif 'Price' in event['previous'] or 'Weekly_price' in event['previous']:
+            record_price(props_db[pid], event['fields'], sys.intern(event['time']))
     return props_db
 
 
 def updates_property_json(current_list, previous_list, props_db, current_time):
+    """
+    Apply the changes from previous_list to current_list to the property database in place,
+    the same way as their listing events would be applied (see apply_property_events).
+    """
     update_dict = ppm.diff_property_info(previous_list, current_list)
+    if update_dict is None:
+        return props_db
+    current_list = ppm.ensure_weekly_price(current_list)
+    current_time = sys.intern(current_time)
+    relist_properties(props_db, current_list.loc[sorted(update_dict['new'])], current_time)
+    for pid in update_dict['passed']:
+        if pid in props_db:
+            props_db[pid]['Offlist_date'].append(current_time)
+
+    repriced = [
+        pid
+        for pid, change in (update_dict['changed'] or dict()).items()
+        if 'Weekly_price' in change and pid in props_db
+    ]
+    columns = [col for col in ['Price', 'Weekly_price'] if col in current_list.columns]
+    prices = current_list.loc[repriced, columns]
+    for pid, *values in prices.itertuples(name=None):
+        record_price(props_db[pid], dict(zip(columns, values)), current_time)
+    return props_db
 
-    new_list_props = current_list.loc[list(update_dict['new'])]
-    new_list_props = new_list_props[new_list_props['PID'].notna()]
-    # Initiate new properties.
-    create_props_pid = new_list_props[~new_list_props.index.isin(props_db.keys())].index
-    create_props = new_list_props.loc[create_props_pid]
-    for pid, prop in create_props.iterrows():
-        props_db[pid] = init_property_entity(prop)
-    # Add new listing (new properties or old properties listed again).
-    for pid, prop in new_list_props.iterrows():
-        props_db[pid] = relist_property_entity(prop, props_db[pid], current_time)
-
-    # Add off listed.
-    off_list_props = previous_list.loc[list(update_dict['passed'])]
-    off_list_props = off_list_props[off_list_props['PID'].notna()]
-    for pid, prop in off_list_props.iterrows():
-        props_db[pid]['Offlist_date'].append(current_time)
-
-    # Add price change.
-    for pid, change in update_dict['changed'].items():
-        if (pid[:5] == 'https') or (change.get('Price', None) is None):
-            continue
-        props_db[pid]['Price'][current_time] = prop['Price']
 
-    return props_db
\ No newline at end of file
+def load_property_json(folder):
+    """Rebuild the property database from the event log of a monitor folder."""
+    return apply_property_events(dict(), ppe.read_events(folder))
@@ -0,0 +1,154 @@
+import functools
+import json
+import threading
+import time
+
+# Metrics are only collected while enabled, otherwise every hook returns straight away.
+ENABLED = False
+PROMETHEUS_PREFIX = "estate_monitor"
+
+_lock = threading.Lock()
+_stages = dict()
+_counters = dict()
+_chunks = []
+
+
+def enable(enabled=True):
+    """Turn metric collection on or off. Return the previous setting."""
+    global ENABLED
+    previous = ENABLED
+    ENABLED = enabled
+    return previous
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _chunks.clear()
+
+
+def add_stage_time(name, seconds):
+    with _lock:
+        stage_time = _stages.setdefault(name, [0, 0.0])
+        stage_time[0] += 1
+        stage_time[1] += seconds
+
+
+class StageTimer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_stage_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+def stage(name):
+    """Context manager adding its wall time to the stage name."""
+    return StageTimer(name) if ENABLED else NULL_TIMER
+
+
+def timed(name):
+    """Decorator adding the wall time of each call to the stage name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with StageTimer(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, value=1):
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def record_chunk(chunk, source, listings, seconds, error=None):
+    if not ENABLED:
+        return
+    with _lock:
+        _chunks.append(
+            {
+                "chunk": chunk,
+                "source": source,
+                "listings": listings,
+                "time": seconds,
+                "error": error,
+            }
+        )
+
+
+def get_report():
+    """
+    Metrics collected since the last reset: calls and seconds per stage (the seconds of
+    concurrent calls add up), counters and listings per chunk.
+    """
+    with _lock:
+        return {
+            "stages": {
+                name: {"calls": calls, "seconds": seconds}
+                for name, (calls, seconds) in sorted(_stages.items())
+            },
+            "counters": dict(sorted(_counters.items())),
+            "chunks": [dict(chunk) for chunk in _chunks],
+        }
+
+
+def write_report(path, report=None):
+    with open(path, "w") as f:
+        json.dump(get_report() if report is None else report, f, indent=2)
+
+
+def to_prometheus(report=None):
+    """Render a report in the Prometheus text exposition format."""
+    if report is None:
+        report = get_report()
+    prefix = PROMETHEUS_PREFIX
+    lines = [
+        f"# TYPE {prefix}_stage_seconds_total counter",
+        *(
+            f'{prefix}_stage_seconds_total{{stage="{name}"}} {values["seconds"]:.6f}'
+            for name, values in report["stages"].items()
+        ),
+        f"# TYPE {prefix}_stage_calls_total counter",
+        *(
+            f'{prefix}_stage_calls_total{{stage="{name}"}} {values["calls"]}'
+            for name, values in report["stages"].items()
+        ),
+    ]
+    for name, value in report["counters"].items():
+        lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+    lines.append(f"# TYPE {prefix}_chunk_listings gauge")
+    for chunk in report["chunks"]:
+        lines.append(
+            f'{prefix}_chunk_listings{{chunk="{chunk["chunk"]}",source="{chunk["source"]}"}} '
+            f'{chunk["listings"]}'
+        )
+    return "\n".join(lines) + "\n"
@@ -1,63 +1,562 @@
+import ast
+import atexit
+import contextlib
+import importlib.util
+import json
+import re
+import shutil
+import threading
 import time
 import os
 import pandas as pd
+import property_events as ppe
+import property_geo as pgeo
+import property_metrics as pmet
+import property_notify as pnot
+import property_query as ppq
 
+try:
+    import fcntl
+except ImportError:  # Without fcntl, folder locks only hold between threads of one process.
+    fcntl = None
 
-def initiate_property_data(folder, property_ori, init_ignore):
+# Prices are compared by their parsed weekly amount, so rewording a price is not a change.
+CHECK_COL = ["Weekly_price", "Bedroom_num", "Bathroom_num", "Parking_num", "Source"]
+PRICE_COLUMNS = ["Weekly_price", "Price_flag"]
+# Column types of the tracked properties snapshot. Images are stored as JSON text.
+PROPERTY_SCHEMA = {
+    "Url": "str",
+    "Price": "str",
+    "Weekly_price": "float64",
+    "Price_flag": "str",
+    "Name": "str",
+    "Room": "str",
+    "Street": "str",
+    "Suburb": "str",
+    "State": "str",
+    "Type": "str",
+    "Available": "str",
+    "PID": "str",
+    "Source": "str",
+    "Latitude": "float64",
+    "Longitude": "float64",
+    "Bedroom_num": "float64",
+    "Bathroom_num": "float64",
+    "Parking_num": "float64",
+    "Images": "json",
+}
+SNAPSHOT_META = "snapshot.json"
+# Compact the event log into a new snapshot once the events logged since the last snapshot
+# reach COMPACT_RATIO of the tracked listings (and at least COMPACT_MIN_EVENTS).
+COMPACT_RATIO = 0.5
+COMPACT_MIN_EVENTS = 100
+PREFERENCE_FILE = "preference.txt"
+IGNORE_FILE = "ignore_street.txt"
+FOLDER_LOCK = ".lock"
+# Name list entries "<rule>:<value>" matching listings by a pattern instead of by name.
+NAME_RULES = {
+    "prefix": lambda keys, props, values: keys.str.startswith(tuple(values)),
+    "suburb": lambda keys, props, values: props["Suburb"].isin(values),
+    "street": lambda keys, props, values: props["Street"].isin(values),
+}
+# Seconds an edit of a cached name list may wait before being written.
+WRITE_BEHIND_DELAY = 1.0
+
+_folder_locks = dict()
+_folder_locks_lock = threading.Lock()
+# Lock files of the folders locked by this process.
+_lock_files = dict()
+
+
+def get_present_time():
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+
+@contextlib.contextmanager
+def folder_lock(folder):
+    """
+    Hold the lock of a monitor folder, exclusive between threads and, through an advisory lock
+    on its .lock file, between processes. A thread may take the lock again while holding it.
+    """
+    key = os.path.abspath(folder)
+    with _folder_locks_lock:
+        lock = _folder_locks.setdefault(key, threading.RLock())
+    with lock:
+        if key in _lock_files:
+            yield
+            return
+        lock_file = open(f"{folder}{FOLDER_LOCK}", "a")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            _lock_files[key] = lock_file
+            yield
+        finally:
+            _lock_files.pop(key, None)
+            lock_file.close()
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def replace_file(path, write, *args):
+    """
+    Write path through a temporary file which is flushed to disk and renamed over it, so a
+    crash never leaves the file half written.
+    """
+    tmp_path = f"{path}.tmp"
+    write(tmp_path, *args)
+    fsync_path(tmp_path)
+    os.replace(tmp_path, path)
+    if os.name == "posix":  # Persist the rename.
+        fsync_path(os.path.dirname(os.path.abspath(path)))
+
+
+def write_text(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def read_name_list(folder, file):
+    with open(f"{folder}{file}", "r") as f:
+        return set(f.read().split(","))
+
+
+def write_name_list(folder, file, names):
+    replace_file(f"{folder}{file}", write_text, ",".join(sorted(names)))
+
+
+def edit_name_lists(folder, edits):
+    """Apply edits {file: (added, removed)} to the name lists of a folder under its lock."""
+    with folder_lock(folder):
+        for file, (added, removed) in edits.items():
+            if len(added) == 0 and len(removed) == 0:
+                continue
+            names = read_name_list(folder, file)
+            write_name_list(folder, file, (names | set(added)) - set(removed))
+
+
+class NameIndex:
+    """
+    Cached name list of a monitor folder (preference or ignored streets). It is read again only
+    when the file is modified, and edits are written behind, merged with concurrent edits of the
+    file, after WRITE_BEHIND_DELAY seconds or on flush.
+    """
+
+    def __init__(self, folder, file):
+        self.folder = folder
+        self.file = file
+        self.names = set()
+        self.rules = dict()
+        self.added = set()
+        self.removed = set()
+        self.version = None
+        self.timer = None
+        self.lock = threading.RLock()
+
+    def refresh(self):
+        """Read the file again if it was modified since it was last read."""
+        stat = os.stat(f"{self.folder}{self.file}")
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if version == self.version:
+                return self
+            self.set_names((read_name_list(self.folder, self.file) | self.added) - self.removed)
+            self.version = version
+        return self
+
+    def set_names(self, names):
+        self.names = set(names)
+        self.rules = dict()
+        for name in names:
+            rule, _, value = name.partition(":")
+            if rule in NAME_RULES and value != "":
+                self.rules.setdefault(rule, set()).add(value)
+
+    def __contains__(self, name):
+        return name in self.refresh().names
+
+    def match(self, keys, props=None):
+        """Boolean mask of the keys (a Series of names) listed or matched by a rule of props."""
+        self.refresh()
+        with self.lock:
+            names = self.names
+            rules = self.rules
+        mask = keys.isin(names).to_numpy(copy=True)
+        for rule, values in rules.items():
+            try:
+                mask |= NAME_RULES[rule](keys, props, values).to_numpy(dtype=bool, na_value=False)
+            except (KeyError, TypeError):  # Rule on a column props do not have.
+                continue
+        return mask
+
+    def edit(self, added=(), removed=()):
+        added = set(added)
+        removed = set(removed)
+        with self.lock:
+            self.refresh()
+            self.added = (self.added - removed) | added
+            self.removed = (self.removed - added) | removed
+            self.set_names((self.names | added) - removed)
+            if self.timer is None:
+                self.timer = threading.Timer(WRITE_BEHIND_DELAY, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        if len(self.added) == 0 and len(self.removed) == 0:
+            return
+        # Same lock order as update_property_data, which matches names under the folder lock.
+        with folder_lock(self.folder), self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if len(self.added) == 0 and len(self.removed) == 0:
+                return
+            edit_name_lists(self.folder, {self.file: (self.added, self.removed)})
+            self.added = set()
+            self.removed = set()
+            self.version = None
+            self.refresh()
+
+
+_name_indexes = dict()
+_name_indexes_lock = threading.Lock()
+
+
+def get_name_index(folder, file):
+    """The shared NameIndex of a folder name list."""
+    key = (os.path.abspath(folder), file)
+    with _name_indexes_lock:
+        if key not in _name_indexes:
+            _name_indexes[key] = NameIndex(folder, file)
+        return _name_indexes[key]
+
+
+@atexit.register
+def flush_name_indexes():
+    with _name_indexes_lock:
+        indexes = list(_name_indexes.values())
+    for index in indexes:
+        index.flush()
+
+
+_geo_indexes = dict()
+_geo_indexes_lock = threading.Lock()
+
+
+def get_geo_index(folder):
+    """
+    The shared property_geo.GeoIndex of the listings tracked in folder, built on first use and
+    then kept up to date by update_property_data.
+    """
+    key = os.path.abspath(folder)
+    with _geo_indexes_lock:
+        if key not in _geo_indexes:
+            property_data = read_property_data(folder, ["Latitude", "Longitude"])
+            _geo_indexes[key] = pgeo.GeoIndex(property_data)
+        return _geo_indexes[key]
+
+
+def update_geo_index(folder, diff_result, current_ori):
+    geo_index = _geo_indexes.get(os.path.abspath(folder))
+    if geo_index is None:
+        return
+    for pid in diff_result["passed"]:
+        geo_index.remove(pid)
+    geo_index.update(current_ori.loc[list(diff_result["new"])])
+
+
+def initiate_property_data(folder, property_ori, init_ignore, current_time=None):
     os.makedirs(folder)
 
-    present = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
-    with open(f"{folder}log.txt", "w+") as f:
-        f.write(f"Start monitoring properties at: {present} (UTC)\n")
+    present = get_present_time() if current_time is None else current_time
+    with folder_lock(folder):
+        with open(f"{folder}log.txt", "w+") as f:
+            f.write(f"Start monitoring properties at: {present} (UTC)\n")
+
+        replace_file(f"{folder}{PREFERENCE_FILE}", write_text, "")
+        replace_file(
+            f"{folder}{IGNORE_FILE}", write_text, "" if init_ignore is None else init_ignore
+        )
+
+        property_data = ensure_weekly_price(property_ori).copy()
+        listed = {"new": set(property_data.index), "passed": set(), "changed": None}
+        ppe.append_events(folder, ppe.make_events(listed, property_data, present))
+        write_property_snapshot(folder, property_data, present)
+    return property_data
+
+
+def parse_images(images):
+    if isinstance(images, str) and images.startswith("["):
+        try:
+            return json.loads(images)
+        except ValueError:  # Python repr written by older versions.
+            return ast.literal_eval(images)
+    return images
 
-    with open(f"{folder}preference.txt", "w+") as f:
-        f.write("")
-    with open(f"{folder}ignore_street.txt", "w+") as f:
-        if init_ignore is None:
-            f.write("")
+
+def encode_images(images):
+    if isinstance(images, (list, tuple, dict)):
+        return json.dumps(images)
+    return images
+
+
+def apply_property_schema(property_data):
+    """Cast the columns of property_data to PROPERTY_SCHEMA for storage."""
+    property_data = property_data.copy()
+    for col, dtype in PROPERTY_SCHEMA.items():
+        if col not in property_data.columns:
+            continue
+        values = property_data[col]
+        if dtype == "json":
+            property_data[col] = values.map(encode_images).astype(object)
+        elif dtype == "str":
+            property_data[col] = values.astype(object).where(values.isna(), values.astype(str))
         else:
-            f.write(init_ignore)
+            property_data[col] = pd.to_numeric(values, errors="coerce").astype(dtype)
+    return property_data
+
 
-    property_data = property_ori.copy()
-    property_data.to_csv(f"{folder}tracked_properties.csv")
+def read_csv_snapshot(path, columns):
+    dtypes = {col: (str if dtype != "float64" else dtype) for col, dtype in PROPERTY_SCHEMA.items()}
+    if columns is None:
+        return pd.read_csv(path, index_col=0, dtype=dtypes)
+    usecols = lambda col: col.startswith("Unnamed: 0") or col in columns
+    return pd.read_csv(path, index_col=0, dtype=dtypes, usecols=usecols)[list(columns)]
+
+
+def write_csv_snapshot(path, property_data):
+    apply_property_schema(property_data).to_csv(path)
+
+
+def read_parquet_snapshot(path, columns):
+    if columns is not None:
+        columns = ["Index"] + list(columns)
+    property_data = pd.read_parquet(path, columns=columns).set_index("Index")
+    property_data.index.name = ""
     return property_data
 
 
-def get_prop_value_change(previous_prop, current_prop):
-    row_same = previous_prop.eq(current_prop).all(axis=1)
-    if all(row_same):
+def write_parquet_snapshot(path, property_data):
+    property_data = apply_property_schema(property_data)
+    property_data.index.name = "Index"
+    property_data.reset_index().to_parquet(path, index=False)
+
+
+SNAPSHOT_BACKENDS = {
+    "parquet": (read_parquet_snapshot, write_parquet_snapshot),
+    "csv": (read_csv_snapshot, write_csv_snapshot),
+}
+
+
+def get_default_snapshot_format():
+    return "parquet" if importlib.util.find_spec("pyarrow") is not None else "csv"
+
+
+def get_snapshot_format(folder):
+    """Format of the folder's tracked properties, the default one for a new folder."""
+    for fmt in SNAPSHOT_BACKENDS:
+        if os.path.isfile(f"{folder}tracked_properties.{fmt}"):
+            return fmt
+    return get_default_snapshot_format()
+
+
+def ensure_weekly_price(property_data):
+    """Add the parsed price columns to listings tracked before prices were parsed."""
+    if "Price" not in property_data.columns or "Weekly_price" in property_data.columns:
+        return property_data
+    return ppq.add_weekly_price(property_data.copy(deep=False))
+
+
+def read_snapshot_file(path, columns=None):
+    read_snapshot = SNAPSHOT_BACKENDS[path.rsplit(".", 1)[-1]][0]
+    try:
+        property_data = read_snapshot(path, columns)
+    except (KeyError, ValueError):
+        if columns is None or not set(PRICE_COLUMNS) & set(columns):
+            raise
+        # Snapshot written before prices were parsed: parse them from Price.
+        legacy_columns = [col for col in columns if col not in PRICE_COLUMNS + ["Price"]]
+        property_data = read_snapshot(path, legacy_columns + ["Price"])
+    property_data = ensure_weekly_price(property_data)
+    if columns is not None:
+        property_data = property_data[list(columns)]
+    if "Images" in property_data.columns:
+        property_data["Images"] = property_data["Images"].map(parse_images)
+    return property_data
+
+
+def read_snapshot_data(folder, columns=None):
+    """Read the last snapshot of tracked properties, only the given columns (besides the PID index) if any."""
+    fmt = get_snapshot_format(folder)
+    return read_snapshot_file(f"{folder}tracked_properties.{fmt}", columns)
+
+
+@pmet.timed("write")
+def write_property_data(folder, property_data):
+    fmt = get_snapshot_format(folder)
+    write_snapshot = SNAPSHOT_BACKENDS[fmt][1]
+    replace_file(f"{folder}tracked_properties.{fmt}", write_snapshot, property_data)
+
+
+def read_snapshot_meta(folder):
+    path = f"{folder}{SNAPSHOT_META}"
+    if not os.path.isfile(path):
         return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_json(path, content):
+    with open(path, "w") as f:
+        json.dump(content, f)
+
+
+def write_snapshot_meta(folder, meta):
+    replace_file(f"{folder}{SNAPSHOT_META}", write_json, meta)
+
+
+def write_property_snapshot(folder, property_data, current_time):
+    """Write property_data as the tracked properties and as a dated snapshot, compacting the event log."""
+    fmt = get_snapshot_format(folder)
+    write_property_data(folder, property_data)
+    os.makedirs(f"{folder}snapshots", exist_ok=True)
+    file = f"snapshots/tracked_properties_{re.sub(r'[^0-9]', '', current_time)}.{fmt}"
+    source = f"{folder}tracked_properties.{fmt}"
+    replace_file(f"{folder}{file}", lambda path: shutil.copyfile(source, path))
+
+    meta = read_snapshot_meta(folder) or {"snapshots": []}
+    meta["snapshots"].append(
+        {"time": current_time, "file": file, "offset": ppe.get_event_log_size(folder)}
+    )
+    meta["pending"] = 0
+    write_snapshot_meta(folder, meta)
+
+
+def ensure_snapshot_meta(folder):
+    """Snapshot a folder tracked before the event log, so its history starts from its last update."""
+    if read_snapshot_meta(folder) is not None:
+        return
+    fmt = get_snapshot_format(folder)
+    modified = time.gmtime(os.path.getmtime(f"{folder}tracked_properties.{fmt}"))
+    current_time = time.strftime("%Y-%m-%d %H:%M:%S", modified)
+    write_property_snapshot(folder, read_snapshot_data(folder), current_time)
+
+
+@pmet.timed("read")
+def read_property_data(folder, columns=None):
+    """
+    Read the current tracked properties: the last snapshot with the events logged since
+    replayed over it. Columns outside CHECK_COL are only refreshed by snapshots.
+    """
+    with folder_lock(folder):
+        property_data = read_snapshot_data(folder, columns)
+        meta = read_snapshot_meta(folder)
+        if meta is None:
+            return property_data
+        events = ppe.read_events(folder, meta["snapshots"][-1]["offset"])
+    return ppe.apply_events(property_data, events)
+
+
+def read_property_data_at(folder, at_time, columns=None):
+    """Reconstruct the tracked properties as they were at at_time (same format as the log times)."""
+    meta = read_snapshot_meta(folder)
+    snapshots = [] if meta is None else [x for x in meta["snapshots"] if x["time"] <= at_time]
+    if len(snapshots) == 0:
+        raise ValueError(f"No snapshot of {folder} before {at_time}.")
+    property_data = read_snapshot_file(f"{folder}{snapshots[-1]['file']}", columns)
+    events = ppe.read_events(folder, snapshots[-1]["offset"], until=at_time)
+    return ppe.apply_events(property_data, events)
+
+
+@pmet.timed("events")
+def record_property_events(folder, diff_result, current_ori, current_time):
+    """Log the listing events of an update, compacting them into a snapshot when due."""
+    events = ppe.make_events(diff_result, current_ori, current_time)
+    ppe.append_events(folder, events)
+    meta = read_snapshot_meta(folder)
+    meta["pending"] += len(events)
+    if meta["pending"] >= max(COMPACT_MIN_EVENTS, COMPACT_RATIO * len(current_ori)):
+        write_property_snapshot(folder, current_ori, current_time)
     else:
-        diff_pids = row_same[~row_same].index
-
-    diff_dict = dict()
-    for pid in diff_pids:
-        diff_val = dict()
-        for col in previous_prop.columns:
-            pre_val = previous_prop.loc[pid, col]
-            cur_val = current_prop.loc[pid, col]
-            if pre_val != cur_val:
-                diff_val[col] = (pre_val, cur_val)
-        diff_dict[pid] = diff_val
+        write_snapshot_meta(folder, meta)
+    return events
+
+
+def migrate_csv_snapshot(folder):
+    """Convert a CSV tracked properties file to Parquet once, keeping the CSV as a backup."""
+    csv_path = f"{folder}tracked_properties.csv"
+    if get_default_snapshot_format() != "parquet" or get_snapshot_format(folder) != "csv":
+        return False
+    if not os.path.isfile(csv_path):
+        return False
+    property_data = read_snapshot_data(folder)
+    replace_file(f"{folder}tracked_properties.parquet", write_parquet_snapshot, property_data)
+    os.replace(csv_path, f"{csv_path}.bak")
+    return True
+
+
+def get_changed_mask(previous_prop, current_prop):
+    """Cell-wise inequality of two aligned frames, where two missing values are equal."""
+    changed = previous_prop.ne(current_prop).fillna(True).astype(bool)
+    return changed & ~(previous_prop.isna() & current_prop.isna())
+
+
+def get_prop_value_change(previous_prop, current_prop):
+    if not previous_prop.index.equals(current_prop.index):
+        current_prop = current_prop.reindex(previous_prop.index)
+    changed = get_changed_mask(previous_prop, current_prop).to_numpy()
+    row_pos, col_pos = changed.nonzero()
+    if len(row_pos) == 0:
+        return None
+
+    pids = previous_prop.index
+    columns = previous_prop.columns
+    pre_cols = [previous_prop[col].to_numpy() for col in columns]
+    cur_cols = [current_prop[col].to_numpy() for col in columns]
+    diff_dict = {pid: dict() for pid in pids[row_pos]}
+    for i, j in zip(row_pos, col_pos):
+        diff_dict[pids[i]][columns[j]] = (pre_cols[j][i], cur_cols[j][i])
     return diff_dict
 
 
+def get_comparable(property_data):
+    """Undo the compact dtypes (see property_query.compact_properties), to compare with a snapshot."""
+    dtypes = dict()
+    for col, dtype in property_data.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            dtypes[col] = object
+        elif dtype == "float32":
+            dtypes[col] = "float64"
+    if len(dtypes) == 0:
+        return property_data
+    return property_data.astype(dtypes)
+
+
+@pmet.timed("diff")
 def diff_property_info(previous_ori, current_ori):
-    check_col = ["Price", "Bedroom_num", "Bathroom_num", "Parking_num", "Source"]
-    previous_prop = previous_ori.copy()
-    current_prop = current_ori.copy()
+    previous_prop = get_comparable(ensure_weekly_price(previous_ori)[CHECK_COL])
+    current_prop = get_comparable(ensure_weekly_price(current_ori)[CHECK_COL])
     # If no update.
-    if previous_prop[check_col].equals(current_prop[check_col]):
+    if previous_prop.equals(current_prop):
         return None
 
-    pre_pids = set(previous_prop.index)
-    cur_pids = set(current_prop.index)
-    new_pids = cur_pids - pre_pids
-    passed_pids = pre_pids - cur_pids
-    same_pids = pre_pids & cur_pids
+    pre_pids = previous_prop.index
+    cur_pids = current_prop.index
+    new_pids = set(cur_pids.difference(pre_pids))
+    passed_pids = set(pre_pids.difference(cur_pids))
+    same_pids = pre_pids.intersection(cur_pids)
     change_dict = get_prop_value_change(
-        previous_prop.loc[list(same_pids), check_col], current_prop.loc[list(same_pids), check_col]
+        previous_prop.loc[same_pids], current_prop.loc[same_pids]
     )
+    if len(new_pids) == 0 and len(passed_pids) == 0 and change_dict is None:
+        return None
     return {"new": new_pids, "passed": passed_pids, "changed": change_dict}
 
 
@@ -113,30 +612,47 @@ def print_update_info(diff_result, pref):
     return
 
 
-def update_property_data(folder, current_ori):
-    previous_ori = pd.read_csv(f"{folder}tracked_properties.csv", index_col=0)
-    diff_result = diff_property_info(previous_ori, current_ori)
-    if diff_result is None:
-        print("No update found.")
-        return None
+def update_property_data(folder, current_ori, current_time=None, notifier=None):
+    """
+    Record the changes of current_ori since the last update and report them, to notifier if
+    given, else to the one set with property_notify.set_notifier. Return the new listings.
+    """
+    if notifier is None:
+        notifier = pnot.get_notifier()
+    current_ori = ensure_weekly_price(current_ori)
+    with folder_lock(folder):
+        migrate_csv_snapshot(folder)
+        ensure_snapshot_meta(folder)
+        previous_ori = read_property_data(folder, CHECK_COL)
+        diff_result = diff_property_info(previous_ori, current_ori)
+        if diff_result is None:
+            print("No update found.")
+            return None
 
-    current_ori.to_csv(f"{folder}tracked_properties.csv")
-    log_update_info(folder, diff_result)
-    with open(f"{folder}preference.txt", "r") as f:
-        pref = set(f.read().split(","))
+        present = get_present_time() if current_time is None else current_time
+        events = record_property_events(folder, diff_result, current_ori, present)
+        update_geo_index(folder, diff_result, current_ori)
+        log_update_info(folder, diff_result)
+        pids = set(diff_result["changed"] or dict()) | diff_result["passed"]
+        if notifier is not None:
+            pids |= diff_result["new"]
+        pids = pd.Series(list(pids))
+        preferred = get_name_index(folder, PREFERENCE_FILE).match(pids)
+        pref = set(pids[preferred])
     print_update_info(diff_result, pref)
+    if notifier is not None:
+        notifier.submit(pnot.make_notifications(events, pref, folder))
 
     if len(diff_result["new"]) == 0:
         return None
     else:
-        return current_ori.loc[diff_result["new"]]
+        return current_ori.loc[list(diff_result["new"])]
 
 
 def filter_prop(new_prop_ori, folder):
     new_prop = new_prop_ori.copy()
-    with open(f"{folder}ignore_street.txt", "r") as f:
-        ignored = f.read().split(",")
-    new_prop = new_prop[~new_prop["Street"].isin(ignored)]
+    ignored = get_name_index(folder, IGNORE_FILE).match(new_prop["Street"], new_prop)
+    new_prop = new_prop[~ignored]
     new_prop = new_prop[
         [
             "Name",
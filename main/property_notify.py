@@ -0,0 +1,244 @@
+import atexit
+import json
+import smtplib
+import threading
+import time
+import warnings
+from email.message import EmailMessage
+import property_http as pph
+
+# Seconds a notification is held, so that further changes of the same listing are merged in.
+COALESCE_DELAY = 5.0
+# Most notifications sent to the sinks at once.
+BATCH_SIZE = 50
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def make_notifications(events, preferred=(), folder=None):
+    """Notifications of listing events (see property_events.make_events) of a monitor folder."""
+    return [
+        {**event, "folder": folder, "preferred": event["pid"] in preferred} for event in events
+    ]
+
+
+def coalesce(previous, notification):
+    """
+    Merge a notification into a pending one of the same listing. Return None when nothing is
+    left to tell, e.g. a listing delisted before its listing was sent, or a price changed back.
+    """
+    preferred = previous["preferred"] or notification["preferred"]
+    kinds = previous["event"], notification["event"]
+    if kinds == ("listed", "delisted"):
+        return None
+    if kinds == ("listed", "changed"):
+        merged = {**previous, "fields": {**previous["fields"], **notification["fields"]}}
+    elif kinds == ("changed", "changed"):
+        changes = {**notification["previous"], **previous["previous"]}
+        fields = {**previous["fields"], **notification["fields"]}
+        changes = {col: value for col, value in changes.items() if value != fields[col]}
+        if len(changes) == 0:
+            return None
+        merged = {**notification, "fields": fields, "previous": changes}
+    else:
+        merged = dict(notification)
+    merged["time"] = notification["time"]
+    merged["preferred"] = preferred
+    return merged
+
+
+def format_notification(notification):
+    mark = "* " if notification["preferred"] else ""
+    pid = notification["pid"]
+    if notification["event"] == "listed":
+        fields = notification["fields"]
+        return f"{mark}{pid} listed: {fields.get('Price')} {fields.get('Url')}"
+    if notification["event"] == "delisted":
+        return f"{mark}{pid} is no longer available."
+    changes = "".join(
+        f"{col} from '{value}' to '{notification['fields'][col]}'. "
+        for col, value in notification["previous"].items()
+    )
+    return f"{mark}{pid} : {changes}"
+
+
+class JsonlSink:
+    """Append notifications to a JSON lines file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def send(self, notifications):
+        with self.lock, open(self.path, "a") as f:
+            f.writelines(json.dumps(notification) + "\n" for notification in notifications)
+
+
+class SmtpSink:
+    """Mail each batch of notifications through an SMTP server, by default a local relay."""
+
+    def __init__(
+        self,
+        recipients,
+        host="localhost",
+        port=25,
+        sender="estate-monitor@localhost",
+        subject="Property updates",
+        timeout=30,
+    ):
+        self.recipients = list(recipients)
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.subject = subject
+        self.timeout = timeout
+
+    def send(self, notifications):
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = ", ".join(self.recipients)
+        message["Subject"] = f"{self.subject} ({len(notifications)})"
+        message.set_content("\n".join(map(format_notification, notifications)) + "\n")
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            smtp.send_message(message)
+
+
+class WebhookSink:
+    """POST each batch of notifications as {"notifications": [...]} to url."""
+
+    def __init__(self, url, timeout=None):
+        self.url = url
+        self.timeout = pph.TIMEOUT if timeout is None else timeout
+
+    def send(self, notifications):
+        response = pph.get_session().post(
+            self.url, json={"notifications": notifications}, timeout=self.timeout
+        )
+        response.raise_for_status()
+
+
+class Notifier:
+    """
+    Send notifications to sinks from a background thread, so submitting never waits for them.
+    Each listing's notification is held coalesce_delay seconds, merging the changes submitted
+    meanwhile (see coalesce). Due notifications are sent in batches of up to batch_size,
+    preferred listings first, and at most rate batches per second when rate is given.
+    A failing sink is warned about and does not stop the others.
+    """
+
+    def __init__(
+        self, sinks, coalesce_delay=COALESCE_DELAY, rate=None, burst=None, batch_size=BATCH_SIZE
+    ):
+        self.sinks = list(sinks)
+        self.coalesce_delay = coalesce_delay
+        self.budget = None if rate is None else pph.RequestBudget(rate, burst)
+        self.batch_size = batch_size
+        # Pending notifications by (folder, PID), with the time they are due and their order.
+        self.pending = dict()
+        self.sequence = 0
+        self.sending = 0
+        self.flushing = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def submit(self, notifications):
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Notifier is closed.")
+            now = time.monotonic()
+            for notification in notifications:
+                key = (notification.get("folder"), notification["pid"])
+                entry = self.pending.get(key)
+                if entry is None:
+                    self.sequence += 1
+                    self.pending[key] = [notification, now + self.coalesce_delay, self.sequence]
+                    continue
+                merged = coalesce(entry[0], notification)
+                if merged is None:
+                    del self.pending[key]
+                else:
+                    entry[0] = merged
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def take_batch(self):
+        """Remove and return the next batch of due notifications, or the seconds to wait for one."""
+        now = time.monotonic()
+        due = [
+            (key, entry)
+            for key, entry in self.pending.items()
+            if self.flushing > 0 or entry[1] <= now
+        ]
+        if len(due) == 0:
+            return min((entry[1] for entry in self.pending.values()), default=now + 60) - now
+        due.sort(key=lambda item: (not item[1][0]["preferred"], item[1][2]))
+        batch = []
+        for key, entry in due[: self.batch_size]:
+            del self.pending[key]
+            batch.append(entry[0])
+        return batch
+
+    def run(self):
+        while True:
+            with self.condition:
+                batch = self.take_batch()
+                while not isinstance(batch, list):
+                    if self.closed and len(self.pending) == 0:
+                        return
+                    self.condition.wait(batch)
+                    batch = self.take_batch()
+                self.sending += 1
+            try:
+                if self.budget is not None:
+                    self.budget.acquire()
+                for sink in self.sinks:
+                    try:
+                        sink.send(batch)
+                    except Exception as e:  # A failing sink must not stop the others.
+                        warnings.warn(f"{type(sink).__name__} failed: {e!r}")
+            finally:
+                with self.condition:
+                    self.sending -= 1
+                    self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Send every pending notification now. Return False if timeout expired first."""
+        with self.condition:
+            self.flushing += 1
+            self.condition.notify_all()
+            try:
+                return self.condition.wait_for(
+                    lambda: len(self.pending) == 0 and self.sending == 0, timeout
+                )
+            finally:
+                self.flushing -= 1
+
+    def close(self, timeout=None):
+        """Send the pending notifications and stop the sending thread."""
+        with self.condition:
+            self.closed = True
+        self.flush(timeout)
+
+
+def set_notifier(notifier):
+    """Set the notifier update_property_data uses by default. Return the previous one."""
+    global _notifier
+    with _notifier_lock:
+        previous = _notifier
+        _notifier = notifier
+    return previous
+
+
+def get_notifier():
+    return _notifier
+
+
+@atexit.register
+def close_notifier():
+    notifier = get_notifier()
+    if notifier is not None:
+        notifier.close()
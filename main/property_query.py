@@ -1,7 +1,94 @@
-import requests
+import functools
+import itertools
+import re
+import sys
 import numpy as np
 import pandas as pd
 import warnings
+import property_http as pph
+import property_metrics as pmet
+from concurrent.futures import ThreadPoolExecutor
+
+# Portal base urls, pointed at a local server by the benchmarks.
+DOMAIN_URL = "https://www.domain.com.au"
+REALESTATE_SEARCH_URL = "https://services.realestate.com.au/services/listings/search"
+DOMAIN_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:91.0) Gecko/20100101 Firefox/91.0",
+    "Accept": "application/json",
+}
+UPPER_LETTERS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+ROAD_SUFFIXES = frozenset(
+    [
+        "Street",
+        "Road",
+        "St",
+        "street",
+        "STREET",
+        "Rd",
+        "ROAD",
+        "Drive",
+        "Place",
+        "Lane",
+        "Terrace",
+        "ST",
+        "RD",
+    ]
+)
+REALESTATE_COLUMNS = [
+    "Url",
+    "Bedroom_num",
+    "Bathroom_num",
+    "Parking_num",
+    "Price",
+    "Type",
+    "Name",
+    "Suburb",
+    "State",
+    "Latitude",
+    "Longitude",
+    "Available",
+    "Images",
+]
+DOMAIN_COLUMNS = [
+    "Url",
+    "Price",
+    "Name",
+    "Suburb",
+    "State",
+    "Latitude",
+    "Longitude",
+    "Bedroom_num",
+    "Bathroom_num",
+    "Parking_num",
+    "Type",
+    "Images",
+]
+# Distance in metres within which unmatched listings of both portals can be paired.
+GEO_MATCH_TOLERANCE = 20.0
+NON_APARTMENT_TYPES = ["House", "Terrace", "Townhouse", "Villa"]
+# What int() accepts.
+ROOM_NUMBER = re.compile(r"\s*[+-]?\d+(?:_\d+)*\s*")
+# Price amounts, with a dollar sign or else bare numbers of 3 digits and more, which are only
+# taken as prices when a period follows them (phone numbers, years).
+PRICE_AMOUNT = re.compile(r"\$\s*(\d[\d,]*(?:\.\d+)?)")
+BARE_PRICE_AMOUNT = re.compile(r"(?<![\d.,/])(\d{1,3}(?:,\d{3})+|\d{3,})(?:\.\d+)?(?![\d/])")
+PRICE_RANGE = re.compile(r"\$\s*(\d[\d,]*(?:\.\d+)?)\s*(?:-|–|to)\s*\$?\s*\d[\d,]*(?:\.\d+)?")
+# Weeks per price period, stated after the amount. Prices are weekly unless stated otherwise.
+# The period nearest the amount applies, later ones describe something else ("annual lease").
+PRICE_PERIODS = [
+    (re.compile(r"\bp\.?w\b|per\s*week|/\s*(?:wk|week)\b|\bweekly"), 1),
+    (re.compile(r"p\.?c\.?m\b|per\s*(?:calendar\s*)?month|/\s*month|\bmonthly|\bp/?m\b"), 52 / 12),
+    (re.compile(r"\bp\.?a\b|per\s*(?:annum|year)|/\s*year|\byearly|\bannual"), 52),
+    (re.compile(r"per\s*(?:night|day)|/\s*(?:night|day)|\bnightly|\bdaily"), 1 / 7),
+    (re.compile(r"per\s*fortnight|/\s*fortnight|\bfortnightly|\bp[./]?f\b"), 2),
+]
+# Price_flag of prices stated as a range (parsed as their lower bound) and without any amount.
+PRICE_RANGE_FLAG = "range"
+PRICE_NONE_FLAG = "none"
+# Columns with few distinct values, stored as categoricals.
+CATEGORY_COLUMNS = ["Street", "Suburb", "State", "Type", "Source", "Price_flag"]
+# Listing counts, stored as float32 to keep missing counts.
+COUNT_COLUMNS = ["Bedroom_num", "Bathroom_num", "Parking_num"]
 
 
 def standardize_room_street(room, street):
@@ -9,9 +96,9 @@ def standardize_room_street(room, street):
     if room not in ["", "-"]:
         if room[:4] == "UNIT":  # Unit 1510
             room_c = room[4:].strip()
-        elif room[0] in [x for x in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"]:  # G05, H8, C101
+        elif room[0] in UPPER_LETTERS:  # G05, H8, C101
             room_c = room[1:]
-        elif room[-1] in [x for x in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"]:  # 407B
+        elif room[-1] in UPPER_LETTERS:  # 407B
             room_c = room[:-1]
         else:
             room_c = room  # 308
@@ -22,30 +109,15 @@ def standardize_room_street(room, street):
             room = ""
 
     # Standardize street.
-    road_suff = [
-        "Street",
-        "Road",
-        "St",
-        "street",
-        "STREET",
-        "Rd",
-        "ROAD",
-        "Drive",
-        "Place",
-        "Lane",
-        "Terrace",
-        "ST",
-        "RD",
-    ]
     street = street.split(" ")
-    if street[-1] in road_suff:
+    if street[-1] in ROAD_SUFFIXES:
         street = street[:-1]
     street = "".join([x.lower().capitalize() for x in street])
     return room, street
 
 
 def get_room_street(estate_name, estate_type):
-    if estate_type in ["House", "Terrace", "Townhouse", "Villa"]:
+    if estate_type in NON_APARTMENT_TYPES:
         is_apartment = False
     else:
         is_apartment = True
@@ -69,6 +141,170 @@ def get_room_street(estate_name, estate_type):
     return room, street
 
 
+@functools.lru_cache(maxsize=2**16)
+def standardize_room(room):
+    """Cached equivalent of the room part of standardize_room_street."""
+    if room in ["", "-"]:
+        return room
+    if room[:4] == "UNIT":  # Unit 1510
+        room_c = room[4:].strip()
+    elif room[0] in UPPER_LETTERS:  # G05, H8, C101
+        room_c = room[1:]
+    elif room[-1] in UPPER_LETTERS:  # 407B
+        room_c = room[:-1]
+    else:
+        room_c = room  # 308
+    room_c = room_c.replace(".", "")  # 12.01; G.11
+    return room if ROOM_NUMBER.fullmatch(room_c) else ""
+
+
+@functools.lru_cache(maxsize=2**16)
+def standardize_street(street):
+    """Cached equivalent of the street part of standardize_room_street."""
+    street = street.split(" ")
+    if street[-1] in ROAD_SUFFIXES:
+        street = street[:-1]
+    return "".join([x.lower().capitalize() for x in street])
+
+
+def map_unique(values, func):
+    """Apply func once per distinct value."""
+    uniques = pd.unique(values)
+    return values.map(dict(zip(uniques, map(func, uniques))))
+
+
+def get_room_street_columns(names, types):
+    """Batch equivalent of get_room_street over columns of names and types (missing names count as "")."""
+    names = names.fillna("").astype(object)
+    n_parts = names.str.count("/") + 1
+    is_valid = (names != "") & (n_parts <= 2)
+    split = names.str.split("/", n=1)
+
+    # Split room and steet.
+    street = split.str[-1].where(is_valid, "")
+    single_room = np.where(types.isin(NON_APARTMENT_TYPES), "-", "")
+    room = split.str[0].str.strip().str.upper().where(n_parts == 2, single_room)
+    room = room.where(is_valid, "")
+
+    # Standardize distinct values only.
+    room = map_unique(room, standardize_room)
+    street = map_unique(street, standardize_street)
+    return pd.DataFrame({"Room": room.astype(object), "Street": street.astype(object)})
+
+
+@pmet.timed("normalize")
+def add_room_street_pid(property_info, after):
+    """Add Room and Street after column after, and PID (missing without a room) at the end."""
+    room_street = get_room_street_columns(property_info["Name"], property_info["Type"])
+    position = property_info.columns.get_loc(after) + 1
+    property_info.insert(position, "Room", room_street["Room"].to_numpy())
+    property_info.insert(position + 1, "Street", room_street["Street"].to_numpy())
+    pid = (
+        property_info["Room"] + "_" + property_info["Street"] + "_"
+        + property_info["Suburb"] + "_" + property_info["State"]
+    )
+    property_info["PID"] = pid.where(property_info["Room"] != "", np.nan)
+    return property_info
+
+
+def iter_pages(request_func, urls, max_workers=1):
+    """
+    Yield the content of every url fetched with request_func, in the order of urls.
+    With max_workers > 1 the pages are fetched concurrently and yielded as soon as all the
+    previous ones have been.
+    """
+    if max_workers <= 1 or len(urls) <= 1:
+        for url in urls:
+            yield request_func(None, url=url)[0]
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
+        futures = [executor.submit(request_func, None, url=url) for url in urls]
+        for future in futures:
+            yield future.result()[0]
+
+
+def fetch_pages(request_func, urls, max_workers=1):
+    """Fetch the content of every url with request_func, in the order of urls."""
+    return list(iter_pages(request_func, urls, max_workers))
+
+
+def append_rows(buffers, rows):
+    """Append rows of values to column buffers."""
+    for buffer, values in zip(buffers, zip(*rows)):
+        buffer.extend(values)
+
+
+def parse_realestate_listing(estate_web):
+    address = estate_web["address"]
+    features = estate_web["features"]["general"]
+    return (
+        estate_web["_links"]["prettyUrl"]["href"],
+        features["bedrooms"],
+        features["bathrooms"],
+        features["parkingSpaces"],
+        estate_web["price"]["display"],
+        estate_web["propertyType"].capitalize(),
+        address["streetAddress"],
+        "".join(address["suburb"].split(" ")).lower().capitalize(),
+        address["state"].upper(),
+        address["location"]["latitude"],
+        address["location"]["longitude"],
+        estate_web["dateAvailable"]["date"],
+        estate_web["images"],
+    )
+
+
+def parse_realestate_pages(pages):
+    """Parse Realestate result pages one at a time into column buffers, then one frame."""
+    buffers = [[] for _ in REALESTATE_COLUMNS]
+    for content in pages:
+        with pmet.stage("parse"):
+            listings = content["tieredResults"][0]["results"]
+            append_rows(buffers, map(parse_realestate_listing, listings))
+    return pd.DataFrame(dict(zip(REALESTATE_COLUMNS, buffers)))
+
+
+def parse_domain_listing(estate_web):
+    address = estate_web["address"]
+    features = estate_web["features"]
+    return (
+        DOMAIN_URL + estate_web["url"],
+        estate_web["price"],
+        address["street"],
+        "".join(address["suburb"].split(" ")).lower().capitalize(),
+        address["state"].upper(),
+        address["lat"],
+        address["lng"],
+        features.get("beds", None),
+        features.get("baths", None),
+        features.get("parking", 0),
+        features.get("propertyTypeFormatted", None),
+        estate_web["images"],
+    )
+
+
+def parse_domain_pages(pages):
+    """
+    Parse Domain result pages one at a time into column buffers, then one frame.
+    A listing repeated on a later page replaces the earlier one in place.
+    """
+    buffers = [[] for _ in DOMAIN_COLUMNS]
+    positions = dict()
+    for content in pages:
+        with pmet.stage("parse"):
+            rows = []
+            for key, estate_web in content["props"]["listingsMap"].items():
+                row = parse_domain_listing(estate_web["listingModel"])
+                if key in positions:
+                    for buffer, value in zip(buffers, row):
+                        buffer[positions[key]] = value
+                    continue
+                positions[key] = len(positions)
+                rows.append(row)
+            append_rows(buffers, rows)
+    return pd.DataFrame(dict(zip(DOMAIN_COLUMNS, buffers)))
+
+
 def create_domain_url(requisition):
     min_bed = requisition.get("min_bed", 1)
     min_bath = requisition.get("min_bath", 1)
@@ -79,7 +315,7 @@ def create_domain_url(requisition):
     south = requisition.get("south")
     east = requisition.get("east")
     domain_url = (
-        f"https://www.domain.com.au/rent/?bedrooms={min_bed}-any&bathrooms={min_bath}-any&price={min_price}-"
+        f"{DOMAIN_URL}/rent/?bedrooms={min_bed}-any&bathrooms={min_bath}-any&price={min_price}-"
         f"{max_price}&excludedeposittaken=1&startloc={north},{west}&endloc={south},{east}&"
         f"displaymap=0"
     )
@@ -89,94 +325,116 @@ def create_domain_url(requisition):
 def request_domain_properties(requisition, url=None):
     if url is None:
         url = create_domain_url(requisition)
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:91.0) Gecko/20100101 Firefox/91.0",
-        "Accept": "application/json",
-    }
-    content = requests.get(url, headers=headers).json()
+    content = pph.get_json(url, headers=DOMAIN_HEADERS)
     return content, url
 
 
-def request_domain_multipages(content, url):
+def get_domain_page_urls(content, url):
     pages = content["props"]["pageViewMetadata"]["searchResponse"]["SearchResults"][
         "totalPages"
     ]
-    for page in range(2, pages + 1):
-        new_url = url + f"&page={page}"
-        page_content, _ = request_domain_properties(None, url=new_url)
-        content["props"]["listingsMap"] = {
-            **content["props"]["listingsMap"],
-            **page_content["props"]["listingsMap"],
-        }
+    return [url + f"&page={page}" for page in range(2, pages + 1)]
+
+
+def request_domain_multipages(content, url, max_workers=1):
+    page_urls = get_domain_page_urls(content, url)
+    for page_content in iter_pages(request_domain_properties, page_urls, max_workers):
+        content["props"]["listingsMap"].update(page_content["props"]["listingsMap"])
     return content
 
 
-def add_domain_detail_info(domain_properties):
+def request_domain_detail(url):
+    content = pph.get_json(url, headers=DOMAIN_HEADERS)
+    stats = pd.DataFrame(content["props"]["listingSummary"]["stats"])
+    avail_date = stats.query("key=='availableFrom'")["value"].iloc[0]
+    return avail_date, content["props"]["gallery"]["slides"]
+
+
+def get_reusable_details(domain_properties, previous):
+    """
+    Return the positions in previous of the rows whose details each Domain listing reuses, -1
+    where they are fetched. Listings already tracked from Domain with the same Url and an
+    unchanged Price reuse their details, and so do listings tracked on both portals (matched by
+    PID), whose merged row keeps the Realestate details anyway.
+    """
+    positions = np.full(len(domain_properties), -1)
+    if previous is None or len(previous) == 0:
+        return positions
+    source = previous["Source"].astype(object).to_numpy()
+
+    tracked = np.flatnonzero(source == "Domain")
+    urls = pd.Index(previous["Url"].to_numpy()[tracked])
+    tracked, urls = tracked[~urls.duplicated()], urls[~urls.duplicated()]
+    found = urls.get_indexer(domain_properties["Url"])
+    # found is -1 for untracked Urls, picking the -1 appended.
+    positions = np.append(tracked, -1)[found]
+    same_price = previous["Price"].to_numpy()[positions] == domain_properties["Price"].to_numpy()
+    positions = np.where(same_price, positions, -1)
+
+    if "PID" in domain_properties.columns:
+        both = np.flatnonzero(source == "Both")
+        pids = previous.index[both]
+        both, pids = both[~pids.duplicated()], pids[~pids.duplicated()]
+        found = pids.get_indexer(domain_properties["PID"])
+        positions = np.where(positions < 0, np.append(both, -1)[found], positions)
+    return positions
+
+
+@pmet.timed("details")
+def add_domain_detail_info(domain_properties, previous=None, max_workers=1):
     """
     Add available date and full image (floorplan).
+    With the previously tracked properties, details are only fetched for new listings and
+    listings whose price changed, the rest reuse the tracked Available and Images (see
+    get_reusable_details).
     """
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:91.0) Gecko/20100101 Firefox/91.0",
-        "Accept": "application/json",
-    }
     domain_detail_info = domain_properties.copy()
+    positions = get_reusable_details(domain_properties, previous)
+    fetch_urls = list(domain_properties.Url[positions < 0])
+    if max_workers <= 1 or len(fetch_urls) <= 1:
+        fetched = [request_domain_detail(url) for url in fetch_urls]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(fetch_urls))) as executor:
+            fetched = list(executor.map(request_domain_detail, fetch_urls))
+    fetched = iter(fetched)
+    if previous is not None:
+        tracked_available = previous["Available"].to_numpy()
+        tracked_images = previous["Images"].to_numpy()
     avail_date = []
     full_images = []
-    for url in domain_properties.Url:
-        content = requests.get(url, headers=headers).json()
-        stats = pd.DataFrame(content["props"]["listingSummary"]["stats"])
-        avail_date.append(stats.query("key=='availableFrom'")["value"].iloc[0])
-        full_images.append(content["props"]["gallery"]["slides"])
+    for position in positions:
+        if position >= 0:
+            avail_date.append(tracked_available[position])
+            full_images.append(tracked_images[position])
+        else:
+            available, images = next(fetched)
+            avail_date.append(available)
+            full_images.append(images)
     domain_detail_info["Available"] = avail_date
     domain_detail_info["Images"] = full_images
     return domain_detail_info
 
 
-def get_domain_properties(requisition, get_details=False):
+def get_domain_properties(requisition, get_details=False, max_workers=1, previous=None):
     content, url = request_domain_properties(requisition)
 
     # Quality control.
     page_info = content["props"]["pageViewMetadata"]["searchResponse"]["SearchResults"]
     if page_info["actualTotalResultsExceedsMaximum"]:
         warnings.warn("Number of Domain properties exceeds maximum limit")
-    if page_info["totalPages"] != 1:
-        content = request_domain_multipages(content, url)
     n_total = page_info["totalResults"]
 
-    # Read information.
-    property_info = []
-    for estate_web in content["props"]["listingsMap"].values():
-        estate_web = estate_web["listingModel"]
-        estate_info = dict()
-        estate_info["Url"] = "https://www.domain.com.au" + estate_web["url"]
-        estate_info["Price"] = estate_web["price"]
-        estate_info["Name"] = estate_web["address"]["street"]
-        estate_info["Suburb"] = (
-            "".join(estate_web["address"]["suburb"].split(" ")).lower().capitalize()
-        )
-        estate_info["State"] = estate_web["address"]["state"].upper()
-        estate_info["Latitude"] = estate_web["address"]["lat"]
-        estate_info["Longitude"] = estate_web["address"]["lng"]
-        estate_info["Bedroom_num"] = estate_web["features"].get("beds", None)
-        estate_info["Bathroom_num"] = estate_web["features"].get("baths", None)
-        estate_info["Parking_num"] = estate_web["features"].get("parking", 0)
-        estate_info["Type"] = estate_web["features"].get("propertyTypeFormatted", None)
-        estate_info["Room"], estate_info["Street"] = get_room_street(
-            estate_info["Name"], estate_info["Type"]
-        )
-        estate_info["Images"] = estate_web["images"]
-        if estate_info["Room"] != "":
-            estate_info["PID"] = (
-                f"{estate_info['Room']}_{estate_info['Street']}_{estate_info['Suburb']}_"
-                f"{estate_info['State']}"
-            )
-        property_info.append(estate_info)
-
-    property_info = pd.DataFrame(property_info)
+    # Read information, parsing each page as it arrives.
+    page_urls = get_domain_page_urls(content, url)
+    pages = iter_pages(request_domain_properties, page_urls, max_workers)
+    property_info = parse_domain_pages(itertools.chain([content], pages))
+    property_info = add_room_street_pid(property_info, after="Type")
+    property_info = add_weekly_price(property_info)
     property_info["Source"] = "Domain"
     property_info["Available"] = ""
+    pmet.count("listings_domain", len(property_info))
     if get_details:
-        property_info = add_domain_detail_info(property_info)
+        property_info = add_domain_detail_info(property_info, previous, max_workers)
     return property_info
 
 
@@ -190,7 +448,7 @@ def create_realestate_url(requisition):
     east = requisition.get("east")
     page_size = 200  # It seems that the maximum number is 200 for the website.
     realestate_url = (
-        f"https://services.realestate.com.au/services/listings/search?query="
+        f"{REALESTATE_SEARCH_URL}?query="
         f'{{"channel":"rent","filters":{{"priceRange":{{"minimum":"{min_price}","maximum":"{max_price}"}},'
         f'"bedroomsRange":{{"minimum":"{min_bed}"}},"surroundingSuburbs":"true",'
         f'"excludeTier2":"true","geoPrecision":"address","excludeAddressHidden":'
@@ -202,91 +460,295 @@ def create_realestate_url(requisition):
 def request_realestate_properties(requisition, url=None):
     if url is None:
         url = create_realestate_url(requisition)
-    content = requests.get(url).json()
+    content = pph.get_json(url)
     return content, url
 
 
-def request_realestate_multipages(content, url):
+def get_realestate_page_urls(content, url):
     n_count = content["totalResultsCount"]
     page_size = int(content["resolvedQuery"]["pageSize"])
+    page_urls = []
     for page in range(2, int((n_count - 1) / page_size) + 2):
         if page == 11:
             warnings.warn("Number of Realestate properties exceeds maximum limit")
             continue
-        new_url = url[:-1] + ',"page":"' + str(page) + '"}'
-        page_content, _ = request_realestate_properties(None, url=new_url)
+        page_urls.append(url[:-1] + ',"page":"' + str(page) + '"}')
+    return page_urls
+
+
+def request_realestate_multipages(content, url, max_workers=1):
+    page_urls = get_realestate_page_urls(content, url)
+    for page_content in iter_pages(request_realestate_properties, page_urls, max_workers):
         content["tieredResults"][0]["results"].extend(
             page_content["tieredResults"][0]["results"]
         )
     return content
 
 
-def get_realestate_properties(requisition):
+def get_realestate_properties(requisition, max_workers=1):
     content, url = request_realestate_properties(requisition)
 
     # Quality control.
     if len(content["tieredResults"]) != 1:
         raise ValueError("Unexpected tier result count!")
+    page_urls = []
     if int(content["totalResultsCount"]) >= 200:
-        content = request_realestate_multipages(content, url)
-
-    # Read information.
-    property_info = []
-    for estate_web in content["tieredResults"][0]["results"]:
-        estate_info = dict()
-        estate_info["Url"] = estate_web["_links"]["prettyUrl"]["href"]
-        estate_info["Bedroom_num"] = estate_web["features"]["general"]["bedrooms"]
-        estate_info["Bathroom_num"] = estate_web["features"]["general"]["bathrooms"]
-        estate_info["Parking_num"] = estate_web["features"]["general"]["parkingSpaces"]
-        estate_info["Price"] = estate_web["price"]["display"]
-        estate_info["Type"] = estate_web["propertyType"].capitalize()
-        estate_info["Name"] = estate_web["address"]["streetAddress"]
-        estate_info["Room"], estate_info["Street"] = get_room_street(
-            estate_info["Name"], estate_info["Type"]
-        )
-        estate_info["Suburb"] = (
-            "".join(estate_web["address"]["suburb"].split(" ")).lower().capitalize()
-        )
-        estate_info["State"] = estate_web["address"]["state"].upper()
-        estate_info["Latitude"] = estate_web["address"]["location"]["latitude"]
-        estate_info["Longitude"] = estate_web["address"]["location"]["longitude"]
-        estate_info["Available"] = estate_web["dateAvailable"]["date"]
-        estate_info["Images"] = estate_web["images"]
-        if estate_info["Room"] != "":
-            estate_info["PID"] = (
-                f"{estate_info['Room']}_{estate_info['Street']}_{estate_info['Suburb']}_"
-                f"{estate_info['State']}"
-            )
-        property_info.append(estate_info)
-
-    property_info = pd.DataFrame(property_info)
+        page_urls = get_realestate_page_urls(content, url)
+
+    # Read information, parsing each page as it arrives.
+    pages = iter_pages(request_realestate_properties, page_urls, max_workers)
+    property_info = parse_realestate_pages(itertools.chain([content], pages))
+    property_info = add_room_street_pid(property_info, after="Name")
+    property_info = add_weekly_price(property_info)
     property_info["Source"] = "Realestate"
+    pmet.count("listings_realestate", len(property_info))
+    return property_info
+
+
+def parse_weekly_price(price):
+    """
+    Weekly rent stated in a display price such as "$650 per week" or "$2,800 pcm", and its
+    Price_flag: "" for a single amount, PRICE_RANGE_FLAG or PRICE_NONE_FLAG.
+    """
+    if not isinstance(price, str):
+        return np.nan, PRICE_NONE_FLAG
+    text = price.lower()
+    flag = ""
+    match = PRICE_RANGE.search(text) or PRICE_AMOUNT.search(text)
+    if match is not None:
+        weeks = get_price_period(text, match.end())[0]
+        if match.re is PRICE_RANGE:
+            flag = PRICE_RANGE_FLAG
+    else:
+        for match in BARE_PRICE_AMOUNT.finditer(text):
+            weeks, start = get_price_period(text, match.end())
+            # Only a period right after a bare number makes it a price.
+            if start is not None and text[match.end() : start].strip() == "":
+                break
+        else:
+            return np.nan, PRICE_NONE_FLAG
+    weekly_price = float(match.group(1).replace(",", ""))
+    return round(weekly_price / (1 if weeks is None else weeks), 2), flag
+
+
+def get_price_period(text, end):
+    """
+    Weeks per period of the amount ending at end of text and where the period starts, (None,
+    None) when no period is stated before the next amount.
+    """
+    following = text[end:]
+    next_amount = re.search(r"\d", following)
+    if next_amount is not None:
+        following = following[: next_amount.start()]
+    nearest = (None, None)
+    for period, weeks in PRICE_PERIODS:
+        found = period.search(following)
+        if found is not None and (nearest[1] is None or found.start() < nearest[1] - end):
+            nearest = (weeks, end + found.start())
+    return nearest
+
+
+def get_weekly_price_columns(prices):
+    """Batch equivalent of parse_weekly_price over a column of prices."""
+    uniques = pd.unique(prices)
+    parsed = [parse_weekly_price(price) for price in uniques]
+    positions = pd.Index(uniques).get_indexer(prices)
+    weekly_price = np.array([x[0] for x in parsed], dtype="float64")[positions]
+    price_flag = np.array([x[1] for x in parsed], dtype=object)[positions]
+    return pd.DataFrame({"Weekly_price": weekly_price, "Price_flag": price_flag})
+
+
+def add_weekly_price(property_info):
+    """Add Weekly_price and Price_flag after the Price column."""
+    weekly_price = get_weekly_price_columns(property_info["Price"])
+    position = property_info.columns.get_loc("Price") + 1
+    property_info.insert(position, "Weekly_price", weekly_price["Weekly_price"].to_numpy())
+    property_info.insert(position + 1, "Price_flag", weekly_price["Price_flag"].to_numpy())
     return property_info
 
 
-def merge_realestate_domain_properties(rp, dp):
+def intern_images(images):
+    """Share the strings of image lists (urls, servers and keys) repeated across listings."""
+    if isinstance(images, str):
+        return sys.intern(images)
+    if isinstance(images, list):
+        return [intern_images(image) for image in images]
+    if isinstance(images, dict):
+        return {sys.intern(key): intern_images(value) for key, value in images.items()}
+    return images
+
+
+def compact_properties(properties):
+    """Store low-cardinality columns as categoricals, counts as float32 and intern image urls."""
+    properties = properties.copy(deep=False)
+    for col in CATEGORY_COLUMNS:
+        if col in properties.columns:
+            properties[col] = properties[col].astype("category")
+    for col in COUNT_COLUMNS:
+        if col in properties.columns:
+            properties[col] = pd.to_numeric(properties[col], errors="coerce").astype("float32")
+    if "Images" in properties.columns:
+        properties["Images"] = properties["Images"].map(intern_images)
+    return properties
+
+
+def get_object_size(value, seen):
+    """Size of value and of the strings, lists and dicts it holds, counting shared objects once."""
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(get_object_size(x, seen) for x in value)
+    elif isinstance(value, dict):
+        size += sum(get_object_size(k, seen) + get_object_size(v, seen) for k, v in value.items())
+    return size
+
+
+def get_memory_report(properties):
+    """Bytes used by each column of properties (including the objects it holds) and in total."""
+    columns = properties.memory_usage(index=True, deep=True).to_dict()
+    for col in properties.columns:
+        if properties[col].dtype == object:
+            seen = set()
+            columns[col] = sum(get_object_size(x, seen) for x in properties[col].to_numpy())
+            columns[col] += properties[col].to_numpy().nbytes
+    return {"columns": columns, "total": sum(columns.values())}
+
+
+def clear_duplicated_pid(properties):
+    """Unset PIDs shared by several listings of one portal."""
+    duplicated = properties["PID"].notna() & properties["PID"].duplicated(keep=False)
+    if not duplicated.any():
+        return properties, 0
+    properties = properties.copy()
+    properties.loc[duplicated, "PID"] = np.nan
+    return properties, int(duplicated.sum())
+
+
+def match_by_location(rp, dp, tolerance):
+    """
+    Pair Realestate and Domain listings with equal bedroom and bathroom counts lying within
+    tolerance metres of each other, through a grid of tolerance-sized cells.
+    Only pairs where neither listing has another candidate are kept, so units of one building
+    are not matched by guess, and two listings which both have a PID are never paired, since
+    their PIDs already tell them apart. Return the positions of the paired rows in rp and dp.
+    """
+    columns = ["Latitude", "Longitude", "Bedroom_num", "Bathroom_num"]
+    if len(rp) == 0 or len(dp) == 0 or not all(col in rp and col in dp for col in columns):
+        return np.array([], dtype=int), np.array([], dtype=int)
+    cell_lat = tolerance / 111320
+    cell_lon = cell_lat / np.cos(np.radians(np.nanmean(rp["Latitude"])))
+
+    def get_keys(properties):
+        values = properties[columns].to_numpy(dtype=float)
+        valid = ~np.isnan(values).any(axis=1)
+        cells = np.floor(values[:, :2] / [cell_lat, cell_lon]).astype(np.int64, copy=False)
+        return values, valid, cells
+
+    def get_has_pid(properties):
+        if "PID" not in properties:
+            return np.zeros(len(properties), dtype=bool)
+        return properties["PID"].notna().to_numpy()
+
+    r_has_pid, d_has_pid = get_has_pid(rp), get_has_pid(dp)
+    d_values, d_valid, d_cells = get_keys(dp)
+    grid = dict()
+    for j in np.flatnonzero(d_valid):
+        key = (d_cells[j, 0], d_cells[j, 1], d_values[j, 2], d_values[j, 3])
+        grid.setdefault(key, []).append(j)
+
+    r_values, r_valid, r_cells = get_keys(rp)
+    candidates = dict()
+    for i in np.flatnonzero(r_valid):
+        found = []
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                key = (r_cells[i, 0] + di, r_cells[i, 1] + dj, r_values[i, 2], r_values[i, 3])
+                found.extend(grid.get(key, []))
+        found = np.array(found, dtype=int)
+        if r_has_pid[i]:
+            found = found[~d_has_pid[found]]
+        if len(found) == 0:
+            continue
+        distance = 111320 * np.hypot(
+            d_values[found, 0] - r_values[i, 0],
+            (d_values[found, 1] - r_values[i, 1]) * cell_lat / cell_lon,
+        )
+        found = found[distance <= tolerance]
+        if len(found) > 0:
+            candidates[i] = found
+
+    # Keep mutually unique pairs.
+    n_claims = np.bincount(
+        np.concatenate([x for x in candidates.values()] + [np.array([], dtype=int)]),
+        minlength=len(dp),
+    )
+    pairs = [(i, found[0]) for i, found in candidates.items() if len(found) == 1]
+    pairs = [(i, j) for i, j in pairs if n_claims[j] == 1]
+    r_pos = np.array([i for i, _ in pairs], dtype=int)
+    d_pos = np.array([j for _, j in pairs], dtype=int)
+    return r_pos, d_pos
+
+
+@pmet.timed("merge")
+def merge_realestate_domain_properties(
+    rp, dp, geo_tolerance=GEO_MATCH_TOLERANCE, match_stats=None
+):
+    """
+    Merge the listings of both portals, joining them on PID first. Listings left unmatched
+    are paired by location (see match_by_location) unless geo_tolerance is None.
+    Match counts are stored in the match_stats dict if given.
+    """
     # Check ID availability.
-    if rp.PID.dropna().duplicated().any() or dp.PID.dropna().duplicated().any():
+    rp, r_duplicated = clear_duplicated_pid(rp)
+    dp, d_duplicated = clear_duplicated_pid(dp)
+    if r_duplicated + d_duplicated > 0:
         warnings.warn("Duplicated property found!")
-        dup_indices = rp.dropna()[rp.PID.dropna().duplicated(keep=False)].index
-        rp.loc[dup_indices, "PID"] = np.nan
-        dup_indices = dp.dropna()[dp.PID.dropna().duplicated(keep=False)].index
-        dp.loc[dup_indices, "PID"] = np.nan
-    rp_pid = set(rp.PID.dropna())
-    dp_pid = set(dp.PID.dropna())
-    both_pid = rp_pid & dp_pid
-    ronly_pid = rp_pid - dp_pid
-    donly_pid = dp_pid - rp_pid
+
+    # Join on PID.
+    r_pid = rp["PID"].to_numpy(dtype=object, copy=True)
+    d_pid = dp["PID"].to_numpy(dtype=object)
+    r_matched = pd.Index(d_pid[pd.notna(d_pid)]).get_indexer(r_pid) >= 0
+    d_matched = pd.Index(r_pid[pd.notna(r_pid)]).get_indexer(d_pid) >= 0
+    n_pid_matched = int(r_matched.sum())
+
+    # Pair the remaining listings by location.
+    both_pid = r_pid
+    if geo_tolerance is not None:
+        r_left = np.flatnonzero(~r_matched)
+        d_left = np.flatnonzero(~d_matched)
+        r_pos, d_pos = match_by_location(rp.iloc[r_left], dp.iloc[d_left], geo_tolerance)
+        r_pos, d_pos = r_left[r_pos], d_left[d_pos]
+        r_matched[r_pos] = True
+        d_matched[d_pos] = True
+        # Keep the Domain PID when Realestate has none.
+        missing = pd.isna(both_pid[r_pos])
+        both_pid[r_pos[missing]] = d_pid[d_pos[missing]]
 
     # Create merged property data.
-    both = rp.query("PID in @both_pid").copy()
+    both = rp[r_matched].copy()
+    both["PID"] = both_pid[r_matched]
     both["Source"] = "Both"
-    rsource = rp[rp["PID"].isin(ronly_pid) | rp["PID"].isna()]
-    dsource = dp[dp["PID"].isin(donly_pid) | dp["PID"].isna()]
+    rsource = rp[~r_matched]
+    dsource = dp[~d_matched]
     merge_p = pd.concat([both, rsource, dsource], ignore_index=True).sort_values(
         ["Street", "Room"]
     )
     indices = merge_p["PID"].fillna(merge_p["Url"])
     indices.name = ""
     merge_p.index = indices
+    merge_p = compact_properties(merge_p)
+    if match_stats is not None:
+        match_stats.update(
+            {
+                "realestate": len(rp),
+                "domain": len(dp),
+                "duplicated_pid": r_duplicated + d_duplicated,
+                "pid_matched": n_pid_matched,
+                "geo_matched": len(both) - n_pid_matched,
+                "realestate_only": len(rsource),
+                "domain_only": len(dsource),
+            }
+        )
     return merge_p
@@ -0,0 +1,162 @@
+import json
+import random
+import signal
+import sys
+import threading
+import time
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import client as emr
+import property_http as pph
+
+# Settings of a profile which are not given in the profile file.
+PROFILE_DEFAULTS = {"interval": 3600, "init_ignore": None, "max_workers": 1, "get_details": False}
+# Each run is shifted by up to this fraction of the profile interval, so profiles sharing an
+# interval do not hit the portals at the same time.
+SCHEDULE_JITTER = 0.1
+# Portal response time in seconds above which runs are postponed and fewer run at once.
+SLOW_LATENCY = 5.0
+MAX_SLOWDOWN = 8.0
+# Longest time in seconds the scheduler sleeps before checking for a stop request.
+POLL_INTERVAL = 1.0
+
+
+def load_profiles(path):
+    """
+    Read named search profiles from a JSON file, e.g.
+    {"carlton": {"folder": "carlton/", "requisition": {...}, "interval": 3600}}.
+    """
+    with open(path, "r") as f:
+        profiles = json.load(f)
+    folders = dict()
+    for name, profile in profiles.items():
+        for key in ("folder", "requisition"):
+            if key not in profile:
+                raise ValueError(f"Profile {name} has no {key}.")
+        if profile["folder"] in folders:
+            raise ValueError(f"Profiles {folders[profile['folder']]} and {name} share a folder.")
+        folders[profile["folder"]] = name
+        profiles[name] = {**PROFILE_DEFAULTS, **profile}
+    return profiles
+
+
+def run_profile(profile):
+    return emr.monitor_properties(
+        profile["folder"],
+        profile["requisition"],
+        profile["init_ignore"],
+        profile["max_workers"],
+        profile["get_details"],
+    )
+
+
+def get_slowdown(latency=None):
+    """Factor by which intervals are stretched while the portals answer slower than SLOW_LATENCY."""
+    if latency is None:
+        latency = pph.get_latency()
+    if latency is None or latency <= SLOW_LATENCY:
+        return 1.0
+    return min(MAX_SLOWDOWN, latency / SLOW_LATENCY)
+
+
+def get_next_delay(interval, jitter=SCHEDULE_JITTER, slowdown=1.0):
+    return interval * slowdown * (1 + random.uniform(-jitter, jitter))
+
+
+def install_stop_handlers(stop_event):
+    """Set stop_event on SIGINT and SIGTERM instead of interrupting a running update."""
+    def handler(signum, frame):
+        stop_event.set()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, handler)
+
+
+def run_scheduler(
+    profiles,
+    max_workers=4,
+    requests_per_second=None,
+    stop_event=None,
+    jitter=SCHEDULE_JITTER,
+    max_runs=None,
+    run_report=None,
+    run=run_profile,
+):
+    """
+    Run every profile every interval seconds, up to max_workers profiles at once, until
+    stop_event is set (or each profile ran max_runs times).
+    All profiles share a budget of requests_per_second portal requests. While the portals slow
+    down, intervals are stretched and fewer profiles run at once.
+    On stop, no new run is started and the running ones are completed, so no tracker is left
+    half updated.
+    Each run is recorded in run_report as {"profile", "start", "time", "error"}.
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+    previous_budget = None
+    if requests_per_second is not None:
+        previous_budget = pph.set_request_budget(pph.RequestBudget(requests_per_second))
+
+    now = time.monotonic()
+    # The first runs are spread over the jitter window.
+    due = {
+        name: now + random.uniform(0, jitter) * profile["interval"]
+        for name, profile in profiles.items()
+    }
+    runs = {name: 0 for name in profiles}
+    running = dict()
+
+    def timed_run(name):
+        start = time.time()
+        error = None
+        try:
+            run(profiles[name])
+        except Exception as e:  # A failed run must not stop the other profiles.
+            error = repr(e)
+            warnings.warn(f"Profile {name} failed: {error}")
+        return {"profile": name, "start": start, "time": time.time() - start, "error": error}
+
+    try:
+        with ThreadPoolExecutor(max_workers) as executor:
+            while not stop_event.is_set():
+                if max_runs is not None and len(running) == 0 and all(
+                    n >= max_runs for n in runs.values()
+                ):
+                    break
+                slowdown = get_slowdown()
+                allowed = max(1, int(max_workers / slowdown))
+                now = time.monotonic()
+                for name in sorted(due, key=due.get):
+                    if len(running) >= allowed or due[name] > now:
+                        break
+                    running[executor.submit(timed_run, name)] = name
+                    del due[name]
+
+                next_due = min(due.values(), default=now + POLL_INTERVAL)
+                timeout = min(POLL_INTERVAL, max(0.0, next_due - now))
+                if len(running) == 0:
+                    stop_event.wait(timeout)
+                    continue
+                done = wait(running, timeout, return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    name = running.pop(future)
+                    runs[name] += 1
+                    if run_report is not None:
+                        run_report.append(future.result())
+                    if max_runs is None or runs[name] < max_runs:
+                        due[name] = time.monotonic() + get_next_delay(
+                            profiles[name]["interval"], jitter, get_slowdown()
+                        )
+            for future in running:
+                if run_report is not None:
+                    run_report.append(future.result())
+    finally:
+        if requests_per_second is not None:
+            pph.set_request_budget(previous_budget)
+    return run_report
+
+
+if __name__ == "__main__":
+    stop = threading.Event()
+    install_stop_handlers(stop)
+    run_scheduler(load_profiles(sys.argv[1]), stop_event=stop)
@@ -0,0 +1,163 @@
+import json
+import sqlite3
+import property_events as ppe
+import property_monitor as ppm
+import property_query as ppq
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS properties (
+    pid TEXT PRIMARY KEY, name TEXT, room TEXT, street TEXT, suburb TEXT, state TEXT,
+    type TEXT, bedroom_num REAL, bathroom_num REAL, latitude REAL, longitude REAL
+);
+CREATE TABLE IF NOT EXISTS price_history (
+    pid TEXT NOT NULL, time TEXT NOT NULL, price TEXT, weekly_price REAL, PRIMARY KEY (pid, time)
+);
+CREATE TABLE IF NOT EXISTS listing_details (
+    pid TEXT NOT NULL, time TEXT NOT NULL, parking_num REAL, available TEXT, images TEXT,
+    PRIMARY KEY (pid, time)
+);
+CREATE TABLE IF NOT EXISTS listing_intervals (
+    pid TEXT NOT NULL, listing_date TEXT NOT NULL, offlist_date TEXT,
+    PRIMARY KEY (pid, listing_date)
+);
+CREATE INDEX IF NOT EXISTS properties_suburb ON properties (suburb);
+CREATE INDEX IF NOT EXISTS properties_street ON properties (street);
+CREATE INDEX IF NOT EXISTS price_history_time ON price_history (time);
+CREATE INDEX IF NOT EXISTS price_history_weekly_price ON price_history (weekly_price);
+CREATE INDEX IF NOT EXISTS listing_intervals_dates ON listing_intervals (listing_date, offlist_date);
+CREATE INDEX IF NOT EXISTS listing_intervals_open ON listing_intervals (pid, offlist_date);
+"""
+PROPERTY_COLUMNS = [
+    "Name",
+    "Room",
+    "Street",
+    "Suburb",
+    "State",
+    "Type",
+    "Bedroom_num",
+    "Bathroom_num",
+    "Latitude",
+    "Longitude",
+]
+
+
+def connect_property_database(path):
+    """SQLite counterpart of the property JSON database."""
+    conn = sqlite3.connect(path)
+    # Databases created before prices were parsed.
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(price_history)")]
+    if len(columns) > 0 and "weekly_price" not in columns:
+        conn.execute("ALTER TABLE price_history ADD COLUMN weekly_price REAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def apply_property_events(conn, events):
+    """Apply listing events (see property_events.make_events) in a single transaction."""
+    properties = []
+    prices = []
+    details = []
+    listings = []
+    offlists = []
+    for event in events:
+        pid = event["pid"]
+        if pid[:5] == "https":  # Listing without PID.
+            continue
+        current_time = event["time"]
+        fields = event.get("fields", dict())
+        if event["event"] == "listed":
+            properties.append([pid] + [fields.get(col) for col in PROPERTY_COLUMNS])
+            details.append(
+                (
+                    pid,
+                    current_time,
+                    fields.get("Parking_num"),
+                    fields.get("Available"),
+                    json.dumps(fields.get("Images")),
+                )
+            )
+            listings.append((pid, current_time))
+        elif event["event"] == "delisted":
+            offlists.append((current_time, pid))
+        # Changed events hold the full listing, of which only the previous fields changed.
+        changes = event.get("previous", fields)
+        if "Price" in changes or "Weekly_price" in changes:
+            weekly_price = fields.get("Weekly_price")
+            if "Weekly_price" not in fields:  # Logged before prices were parsed.
+                weekly_price = ppq.parse_weekly_price(fields["Price"])[0]
+            prices.append(
+                (pid, current_time, fields.get("Price"), ppe.to_json_value(weekly_price))
+            )
+
+    with conn:
+        conn.executemany(
+            f"INSERT OR REPLACE INTO properties VALUES ({', '.join(['?'] * 11)})", properties
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO price_history (pid, time, price, weekly_price) "
+            "VALUES (?, ?, ?, ?)",
+            prices,
+        )
+        conn.executemany("INSERT OR REPLACE INTO listing_details VALUES (?, ?, ?, ?, ?)", details)
+        conn.executemany(
+            "INSERT OR IGNORE INTO listing_intervals VALUES (?, ?, NULL)", listings
+        )
+        conn.executemany(
+            "UPDATE listing_intervals SET offlist_date = ? WHERE pid = ? AND offlist_date IS NULL",
+            offlists,
+        )
+    return conn
+
+
+def init_property_sqlite(conn, current_list, current_time):
+    listed = {"new": set(current_list.index), "passed": set(), "changed": None}
+    return apply_property_events(conn, ppe.make_events(listed, current_list, current_time))
+
+
+def updates_property_sqlite(conn, current_list, previous_list, current_time):
+    update_dict = ppm.diff_property_info(previous_list, current_list)
+    return apply_property_events(conn, ppe.make_events(update_dict, current_list, current_time))
+
+
+def load_property_sqlite(conn, folder):
+    """Load the event log of a monitor folder into the database."""
+    return apply_property_events(conn, ppe.read_events(folder))
+
+
+def get_price_history(conn, pid):
+    return conn.execute(
+        "SELECT time, price FROM price_history WHERE pid = ? ORDER BY time", (pid,)
+    ).fetchall()
+
+
+def get_listing_intervals(conn, pid):
+    return conn.execute(
+        "SELECT listing_date, offlist_date FROM listing_intervals WHERE pid = ? "
+        "ORDER BY listing_date",
+        (pid,),
+    ).fetchall()
+
+
+def get_active_listings(conn, date, suburb=None):
+    """PIDs listed at date (same format as the log times), in suburb if given."""
+    query = (
+        "SELECT l.pid FROM listing_intervals l JOIN properties p ON p.pid = l.pid "
+        "WHERE l.listing_date <= ? AND (l.offlist_date IS NULL OR l.offlist_date > ?)"
+    )
+    params = [date, date]
+    if suburb is not None:
+        query += " AND p.suburb = ?"
+        params.append(suburb)
+    return [row[0] for row in conn.execute(query + " ORDER BY l.pid", params)]
+
+
+def get_weekly_price_range(conn, low, high):
+    """PIDs which were ever listed for a weekly price between low and high."""
+    return [
+        row[0]
+        for row in conn.execute(
+            "SELECT DISTINCT pid FROM price_history WHERE weekly_price BETWEEN ? AND ? "
+            "ORDER BY pid",
+            (low, high),
+        )
+    ]
@@ -1,8 +1,33 @@
 """Testing code."""
 
+import copy
+import http.server
+import importlib.util
+import json
+import os
 import tempfile
+import threading
+import time
 import unittest
+import warnings
+from unittest import mock
+import numpy as np
+import pandas as pd
+import requests
+import benchmark as bench
 import client as emr
+import property_cache as pcache
+import property_database as ppd
+import property_events as ppe
+import property_geo as pgeo
+import property_http as pph
+import property_json as ppj
+import property_metrics as pmet
+import property_monitor as ppm
+import property_notify as pnot
+import property_query as ppq
+import property_scheduler as psch
+import property_sqlite as pps
 
 
 class TestTuning(unittest.TestCase):
@@ -88,3 +113,1389 @@ class TestTuning(unittest.TestCase):
                 result = sorted(f.read().split(","))
             expect = ["b_1"]
             self.assertEqual(expect, result)
+
+
+def fake_realestate_page(page, page_size=200, n_count=1000):
+    results = [{"id": f"{page}_{i}"} for i in range(page_size)]
+    return {
+        "totalResultsCount": n_count,
+        "resolvedQuery": {"pageSize": str(page_size)},
+        "tieredResults": [{"results": results}],
+    }
+
+
+def fake_domain_page(page, total_pages=5):
+    return {
+        "props": {
+            "pageViewMetadata": {
+                "searchResponse": {"SearchResults": {"totalPages": total_pages}}
+            },
+            "listingsMap": {f"{page}_{i}": {"page": page} for i in range(3)},
+        }
+    }
+
+
+def fake_request(page_func, page_key):
+    def request(requisition, url=None):
+        page = int(url.split(page_key)[-1].strip('"}'))
+        time.sleep(0.01 * (6 - page % 5))  # Later pages return first.
+        return page_func(page), url
+    return request
+
+
+class TestMultipages(unittest.TestCase):
+    def test_01_realestate_concurrent_order(self):
+        url = '{"pageSize":"200"}'
+        request = fake_request(fake_realestate_page, '"page":"')
+        with mock.patch.object(ppq, "request_realestate_properties", request):
+            serial = ppq.request_realestate_multipages(fake_realestate_page(1), url)
+            concurrent = ppq.request_realestate_multipages(
+                fake_realestate_page(1), url, max_workers=4
+            )
+        self.assertEqual(1000, len(serial["tieredResults"][0]["results"]))
+        self.assertEqual(serial, concurrent)
+
+    def test_02_domain_concurrent_order(self):
+        url = "https://www.domain.com.au/rent/?displaymap=0"
+        request = fake_request(fake_domain_page, "&page=")
+        with mock.patch.object(ppq, "request_domain_properties", request):
+            serial = ppq.request_domain_multipages(fake_domain_page(1), url)
+            concurrent = ppq.request_domain_multipages(fake_domain_page(1), url, 4)
+        self.assertEqual(15, len(serial["props"]["listingsMap"]))
+        self.assertEqual(
+            list(serial["props"]["listingsMap"]), list(concurrent["props"]["listingsMap"])
+        )
+
+
+def fake_properties(source, requisition):
+    chunk = int(requisition["north"])
+    rows = []
+    for i in range(3):
+        rows.append(
+            {
+                "Url": f"https://{source}/{chunk}_{i}",
+                "Price": f"${500 + i} per week",
+                "Room": str(i + 1),
+                "Street": f"{chunk}Flemington",
+                "PID": f"{i + 1}_{chunk}Flemington_Carlton_VIC",
+                "Source": source,
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def fake_portal_query(source, failed_chunk=None):
+    def query(requisition, max_workers=1):
+        if int(requisition["north"]) == failed_chunk:
+            raise ConnectionError("Portal unavailable")
+        time.sleep(0.01 * (4 - int(requisition["north"])))
+        return fake_properties(source, requisition)
+    return query
+
+
+class TestMultiChunk(unittest.TestCase):
+    def setUp(self):
+        self.requisitions = [{"north": i} for i in range(4)]
+
+    def test_01_parallel_matches_serial(self):
+        with mock.patch.object(
+            ppq, "get_realestate_properties", fake_portal_query("Realestate")
+        ), mock.patch.object(ppq, "get_domain_properties", fake_portal_query("Domain")):
+            serial = ppd.query_multi_chunk_properties(self.requisitions)
+            parallel = ppd.query_multi_chunk_properties(
+                self.requisitions, max_workers=4, max_inflight=2
+            )
+        pd.testing.assert_frame_equal(serial, parallel)
+        self.assertTrue((serial["Source"] == "Both").all())
+
+    def test_02_failed_chunk_isolated(self):
+        report = []
+        with mock.patch.object(
+            ppq, "get_realestate_properties", fake_portal_query("Realestate", 2)
+        ), mock.patch.object(ppq, "get_domain_properties", fake_portal_query("Domain")):
+            with self.assertWarns(UserWarning):
+                result = ppd.query_multi_chunk_properties(
+                    self.requisitions, max_workers=4, chunk_report=report
+                )
+        self.assertEqual(12, len(result))
+        self.assertEqual(3, (result["Source"] == "Domain").sum())
+        self.assertIn("ConnectionError", report[2]["Realestate"]["error"])
+        self.assertIsNone(report[2]["Domain"]["error"])
+        self.assertEqual(3, report[0]["Realestate"]["count"])
+
+    def test_03_process_sweep(self):
+        report = []
+        with mock.patch.object(
+            ppq, "get_realestate_properties", fake_portal_query("Realestate", 2)
+        ), mock.patch.object(ppq, "get_domain_properties", fake_portal_query("Domain")):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                threads = ppd.query_multi_chunk_properties(self.requisitions, max_workers=4)
+                result = ppd.query_multi_chunk_properties(
+                    self.requisitions, max_workers=2, chunk_report=report, processes=True
+                )
+        pd.testing.assert_frame_equal(threads, result)
+        self.assertIn("ConnectionError", report[2]["Realestate"]["error"])
+
+    def test_04_columnar_round_trip(self):
+        properties = fake_properties("Realestate", {"north": 0})
+        properties["Images"] = [["https://i/1.jpg"], [], "https://i/3.jpg"]
+        properties["Bedroom_num"] = [1.0, np.nan, 2.0]
+        pd.testing.assert_frame_equal(properties, ppd.from_columnar(ppd.to_columnar(properties)))
+
+    def test_05_resume_from_checkpoints(self):
+        queried = []
+
+        def counted(query):
+            def counted_query(requisition, max_workers=1):
+                queried.append(requisition["north"])
+                return query(requisition, max_workers)
+            return counted_query
+
+        with mock.patch.object(
+            ppq, "get_realestate_properties", fake_portal_query("Realestate")
+        ), mock.patch.object(ppq, "get_domain_properties", fake_portal_query("Domain")):
+            expect = ppd.query_multi_chunk_properties(self.requisitions, max_workers=4)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.object(
+                ppq, "get_realestate_properties", fake_portal_query("Realestate", 2)
+            ), mock.patch.object(ppq, "get_domain_properties", fake_portal_query("Domain")):
+                with self.assertWarns(UserWarning):
+                    ppd.query_multi_chunk_properties(
+                        self.requisitions, max_workers=4, checkpoint_dir=tmpdir
+                    )
+            checkpoint = ppd.get_sweep_checkpoint(tmpdir, self.requisitions)
+            status = ppd.read_sweep_status(checkpoint)
+            self.assertIn("ConnectionError", status["2_Realestate"]["error"])
+            self.assertEqual(3, status["2_Domain"]["count"])
+
+            report = []
+            with mock.patch.object(
+                ppq, "get_realestate_properties", counted(fake_portal_query("Realestate"))
+            ), mock.patch.object(
+                ppq, "get_domain_properties", counted(fake_portal_query("Domain"))
+            ):
+                result = ppd.query_multi_chunk_properties(
+                    self.requisitions, max_workers=4, chunk_report=report, checkpoint_dir=tmpdir
+                )
+            self.assertEqual([2], queried)
+            self.assertFalse(os.path.exists(checkpoint))
+        pd.testing.assert_frame_equal(expect, result)
+        self.assertEqual(3, report[2]["Realestate"]["count"])
+
+    def test_06_complete_sweep_refetches(self):
+        queried = []
+
+        def counted(query):
+            def counted_query(requisition, max_workers=1):
+                queried.append(requisition["north"])
+                return query(requisition, max_workers)
+            return counted_query
+
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.object(
+            ppq, "get_realestate_properties", counted(fake_portal_query("Realestate"))
+        ), mock.patch.object(ppq, "get_domain_properties", counted(fake_portal_query("Domain"))):
+            first = ppd.query_multi_chunk_properties(self.requisitions, checkpoint_dir=tmpdir)
+            self.assertFalse(os.path.exists(ppd.get_sweep_checkpoint(tmpdir, self.requisitions)))
+            second = ppd.query_multi_chunk_properties(self.requisitions, checkpoint_dir=tmpdir)
+        self.assertEqual(16, len(queried))
+        pd.testing.assert_frame_equal(first, second)
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """Fail the first request of every path with 503, then return its path as JSON."""
+
+    seen = set()
+
+    def do_GET(self):
+        if self.path not in self.seen:
+            self.seen.add(self.path)
+            self.send_response(503)
+            self.end_headers()
+            return
+        body = json.dumps({"path": self.path}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        return
+
+
+class TestHttpSession(unittest.TestCase):
+    def setUp(self):
+        FlakyHandler.seen = set()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_01_retry_transient_error(self):
+        session = pph.make_session(retries=2, backoff=0.01, jitter=0.01)
+        content = pph.get_json(self.base_url + "/a", session=session)
+        self.assertEqual({"path": "/a"}, content)
+
+    def test_02_no_retry_raises(self):
+        session = pph.make_session(retries=0)
+        with self.assertRaises(requests.HTTPError):
+            pph.get_json(self.base_url + "/b", session=session)
+
+    def test_03_shared_session(self):
+        session = pph.make_session(retries=1, backoff=0.01, jitter=0)
+        previous = pph.set_session(session)
+        try:
+            content, _ = ppq.request_realestate_properties(None, url=self.base_url + "/c")
+        finally:
+            pph.set_session(previous)
+        self.assertEqual({"path": "/c"}, content)
+
+    def test_04_response_cache(self):
+        session = pph.make_session(retries=1, backoff=0.01, jitter=0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = pcache.ResponseCache(f"{tmpdir}/cache.sqlite")
+            previous = pph.set_cache(cache)
+            try:
+                first = pph.get_json(self.base_url + "/d", session=session)
+                self.server.shutdown()
+                second = pph.get_json(self.base_url + "/d", session=session)
+            finally:
+                pph.set_cache(previous)
+                cache.close()
+        self.assertEqual(first, second)
+        self.assertEqual(1, cache.hits)
+
+    def test_05_request_metrics(self):
+        session = pph.make_session(retries=2, backoff=0.01, jitter=0)
+        pmet.reset()
+        previous = pmet.enable()
+        try:
+            pph.get_json(self.base_url + "/e", session=session)
+        finally:
+            pmet.enable(previous)
+        counters = pmet.get_report()["counters"]
+        self.assertEqual(1, counters["http_requests"])
+        self.assertEqual(1, counters["http_retries"])
+        self.assertEqual(len(json.dumps({"path": "/e"})), counters["http_bytes"])
+
+    def test_06_worker_settings(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = pcache.ResponseCache(f"{tmpdir}/cache.sqlite", max_bytes=2**20)
+            with mock.patch.object(pph, "HOST_MIN_INTERVAL", 0.5), mock.patch.object(
+                pph, "_budget", pph.RequestBudget(8, 4)
+            ), mock.patch.object(pph, "_cache", cache), mock.patch.object(
+                pph, "_session", pph.get_session()
+            ):
+                previous_limit = pph.set_max_inflight(8)
+                try:
+                    settings = pph.get_worker_settings(4)
+                    pph.init_worker(settings)
+                    self.assertEqual(2.0, pph.HOST_MIN_INTERVAL)
+                    self.assertEqual((2, 1), (pph._budget.rate, pph._budget.burst))
+                    self.assertEqual(2, pph._inflight_limit)
+                    self.assertIsNot(cache, pph._cache)
+                    self.assertEqual(cache.get_settings(), pph._cache.get_settings())
+                    self.assertIsNone(pph._session)
+                    pph._cache.close()
+                finally:
+                    pph.set_max_inflight(previous_limit)
+            cache.close()
+
+    def test_07_retry_jitter(self):
+        retry = pph.JitterRetry(total=3, backoff_factor=1.0, jitter=0.5)
+        retry = retry.increment("GET", "/a").increment("GET", "/a")
+        self.assertEqual(0.5, retry.jitter)
+        backoff = retry.get_backoff_time()
+        self.assertTrue(2.0 <= backoff <= 2.5, backoff)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = f"{self.tmpdir.name}/cache.sqlite"
+        self.search_url = "https://www.domain.com.au/rent/?bedrooms=1-any"
+        self.detail_url = "https://www.domain.com.au/907-83-flemington-road-1"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_01_endpoint_ttl(self):
+        cache = pcache.ResponseCache(self.path, ttls={"search": -1, "detail": 60})
+        cache.put(self.search_url, "{}")
+        cache.put(self.detail_url, "{}")
+        self.assertIsNone(cache.get(self.search_url))
+        self.assertEqual("{}", cache.get(self.detail_url))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        cache.close()
+
+    def test_02_lru_eviction(self):
+        cache = pcache.ResponseCache(self.path, max_bytes=20)
+        cache.put(self.detail_url + "1", "a" * 8)
+        cache.put(self.detail_url + "2", "b" * 8)
+        time.sleep(0.01)
+        cache.get(self.detail_url + "1")
+        cache.put(self.detail_url + "3", "c" * 8)
+        self.assertIsNone(cache.get(self.detail_url + "2"))
+        self.assertIsNotNone(cache.get(self.detail_url + "1"))
+        self.assertEqual(2, cache.stats()["entries"])
+        self.assertEqual(16, cache.stats()["bytes"])
+        cache.close()
+
+    def test_03_offline_replay(self):
+        cache = pcache.ResponseCache(self.path, ttls={"search": -1})
+        cache.put(self.search_url, "{}")
+        cache.close()
+        cache = pcache.ResponseCache(self.path, offline=True)
+        self.assertEqual("{}", cache.get(self.search_url))
+        with self.assertRaises(pcache.OfflineCacheMiss):
+            cache.get(self.detail_url)
+        cache.close()
+
+
+def fake_domain_detail(url, headers=None):
+    return {
+        "props": {
+            "listingSummary": {"stats": [{"key": "availableFrom", "value": "Now"}]},
+            "gallery": {"slides": [url + "/floorplan"]},
+        }
+    }
+
+
+class TestDomainDetails(unittest.TestCase):
+    def test_01_incremental_details(self):
+        current = pd.DataFrame(
+            {
+                "Url": ["https://d/1", "https://d/2", "https://d/3"],
+                "Price": ["$500", "$650", "$700"],
+                "Source": "Domain",
+            }
+        )
+        previous = pd.DataFrame(
+            {
+                "Url": ["https://d/1", "https://d/2"],
+                "Price": ["$500", "$600"],
+                "Source": "Domain",
+                "Available": ["Tue 01 Mar", "Now"],
+                "Images": [["https://d/1/old"], ["https://d/2/old"]],
+            }
+        )
+        with mock.patch.object(pph, "get_json", side_effect=fake_domain_detail) as get:
+            result = ppq.add_domain_detail_info(current, previous, max_workers=2)
+        fetched = sorted(call.args[0] for call in get.call_args_list)
+        self.assertEqual(["https://d/2", "https://d/3"], fetched)
+        self.assertEqual(["Tue 01 Mar", "Now", "Now"], list(result["Available"]))
+        self.assertEqual(["https://d/1/old"], result["Images"].iloc[0])
+        self.assertEqual(["https://d/2/floorplan"], result["Images"].iloc[1])
+
+    def test_02_listing_on_both_portals(self):
+        current = pd.DataFrame(
+            {
+                "Url": ["https://d/1", "https://d/2"],
+                "Price": ["$520", "$650"],
+                "Source": "Domain",
+                "PID": ["1_83Flemington_Parkville_VIC", np.nan],
+            }
+        )
+        # Both rows keep the Realestate Url and Price.
+        previous = pd.DataFrame(
+            {
+                "Url": ["https://r/1"],
+                "Price": ["$500 per week"],
+                "Source": pd.Categorical(["Both"]),
+                "Available": ["2021-09-01"],
+                "Images": [["https://r/1.jpg"]],
+            },
+            index=["1_83Flemington_Parkville_VIC"],
+        )
+        with mock.patch.object(pph, "get_json", side_effect=fake_domain_detail) as get:
+            result = ppq.add_domain_detail_info(current, previous)
+        self.assertEqual(["https://d/2"], [call.args[0] for call in get.call_args_list])
+        self.assertEqual(["2021-09-01", "Now"], list(result["Available"]))
+        self.assertEqual(["https://r/1.jpg"], result["Images"].iloc[0])
+
+
+class TestAdaptiveChunks(unittest.TestCase):
+    def setUp(self):
+        self.requisition = {"min_bed": 1, "north": -37.0, "west": 144.0, "south": -38.0, "east": 145.0}
+
+    @staticmethod
+    def probe(requisition):
+        # Saturated while the box holds the CBD point and is larger than 1/8 degree.
+        contains = (requisition["south"] <= -37.8 <= requisition["north"]) and (
+            requisition["west"] <= 144.95 <= requisition["east"]
+        )
+        return contains and requisition["north"] - requisition["south"] > 0.125
+
+    def test_01_split_saturated_only(self):
+        req_list = ppd.make_adaptive_chunk_requisitions(self.requisition, probe=self.probe)
+        self.assertEqual(10, len(req_list))
+        area = sum((r["north"] - r["south"]) * (r["east"] - r["west"]) for r in req_list)
+        self.assertAlmostEqual(1.0, area)
+        self.assertTrue(all(r["min_bed"] == 1 for r in req_list))
+        self.assertFalse(any(self.probe(r) for r in req_list))
+
+    def test_02_reuse_partition(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            partition_file = f"{tmpdir}/partition.json"
+            learned = ppd.make_adaptive_chunk_requisitions(
+                self.requisition, partition_file=partition_file, probe=self.probe
+            )
+            probe = mock.Mock(side_effect=self.probe)
+            reused = ppd.make_adaptive_chunk_requisitions(
+                self.requisition, partition_file=partition_file, probe=probe
+            )
+            # Only the chunks are probed again.
+            self.assertEqual(len(learned), probe.call_count)
+            probe = mock.Mock(side_effect=self.probe)
+            ppd.make_adaptive_chunk_requisitions(
+                {**self.requisition, "min_bed": 2}, partition_file=partition_file, probe=probe
+            )
+            # Other filters saturate differently, so the partition is learned again.
+            self.assertGreater(probe.call_count, len(learned))
+        self.assertEqual(learned, reused)
+
+    def test_03_split_reused_saturated_chunk(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            partition_file = f"{tmpdir}/partition.json"
+            learned = ppd.make_adaptive_chunk_requisitions(
+                self.requisition, partition_file=partition_file, probe=self.probe
+            )
+            # Listings added since saturate the chunks holding another point.
+            def probe(req):
+                contains = (req["south"] <= -37.3 <= req["north"]) and (
+                    req["west"] <= 144.3 <= req["east"]
+                )
+                return self.probe(req) or (contains and req["north"] - req["south"] > 0.25)
+
+            resplit = ppd.make_adaptive_chunk_requisitions(
+                self.requisition, partition_file=partition_file, probe=probe
+            )
+            self.assertEqual(
+                resplit,
+                ppd.make_adaptive_chunk_requisitions(
+                    self.requisition, partition_file=partition_file, probe=probe
+                ),
+            )
+        self.assertGreater(len(resplit), len(learned))
+        self.assertFalse(any(probe(r) for r in resplit))
+        area = sum((r["north"] - r["south"]) * (r["east"] - r["west"]) for r in resplit)
+        self.assertAlmostEqual(1.0, area)
+
+
+class TestDiff(unittest.TestCase):
+    def test_01_matches_legacy(self):
+        previous = bench.make_tracked_properties(500)
+        current = bench.make_updated_properties(previous, 0.1)
+        same_pids = previous.index.intersection(current.index)
+        expect = bench.legacy_get_prop_value_change(
+            previous.loc[same_pids], current.loc[same_pids]
+        )
+        result = ppm.get_prop_value_change(previous.loc[same_pids], current.loc[same_pids])
+        self.assertEqual(expect, result)
+        self.assertEqual(list(expect), list(result))
+
+    def test_02_missing_values_unchanged(self):
+        previous = bench.make_tracked_properties(4)
+        previous["Bedroom_num"] = np.nan
+        current = previous.copy()
+        self.assertIsNone(ppm.get_prop_value_change(previous, current))
+        current.iloc[0, 1] = 2.0
+        current.iloc[3, 0] = "$10 per week"
+        result = ppm.diff_property_info(previous, current.iloc[::-1])
+        self.assertEqual(set(), result["new"] | result["passed"])
+        self.assertEqual([previous.index[0], previous.index[3]], list(result["changed"]))
+        self.assertEqual({"Bedroom_num"}, set(result["changed"][previous.index[0]]))
+
+
+def make_tracked_frame():
+    property_data = pd.DataFrame(
+        {
+            "Url": ["https://r/1", "https://d/2", "https://d/3"],
+            "Price": ["$500 per week", "$650 pw", "$2,800 pcm"],
+            "Name": ["1/83 Flemington Road", "2/83 Flemington Road", "33 Blackwood Street"],
+            "Room": ["1", "2", "-"],
+            "Street": ["83Flemington", "83Flemington", "33Blackwood"],
+            "Suburb": "Parkville",
+            "State": "VIC",
+            "Type": ["Apartment", "Apartment", "House"],
+            "Available": ["2021-09-01", "", "Now"],
+            "PID": ["1_83Flemington_Parkville_VIC", "2_83Flemington_Parkville_VIC", np.nan],
+            "Source": ["Realestate", "Domain", "Domain"],
+            "Latitude": [-37.79, -37.79, -37.80],
+            "Longitude": [144.95, 144.95, 144.94],
+            "Bedroom_num": [1, 2, np.nan],
+            "Bathroom_num": [1, 1, 2],
+            "Parking_num": [0, 1, 2],
+            "Images": [[{"server": "https://i", "uri": "/1.jpg"}], ["https://d/2.jpg"], []],
+        }
+    )
+    property_data.index = property_data["PID"].fillna(property_data["Url"])
+    property_data.index.name = ""
+    return property_data
+
+
+class TestSnapshotStore(unittest.TestCase):
+    def round_trip(self, fmt):
+        property_data = make_tracked_frame()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            folder = tmpdir + "/"
+            with mock.patch.object(ppm, "get_default_snapshot_format", return_value=fmt):
+                ppm.write_property_data(folder, property_data)
+                self.assertTrue(os.path.isfile(f"{folder}tracked_properties.{fmt}"))
+                result = ppm.read_property_data(folder)
+                projected = ppm.read_property_data(folder, ppm.CHECK_COL)
+        self.assertEqual(list(property_data.index), list(result.index))
+        self.assertEqual(list(property_data["Images"]), list(result["Images"]))
+        self.assertEqual(["1", "2", "-"], list(result["Room"]))
+        self.assertEqual("float64", result["Parking_num"].dtype)
+        self.assertEqual(ppm.CHECK_COL, list(projected.columns))
+        self.assertIsNone(ppm.diff_property_info(projected, property_data))
+
+    def test_01_csv_round_trip(self):
+        self.round_trip("csv")
+
+    @unittest.skipIf(importlib.util.find_spec("pyarrow") is None, "pyarrow is not installed")
+    def test_02_parquet_round_trip(self):
+        self.round_trip("parquet")
+
+    @unittest.skipIf(importlib.util.find_spec("pyarrow") is None, "pyarrow is not installed")
+    def test_03_migrate_csv(self):
+        property_data = make_tracked_frame()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            folder = tmpdir + "/"
+            property_data.to_csv(f"{folder}tracked_properties.csv")
+            self.assertTrue(ppm.migrate_csv_snapshot(folder))
+            self.assertFalse(ppm.migrate_csv_snapshot(folder))
+            self.assertEqual("parquet", ppm.get_snapshot_format(folder))
+            result = ppm.read_property_data(folder)
+        self.assertEqual(list(property_data["Images"]), list(result["Images"]))
+
+
+def make_updates():
+    """Three successive listings: reprice 1, delist 3 and list 4, then relist 3."""
+    first = make_tracked_frame()
+    second = first.copy()
+    second.loc["1_83Flemington_Parkville_VIC", "Price"] = "$520 per week"
+    fourth = first.iloc[[1]].rename(index=lambda pid: "4_83Flemington_Parkville_VIC")
+    fourth["PID"] = fourth.index
+    fourth["Url"] = "https://d/4"
+    second = pd.concat([second.iloc[:2], fourth])
+    third = pd.concat([second, first.iloc[[2]]])
+    return first, second, third
+
+
+class TestEventLog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.folder = self.tmpdir.name + "/monitor/"
+        self.times = ["2021-09-01 00:00:00", "2021-09-02 00:00:00", "2021-09-03 00:00:00"]
+        self.frames = make_updates()
+        ppm.initiate_property_data(self.folder, self.frames[0], None, self.times[0])
+        for frame, current_time in zip(self.frames[1:], self.times[1:]):
+            ppm.update_property_data(self.folder, frame, current_time)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_01_current_state(self):
+        result = ppm.read_property_data(self.folder)
+        self.assertIsNone(ppm.diff_property_info(result, self.frames[2]))
+        self.assertEqual(1, len(ppm.read_snapshot_meta(self.folder)["snapshots"]))
+
+    def test_02_state_at_time(self):
+        for frame, current_time in zip(self.frames, self.times):
+            result = ppm.read_property_data_at(self.folder, current_time, ppm.CHECK_COL)
+            self.assertIsNone(ppm.diff_property_info(result, frame))
+        with self.assertRaises(ValueError):
+            ppm.read_property_data_at(self.folder, "2021-08-31 00:00:00")
+
+    def test_03_compaction(self):
+        with mock.patch.object(ppm, "COMPACT_MIN_EVENTS", 1):
+            ppm.update_property_data(self.folder, self.frames[0], "2021-09-04 00:00:00")
+        meta = ppm.read_snapshot_meta(self.folder)
+        self.assertEqual(2, len(meta["snapshots"]))
+        self.assertEqual(0, meta["pending"])
+        result = ppm.read_property_data_at(self.folder, self.times[2])
+        self.assertIsNone(ppm.diff_property_info(result, self.frames[2]))
+        result = ppm.read_snapshot_data(self.folder)
+        self.assertIsNone(ppm.diff_property_info(result, self.frames[0]))
+
+    def test_04_property_json(self):
+        props_db = ppj.load_property_json(self.folder)
+        props_json = ppj.init_property_database(self.frames[0], self.times[0])
+        for i in [1, 2]:
+            props_json = ppj.updates_property_json(
+                self.frames[i], self.frames[i - 1], props_json, self.times[i]
+            )
+        pid = "1_83Flemington_Parkville_VIC"
+        expect = {self.times[0]: "$500 per week", self.times[1]: "$520 per week"}
+        self.assertEqual(expect, props_db[pid]["Price"])
+        self.assertEqual(expect, props_json[pid]["Price"])
+        self.assertEqual([self.times[1]], props_db["4_83Flemington_Parkville_VIC"]["Listing_date"])
+        self.assertEqual(sorted(props_db), sorted(props_json))
+
+    def test_05_property_json_in_place(self):
+        props_json = ppj.init_property_database(self.frames[0], self.times[0])
+        events = ppe.make_events(
+            ppm.diff_property_info(self.frames[0], self.frames[1]), self.frames[1], self.times[1]
+        )
+        props_events = ppj.apply_property_events(copy.deepcopy(props_json), events)
+        before = copy.deepcopy(props_json)
+        result = ppj.updates_property_json(self.frames[1], self.frames[0], props_json, self.times[1])
+        self.assertIs(props_json, result)
+        self.assertEqual(props_events, props_json)
+        self.assertNotEqual(before, props_json)
+        # Relisting one entity leaves the containers of the others alone.
+        entity_1, entity_2 = (props_json[pid] for pid in list(props_json)[:2])
+        for key in ["Listing_date", "Price", "Images"]:
+            self.assertIsNot(entity_1[key], entity_2[key])
+        ppj.relist_property_entity(self.frames[0].iloc[1], entity_2, self.times[2])
+        self.assertEqual([self.times[0]], entity_1["Listing_date"])
+
+    def test_06_changed_listing_details(self):
+        pid = "1_83Flemington_Parkville_VIC"
+        current = self.frames[2].copy()
+        current.loc[pid, "Price"] = "$650 per week"
+        current.loc[pid, "Available"] = "2021-10-01"
+        current.at[pid, "Images"] = ["https://i/b.jpg"]
+        ppm.update_property_data(self.folder, current, "2021-09-04 00:00:00")
+        result = ppm.read_property_data(self.folder)
+        self.assertEqual("$650 per week", result.at[pid, "Price"])
+        self.assertEqual("2021-10-01", result.at[pid, "Available"])
+        self.assertEqual(["https://i/b.jpg"], result.at[pid, "Images"])
+
+    def test_07_partial_event(self):
+        with open(self.folder + ppe.EVENT_LOG, "a") as f:
+            f.write('{"time": "2021-09-04 00:00:00", "event": "deli')
+        result = ppm.read_property_data(self.folder)
+        self.assertIsNone(ppm.diff_property_info(result, self.frames[2]))
+        ppm.update_property_data(self.folder, self.frames[1], "2021-09-05 00:00:00")
+        with open(self.folder + ppe.EVENT_LOG, "r") as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual("2021-09-05 00:00:00", events[-1]["time"])
+        result = ppm.read_property_data(self.folder)
+        self.assertIsNone(ppm.diff_property_info(result, self.frames[1]))
+
+
+class TestPropertySqlite(unittest.TestCase):
+    def setUp(self):
+        self.times = ["2021-09-01 00:00:00", "2021-09-02 00:00:00", "2021-09-03 00:00:00"]
+        self.frames = make_updates()
+        self.conn = pps.connect_property_database(":memory:")
+        pps.init_property_sqlite(self.conn, self.frames[0], self.times[0])
+        for i in [1, 2]:
+            pps.updates_property_sqlite(self.conn, self.frames[i], self.frames[i - 1], self.times[i])
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_01_price_history(self):
+        result = pps.get_price_history(self.conn, "1_83Flemington_Parkville_VIC")
+        expect = [(self.times[0], "$500 per week"), (self.times[1], "$520 per week")]
+        self.assertEqual(expect, result)
+
+    def test_02_active_listings(self):
+        self.assertEqual(
+            ["1_83Flemington_Parkville_VIC", "2_83Flemington_Parkville_VIC"],
+            pps.get_active_listings(self.conn, "2021-09-01 12:00:00"),
+        )
+        active = pps.get_active_listings(self.conn, "2021-09-02 12:00:00", "Parkville")
+        self.assertEqual(3, len(active))
+        active = pps.get_active_listings(self.conn, "2021-09-02 12:00:00", "Carlton")
+        self.assertEqual([], active)
+
+    def test_03_load_event_log(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            folder = tmpdir + "/monitor/"
+            ppm.initiate_property_data(folder, self.frames[0], None, self.times[0])
+            for i in [1, 2]:
+                ppm.update_property_data(folder, self.frames[i], self.times[i])
+            conn = pps.connect_property_database(f"{tmpdir}/properties.sqlite")
+            pps.load_property_sqlite(conn, folder)
+            for table in ["properties", "price_history", "listing_details", "listing_intervals"]:
+                query = f"SELECT * FROM {table} ORDER BY 1, 2"
+                self.assertEqual(
+                    self.conn.execute(query).fetchall(), conn.execute(query).fetchall()
+                )
+            conn.close()
+
+
+GOLDEN_NAMES = [
+    ("907/83 Flemington Road", "Apartment"),
+    ("33 Blackwood street", "House"),
+    ("33 Blackwood street", "Apartment"),
+    ("33 Blackwood street", None),
+    ("Unit 1510/8 Sutherland Street", "Apartment"),
+    ("UNIT 12/8 Sutherland ST", "Unit"),
+    ("G05/221 Sturt Street", "Apartment"),
+    ("h8/5 Ward Lane", "Apartment"),
+    ("407B/8 Howard Street", "Apartment"),
+    ("12.01/200 Spencer Street", "Apartment"),
+    ("G.11/7 Porter Place", "Apartment"),
+    ("2 Bedroom Apartment/800 Swanston Street", "Apartment"),
+    ("1/2/3 Triple Road", "Apartment"),
+    ("", "Apartment"),
+    ("", "House"),
+    (" 5 /12 Main Rd", "Townhouse"),
+    ("-/12 Main Rd", "Townhouse"),
+    ("/12 Main Rd", "Apartment"),
+    ("12/", "Apartment"),
+    ("12/ Main", "Apartment"),
+    ("LG1/10 Queens Road", "Apartment"),
+    ("1_000/10 Queens ROAD", "Apartment"),
+    ("+7/10 Queens RD", "Apartment"),
+    ("A/10 Queens Road", "Apartment"),
+    ("UNIT/10 Queens Road", "Apartment"),
+    ("Level 3/10 Queens Road", "Apartment"),
+    ("3 /10 Queens Drive", "Villa"),
+    ("10 Queens Terrace", "Terrace"),
+    ("10 Queens Terrace", "Apartment"),
+    ("10  Queens  Street", "House"),
+    ("10 Queens Street ", "House"),
+    ("10 st kilda road", "House"),
+    ("٣/10 Queens Road", "Apartment"),
+    ("1203/555 Flinders Street", "Apartment"),
+    ("1203/555 Flinders Street", "Apartment"),
+]
+
+
+class TestAddressNormalization(unittest.TestCase):
+    def test_01_room_street_golden(self):
+        names = pd.Series([name for name, _ in GOLDEN_NAMES])
+        types = pd.Series([estate_type for _, estate_type in GOLDEN_NAMES])
+        result = ppq.get_room_street_columns(names, types)
+        expect = [ppq.get_room_street(name, estate_type) for name, estate_type in GOLDEN_NAMES]
+        self.assertEqual(expect, list(zip(result["Room"], result["Street"])))
+
+    def test_02_pid(self):
+        property_info = pd.DataFrame(
+            {
+                "Name": [name for name, _ in GOLDEN_NAMES],
+                "Type": [estate_type for _, estate_type in GOLDEN_NAMES],
+                "Suburb": "Melbourne",
+                "State": "VIC",
+            }
+        )
+        result = ppq.add_room_street_pid(property_info, after="Name")
+        self.assertEqual(["Name", "Room", "Street", "Type", "Suburb", "State", "PID"], list(result))
+        for (name, estate_type), pid in zip(GOLDEN_NAMES, result["PID"]):
+            room, street = ppq.get_room_street(name, estate_type)
+            expect = f"{room}_{street}_Melbourne_VIC" if room != "" else None
+            self.assertEqual(expect, None if pd.isna(pid) else pid)
+
+
+class TestStreamingParse(unittest.TestCase):
+    def test_01_realestate_matches_legacy(self):
+        expect = bench.legacy_parse_realestate_pages(bench.make_realestate_pages(450))
+        result = ppq.parse_realestate_pages(iter(bench.make_realestate_pages(450)))
+        pd.testing.assert_frame_equal(expect, result)
+
+    def test_02_domain_matches_legacy(self):
+        pages = bench.make_domain_pages(95)
+        # Listing repeated on a later page with a new price.
+        pages[3]["props"]["listingsMap"]["5"] = bench.make_domain_listing(7)
+        expect = bench.legacy_parse_domain_pages(copy.deepcopy(pages))
+        result = ppq.parse_domain_pages(iter(pages))
+        pd.testing.assert_frame_equal(expect, result)
+
+    def test_03_get_realestate_properties(self):
+        pages = bench.make_realestate_pages(450)
+
+        def request(requisition, url=None):
+            page = 1 if requisition is not None else int(url.split('"page":"')[-1].strip('"}'))
+            return pages[page - 1], ppq.create_realestate_url({}) if url is None else url
+
+        with mock.patch.object(ppq, "request_realestate_properties", request):
+            result = ppq.get_realestate_properties({}, max_workers=2)
+        self.assertEqual(450, len(result))
+        self.assertEqual(450, result["PID"].nunique())
+        self.assertEqual("Realestate", result["Source"].iloc[0])
+
+
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self.rp, self.dp = bench.make_portal_properties(600)
+
+    def test_01_pid_join_matches_legacy(self):
+        expect = bench.legacy_merge_realestate_domain_properties(self.rp.copy(), self.dp.copy())
+        expect = ppq.compact_properties(expect)
+        stats = dict()
+        result = ppq.merge_realestate_domain_properties(self.rp, self.dp, None, stats)
+        pd.testing.assert_frame_equal(expect, result)
+        self.assertEqual(400, stats["pid_matched"])
+        self.assertEqual((200, 200), (stats["realestate_only"], stats["domain_only"]))
+
+    def test_02_geo_fallback(self):
+        rp = self.rp.copy()
+        # Realestate listing 300 loses its PID, Domain has it at index 100.
+        rp.loc[300, "PID"] = np.nan
+        # Domain copies without PID of Realestate-only listing 0 (once) and listing 1 (twice).
+        copies = self.rp.loc[[0, 1, 1]].assign(PID=np.nan, Source="Domain")
+        copies["Url"] = ["https://d/0", "https://d/1a", "https://d/1b"]
+        dp = pd.concat([self.dp, copies], ignore_index=True)
+        stats = dict()
+        result = ppq.merge_realestate_domain_properties(rp, dp, 20.0, stats)
+        self.assertEqual((399, 2), (stats["pid_matched"], stats["geo_matched"]))
+        self.assertEqual("Both", result.loc[self.dp.loc[100, "PID"], "Source"])
+        self.assertEqual("Both", result.loc[rp.loc[0, "PID"], "Source"])
+        self.assertEqual("Realestate", result.loc[rp.loc[1, "PID"], "Source"])
+        self.assertEqual(len(rp) + len(dp) - 401, len(result))
+
+    def test_03_no_geo_match_between_pids(self):
+        rp = self.rp.iloc[[0]].assign(Name="101/83 Flemington Road", Bedroom_num=2.0)
+        rp = ppq.add_room_street_pid(rp.drop(columns=["Room", "Street", "PID"]), after="Name")
+        dp = rp.assign(Name="102/83 Flemington Road", Source="Domain", Url="https://d/102")
+        dp = ppq.add_room_street_pid(dp.drop(columns=["Room", "Street", "PID"]), after="Name")
+        stats = dict()
+        result = ppq.merge_realestate_domain_properties(rp, dp, 20.0, stats)
+        self.assertEqual(0, stats["geo_matched"])
+        self.assertEqual(2, len(result))
+        stats = dict()
+        ppq.merge_realestate_domain_properties(rp, dp.assign(PID=np.nan), 20.0, stats)
+        self.assertEqual(1, stats["geo_matched"])
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.profiles = {
+            name: {**psch.PROFILE_DEFAULTS, "folder": f"{name}/", "requisition": {}}
+            for name in ["a", "b", "c"]
+        }
+        for profile in self.profiles.values():
+            profile["interval"] = 0.05
+
+    def test_01_load_profiles(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = f"{tmpdir}/profiles.json"
+            with open(path, "w") as f:
+                json.dump({"a": {"folder": "a/", "requisition": {"north": 1}}}, f)
+            profiles = psch.load_profiles(path)
+            self.assertEqual(3600, profiles["a"]["interval"])
+            with open(path, "w") as f:
+                profile = {"folder": "a/", "requisition": {}}
+                json.dump({"a": profile, "b": profile}, f)
+            with self.assertRaises(ValueError):
+                psch.load_profiles(path)
+
+    def test_02_concurrent_runs(self):
+        lock = threading.Lock()
+        active = [0, 0]
+
+        def run(profile):
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            if profile["folder"] == "c/":
+                raise requests.ConnectionError()
+
+        report = []
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter("always")
+            psch.run_scheduler(
+                self.profiles, max_workers=2, max_runs=2, run_report=report, run=run
+            )
+        self.assertEqual(6, len(report))
+        self.assertEqual(2, active[1])
+        self.assertEqual(2, sum(entry["error"] is not None for entry in report))
+
+    def test_03_graceful_stop(self):
+        stop = threading.Event()
+        finished = []
+
+        def run(profile):
+            stop.set()
+            time.sleep(0.05)
+            finished.append(profile["folder"])
+
+        report = psch.run_scheduler(
+            self.profiles, max_workers=1, stop_event=stop, run_report=[], run=run, jitter=0
+        )
+        self.assertEqual(1, len(finished))
+        self.assertEqual(1, len(report))
+
+    def test_04_backpressure(self):
+        self.assertEqual(1.0, psch.get_slowdown(1.0))
+        self.assertEqual(2.0, psch.get_slowdown(2 * psch.SLOW_LATENCY))
+        self.assertEqual(psch.MAX_SLOWDOWN, psch.get_slowdown(100 * psch.SLOW_LATENCY))
+        delay = psch.get_next_delay(10, 0.1, 2.0)
+        self.assertTrue(18 <= delay <= 22)
+
+    def test_05_request_budget(self):
+        budget = pph.RequestBudget(100, burst=1)
+        start = time.monotonic()
+        for _ in range(6):
+            budget.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.045)
+
+    def test_06_atomic_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            folder = tmpdir + "/"
+            data = make_tracked_frame()
+            with mock.patch.object(ppm.os, "replace", side_effect=KeyboardInterrupt):
+                with self.assertRaises(KeyboardInterrupt):
+                    ppm.write_property_data(folder, data)
+            # The interrupted write leaves only its temporary file behind.
+            fmt = ppm.get_default_snapshot_format()
+            self.assertEqual([f"tracked_properties.{fmt}.tmp"], os.listdir(tmpdir))
+            ppm.write_property_data(folder, data)
+            self.assertEqual(len(data), len(ppm.read_snapshot_data(folder)))
+
+
+class TestStateStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.folder = self.tmpdir.name + "/"
+        for file in [ppm.PREFERENCE_FILE, ppm.IGNORE_FILE]:
+            with open(f"{self.folder}{file}", "w") as f:
+                f.write("")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_01_concurrent_edits(self):
+        threads = [
+            threading.Thread(target=emr.set_preferred_properties, args=(self.folder, f"p_{i}"))
+            for i in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pref = ppm.read_name_list(self.folder, ppm.PREFERENCE_FILE)
+        self.assertEqual({""} | {f"p_{i}" for i in range(20)}, pref)
+        self.assertNotIn(f"{ppm.PREFERENCE_FILE}.tmp", os.listdir(self.folder))
+
+    def test_02_batched_edits(self):
+        emr.edit_preferences(self.folder, preferred=["a_1", "a_2"], ignored=["street_a"])
+        emr.edit_preferences(self.folder, unpreferred=["a_1"], unignored=["street_b"])
+        self.assertEqual({"", "a_2"}, ppm.read_name_list(self.folder, ppm.PREFERENCE_FILE))
+        self.assertEqual({"", "street_a"}, ppm.read_name_list(self.folder, ppm.IGNORE_FILE))
+
+    @unittest.skipIf(ppm.fcntl is None, "needs fcntl")
+    def test_03_folder_lock(self):
+        lock_path = f"{self.folder}{ppm.FOLDER_LOCK}"
+        with ppm.folder_lock(self.folder):
+            with ppm.folder_lock(self.folder):  # Reentrant within a thread.
+                pass
+            # Another open file description (as in another process) cannot take the lock.
+            with open(lock_path, "a") as f:
+                with self.assertRaises(BlockingIOError):
+                    ppm.fcntl.flock(f, ppm.fcntl.LOCK_EX | ppm.fcntl.LOCK_NB)
+        with open(lock_path, "a") as f:
+            ppm.fcntl.flock(f, ppm.fcntl.LOCK_EX | ppm.fcntl.LOCK_NB)
+
+
+class TestNameIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.folder = self.tmpdir.name + "/"
+        for file in [ppm.PREFERENCE_FILE, ppm.IGNORE_FILE]:
+            with open(f"{self.folder}{file}", "w") as f:
+                f.write("street_a")
+        self.props = pd.DataFrame(
+            {
+                "Name": ["1/1 street_a", "2 street_b", "3 lane_c", "4 road_d"],
+                "Street": ["street_a", "street_b", "lane_c", "road_d"],
+                "Suburb": ["carlton", "carlton", "parkville", "docklands"],
+            },
+            index=["a", "b", "c", "d"],
+        )
+        for col in ["Price", "Bedroom_num", "Bathroom_num", "Url", "Available", "Type"]:
+            self.props[col] = np.nan
+        self.props["Parking_num"] = np.nan
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_01_reload_on_change(self):
+        index = ppm.get_name_index(self.folder, ppm.IGNORE_FILE)
+        self.assertIn("street_a", index)
+        with mock.patch.object(ppm, "read_name_list", wraps=ppm.read_name_list) as read:
+            self.assertNotIn("street_b", index)
+            self.assertEqual(0, read.call_count)
+            with open(f"{self.folder}{ppm.IGNORE_FILE}", "w") as f:
+                f.write("street_a,street_b")
+            self.assertIn("street_b", index)
+            self.assertEqual(1, read.call_count)
+
+    def test_02_rules(self):
+        emr.set_ignored_streets(self.folder, ["suburb:docklands", "prefix:lane"])
+        result = ppm.filter_prop(self.props, self.folder)
+        self.assertEqual(["2 street_b"], list(result["Name"]))
+
+    def test_03_write_behind(self):
+        with mock.patch.object(ppm, "WRITE_BEHIND_DELAY", 0.05):
+            emr.edit_preferences(self.folder, preferred=["b"], write_behind=True)
+            index = ppm.get_name_index(self.folder, ppm.PREFERENCE_FILE)
+            self.assertIn("b", index)
+            self.assertEqual({"street_a"}, ppm.read_name_list(self.folder, ppm.PREFERENCE_FILE))
+            # Edits made to the file meanwhile are kept.
+            with open(f"{self.folder}{ppm.PREFERENCE_FILE}", "w") as f:
+                f.write("street_a,c")
+            time.sleep(0.2)
+        pref = ppm.read_name_list(self.folder, ppm.PREFERENCE_FILE)
+        self.assertEqual({"b", "c", "street_a"}, pref)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        pmet.reset()
+        self.requisitions = [{"north": i} for i in range(3)]
+
+    def tearDown(self):
+        pmet.enable(False)
+        pmet.reset()
+
+    def sweep(self):
+        with mock.patch.object(
+            ppq, "get_realestate_properties", fake_portal_query("Realestate")
+        ), mock.patch.object(ppq, "get_domain_properties", fake_portal_query("Domain")):
+            return ppd.query_multi_chunk_properties(self.requisitions, max_workers=2)
+
+    def test_01_disabled(self):
+        self.sweep()
+        self.assertIs(pmet.NULL_TIMER, pmet.stage("parse"))
+        self.assertEqual({"stages": {}, "counters": {}, "chunks": []}, pmet.get_report())
+
+    def test_02_run_report(self):
+        pmet.enable()
+        self.sweep()
+        report = pmet.get_report()
+        self.assertEqual(["merge", "sweep"], list(report["stages"]))
+        self.assertEqual(1, report["stages"]["sweep"]["calls"])
+        self.assertEqual(6, len(report["chunks"]))
+        self.assertEqual({3}, {chunk["listings"] for chunk in report["chunks"]})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pmet.write_report(f"{tmpdir}/report.json")
+            with open(f"{tmpdir}/report.json", "r") as f:
+                self.assertEqual(report, json.load(f))
+
+    def test_03_prometheus(self):
+        pmet.enable()
+        pmet.count("http_requests", 3)
+        pmet.record_chunk(0, "Domain", 12, 0.5)
+        with pmet.stage("diff"):
+            pass
+        text = pmet.to_prometheus()
+        self.assertIn("estate_monitor_http_requests_total 3\n", text)
+        self.assertIn('estate_monitor_chunk_listings{chunk="0",source="Domain"} 12\n', text)
+        self.assertIn('estate_monitor_stage_calls_total{stage="diff"} 1\n', text)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_01_portal_stub(self):
+        with bench.portal_stub(chunk_size=250):
+            req = bench.get_stub_requisitions(2)[1]
+            rp = ppq.get_realestate_properties(req, max_workers=2)
+            dp = ppq.get_domain_properties(req, max_workers=2)
+        self.assertEqual(250, len(rp))
+        self.assertEqual(250, len(dp))
+        self.assertEqual("https://www.domain.com.au", ppq.DOMAIN_URL)
+        merged = ppq.merge_realestate_domain_properties(rp, dp)
+        self.assertEqual(250 - 250 // 3, (merged["Source"] == "Both").sum())
+
+    def test_02_regressions(self):
+        baseline = {"1000": {"merge": {"seconds": 1.0, "peak_mb": 10.0}}}
+        results = {"1000": {"merge": {"seconds": 1.1, "peak_mb": 20.0}, "diff": {}}}
+        regressions = bench.find_regressions(results, baseline)
+        self.assertEqual(1, len(regressions))
+        self.assertTrue(regressions[0].startswith("merge at 1000 listings: peak_mb"))
+        # Small in-process stages regress on the ratio alone, portal stages need a margin.
+        baseline = {
+            "1000": {
+                "diff_property_info": {"seconds": 0.1, "peak_mb": 1.0},
+                "get_domain_properties": {"seconds": 0.6, "peak_mb": 1.0},
+            }
+        }
+        results = {
+            "1000": {
+                "diff_property_info": {"seconds": 0.2, "peak_mb": 1.0},
+                "get_domain_properties": {"seconds": 0.9, "peak_mb": 1.0},
+            }
+        }
+        regressions = bench.find_regressions(results, baseline)
+        self.assertEqual(1, len(regressions))
+        self.assertTrue(regressions[0].startswith("diff_property_info at 1000 listings: seconds"))
+
+
+class TestCompactMemory(unittest.TestCase):
+    def setUp(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            rp, dp = bench.make_portal_properties(300)
+        self.merged = ppq.merge_realestate_domain_properties(rp, dp)
+
+    def test_01_dtypes(self):
+        self.assertIsInstance(self.merged["Suburb"].dtype, pd.CategoricalDtype)
+        self.assertEqual("float32", self.merged["Parking_num"].dtype)
+        images = self.merged.loc[self.merged["Source"] != "Domain", "Images"]
+        first, second = images.iloc[0], images.iloc[1]
+        self.assertIs(first[0]["server"], second[0]["server"])
+
+    def test_02_memory_report(self):
+        report = bench.bench_memory(300)
+        self.assertLess(report["compact_mb"], report["plain_mb"])
+        columns = ppq.get_memory_report(self.merged)["columns"]
+        self.assertEqual(set(self.merged.columns) | {"Index"}, set(columns))
+
+    def test_03_diff_against_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = f"{tmpdir}/tracked_properties.csv"
+            ppm.write_csv_snapshot(path, self.merged)
+            previous = ppm.read_csv_snapshot(path, ppm.CHECK_COL)
+        self.assertIsNone(ppm.diff_property_info(previous, self.merged))
+        current = self.merged.copy()
+        pid = current.index[current["Source"] == "Both"][0]
+        current.loc[pid, "Source"] = "Realestate"
+        change = ppm.diff_property_info(previous, current)["changed"]
+        self.assertEqual({pid: {"Source": ("Both", "Realestate")}}, change)
+
+    def test_04_json_entities(self):
+        props_db = ppj.init_property_database(self.merged, "2021-09-01 12:00:00")
+        entity = props_db[self.merged["PID"].dropna().iloc[0]]
+        self.assertIs(float, type(entity["Bedroom_num"]))
+        json.dumps(props_db)
+
+
+class TestWeeklyPrice(unittest.TestCase):
+    def test_01_parse(self):
+        cases = {
+            "$650 per week": (650.0, ""),
+            "$2,800 pcm": (646.15, ""),
+            "$31,200 per annum": (600.0, ""),
+            "$1,300 per fortnight": (650.0, ""),
+            "$1300 pf": (650.0, ""),
+            "$1300 p.f.": (650.0, ""),
+            "$1,300 fortnightly": (650.0, ""),
+            "$650 per week - annual lease": (650.0, ""),
+            "$650pw - Short Term Lease (Monthly)": (650.0, ""),
+            "$1,200 per week (nightly stays avail)": (1200.0, ""),
+            "$2,800 pcm (weekly inspections)": (646.15, ""),
+            "$650/wk": (650.0, ""),
+            "Contact agent 0412 345 678": (np.nan, "none"),
+            "Call 9654 1234 to inspect": (np.nan, "none"),
+            "Leased in 2021": (np.nan, "none"),
+            "Call 9654 1234, 650 pw": (650.0, ""),
+            "$500 - $550 pw": (500.0, "range"),
+            "$650 pw / $2824 pcm": (650.0, ""),
+            "650 pw": (650.0, ""),
+            "Contact agent": (np.nan, "none"),
+        }
+        prices = pd.Series(list(cases) + ["$650 per week", np.nan])
+        result = ppq.get_weekly_price_columns(prices)
+        expect = [value for value, _ in cases.values()] + [650.0, np.nan]
+        np.testing.assert_array_equal(expect, result["Weekly_price"].to_numpy())
+        self.assertEqual(
+            [flag for _, flag in cases.values()] + ["", "none"], list(result["Price_flag"])
+        )
+
+    def test_02_cosmetic_change(self):
+        previous = ppm.ensure_weekly_price(make_tracked_frame())
+        current = make_tracked_frame()
+        current["Price"] = ["$500 pw", "$650 per week", "$2,800 per month"]
+        self.assertIsNone(ppm.diff_property_info(previous, current))
+        current.iloc[0, current.columns.get_loc("Price")] = "$520 pw"
+        change = ppm.diff_property_info(previous, current)["changed"]
+        expect = {"1_83Flemington_Parkville_VIC": {"Weekly_price": (500.0, 520.0)}}
+        self.assertEqual(expect, change)
+
+    def test_03_legacy_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            folder = tmpdir + "/"
+            make_tracked_frame().to_csv(f"{folder}tracked_properties.csv")
+            with mock.patch.object(ppm, "get_default_snapshot_format", return_value="csv"):
+                result = ppm.read_property_data(folder, ppm.CHECK_COL)
+        self.assertEqual(ppm.CHECK_COL, list(result.columns))
+        self.assertEqual([500.0, 650.0, 646.15], list(result["Weekly_price"]))
+
+    def test_04_price_history(self):
+        first, second, _ = make_updates()
+        times = ["2021-09-01 12:00:00", "2021-09-02 12:00:00"]
+        props_json = ppj.init_property_database(first, times[0])
+        props_json = ppj.updates_property_json(second, first, props_json, times[1])
+        pid = "1_83Flemington_Parkville_VIC"
+        self.assertEqual(dict(zip(times, [500.0, 520.0])), props_json[pid]["Weekly_price"])
+        conn = pps.connect_property_database(":memory:")
+        pps.init_property_sqlite(conn, first, times[0])
+        pps.updates_property_sqlite(conn, second, first, times[1])
+        self.assertEqual([pid], pps.get_weekly_price_range(conn, 510, 530))
+        self.assertEqual(3, len(pps.get_weekly_price_range(conn, 500, 700)))
+
+
+class TestGeoIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 2000
+        self.props = pd.DataFrame(
+            {
+                "Latitude": -37.8 + rng.uniform(-0.05, 0.05, n),
+                "Longitude": 144.96 + rng.uniform(-0.06, 0.06, n),
+                "Bedroom_num": rng.integers(1, 4, n).astype(float),
+            },
+            index=[f"{i}_Street_Carlton_VIC" for i in range(n)],
+        )
+        self.index = pgeo.GeoIndex(self.props)
+        self.distance = pgeo.get_distance(
+            -37.8, 144.96, self.props["Latitude"], self.props["Longitude"]
+        )
+
+    def test_01_radius(self):
+        result = self.index.query_radius(-37.8, 144.96, 1500)
+        self.assertEqual(set(self.props.index[self.distance <= 1500]), set(result))
+        self.assertEqual(list(self.props.index[np.argsort(self.distance)[: len(result)]]), result)
+        two_beds = self.props.loc[result].query("Bedroom_num == 2")
+        self.assertTrue(0 < len(two_beds) < len(result))
+
+    def test_02_polygon(self):
+        polygon = [(-37.79, 144.95), (-37.79, 144.97), (-37.81, 144.96)]
+        result = set(self.index.query_polygon(polygon))
+        lat, lon = self.props["Latitude"], self.props["Longitude"]
+        # Inside the triangle: below the top edge and between the two slanted edges.
+        inside = (lat < -37.79) & (lat > -37.81 + 2 * (lon - 144.96).abs())
+        self.assertEqual(set(self.props.index[inside]), result)
+
+    def test_03_nearest_dms(self):
+        self.assertAlmostEqual(-37.8, emr.transform_angle([-37, 48]))
+        result = self.index.query_nearest([-37, 48], [144, 57, 36], 5)
+        self.assertEqual(list(self.props.index[np.argsort(self.distance)[:5]]), result)
+
+    def test_04_incremental_update(self):
+        first, second, third = make_updates()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            folder = tmpdir + "/monitor/"
+            ppm.initiate_property_data(folder, first, None, "2021-09-01 00:00:00")
+            geo_index = ppm.get_geo_index(folder)
+            self.assertEqual(3, len(geo_index))
+            second = second.copy()
+            second.loc["4_83Flemington_Parkville_VIC", "Latitude"] = -37.7
+            ppm.update_property_data(folder, second, "2021-09-02 00:00:00")
+        self.assertIs(geo_index, ppm.get_geo_index(folder))
+        self.assertEqual(["4_83Flemington_Parkville_VIC"], geo_index.query_radius(-37.7, 144.95, 50))
+        self.assertEqual([], geo_index.query_radius(-37.80, 144.94, 50))
+
+
+class ListSink:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.batches = []
+
+    def send(self, notifications):
+        time.sleep(self.delay)
+        self.batches.append(notifications)
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.received.append(json.loads(body))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        return
+
+
+def make_change(pid, previous, price, preferred=False):
+    event = {
+        "time": "2021-09-01 00:00:00",
+        "event": "changed",
+        "pid": pid,
+        "fields": {"Weekly_price": price, "Price": f"${price} per week"},
+        "previous": {"Weekly_price": previous},
+    }
+    return pnot.make_notifications([event], {pid} if preferred else set(), "monitor/")[0]
+
+
+class TestNotifier(unittest.TestCase):
+    def test_01_coalescing(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = f"{tmpdir}/notifications.jsonl"
+            notifier = pnot.Notifier([pnot.JsonlSink(path)], coalesce_delay=60)
+            notifier.submit([make_change("1", 500.0, 520.0), make_change("2", 500.0, 520.0)])
+            notifier.submit([make_change("1", 520.0, 540.0), make_change("2", 520.0, 500.0)])
+            listed = {"time": "t", "event": "listed", "pid": "3", "fields": {"Price": "$1"}}
+            notifier.submit(pnot.make_notifications([listed]))
+            delisted = {"time": "t", "event": "delisted", "pid": "3"}
+            notifier.submit(pnot.make_notifications([delisted]))
+            self.assertTrue(notifier.flush(5))
+            with open(path, "r") as f:
+                sent = [json.loads(line) for line in f]
+        self.assertEqual(1, len(sent))
+        self.assertEqual({"Weekly_price": 500.0}, sent[0]["previous"])
+        self.assertEqual({"Weekly_price": 540.0, "Price": "$540.0 per week"}, sent[0]["fields"])
+
+    def test_02_priority_and_rate(self):
+        sink = ListSink()
+        notifier = pnot.Notifier([sink], coalesce_delay=0, rate=20, burst=1, batch_size=2)
+        start = time.monotonic()
+        notifier.submit([make_change(str(i), 500.0, 520.0, preferred=i >= 4) for i in range(6)])
+        notifier.close(5)
+        self.assertGreaterEqual(time.monotonic() - start, 0.08)
+        self.assertEqual(
+            [["4", "5"], ["0", "1"], ["2", "3"]],
+            [[notification["pid"] for notification in batch] for batch in sink.batches],
+        )
+        with self.assertRaises(RuntimeError):
+            notifier.submit([make_change("1", 500.0, 520.0)])
+
+    def test_03_slow_and_failing_sinks(self):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), WebhookHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        slow = ListSink(delay=0.5)
+        smtp = mock.MagicMock()
+        sinks = [
+            slow,
+            pnot.WebhookSink(f"http://127.0.0.1:{server.server_address[1]}/hook"),
+            pnot.SmtpSink(["me@localhost"]),
+        ]
+        try:
+            with mock.patch.object(pnot.smtplib, "SMTP", side_effect=ConnectionRefusedError):
+                notifier = pnot.Notifier(sinks, coalesce_delay=0)
+                start = time.monotonic()
+                notifier.submit([make_change("1", 500.0, 520.0, preferred=True)])
+                self.assertLess(time.monotonic() - start, 0.1)
+                with self.assertWarns(UserWarning):
+                    notifier.flush(5)
+            with mock.patch.object(pnot.smtplib, "SMTP", return_value=smtp):
+                notifier.submit([make_change("2", 500.0, 520.0)])
+                notifier.flush(5)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(2, len(slow.batches))
+        self.assertEqual(
+            ["1", "2"], [body["notifications"][0]["pid"] for body in WebhookHandler.received]
+        )
+        message = smtp.__enter__.return_value.send_message.call_args[0][0]
+        self.assertIn("2 : Weekly_price from '500.0' to '520.0'.", message.get_content())
+
+    def test_04_monitor_update(self):
+        first, second, _ = make_updates()
+        sink = ListSink()
+        notifier = pnot.Notifier([sink], coalesce_delay=0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            folder = tmpdir + "/monitor/"
+            ppm.initiate_property_data(folder, first, None, "2021-09-01 00:00:00")
+            emr.set_preferred_properties(folder, "1_83Flemington_Parkville_VIC")
+            ppm.update_property_data(folder, second, "2021-09-02 00:00:00", notifier)
+        notifier.close(5)
+        sent = [notification for batch in sink.batches for notification in batch]
+        self.assertEqual(
+            [("1_83Flemington_Parkville_VIC", "changed", True)],
+            [(n["pid"], n["event"], n["preferred"]) for n in sent][:1],
+        )
+        self.assertEqual(
+            {"listed", "delisted", "changed"}, {notification["event"] for notification in sent}
+        )
+        self.assertEqual({folder}, {notification["folder"] for notification in sent})